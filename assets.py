@@ -0,0 +1,175 @@
+# NOTE: This file contains the AssetPipeline class that is used to serve resized, cached variants of image assets.
+
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable
+
+import streamlit as st
+from PIL import Image
+
+CACHE_DIR = ".cache/assets"
+
+# Longest side in pixels, file format and save options of every variant
+VARIANTS = {
+    "icon": (64, "PNG", {"optimize": True}),
+    "thumbnail": (256, "WEBP", {"quality": 80, "method": 6}),
+    "detail": (768, "WEBP", {"quality": 85, "method": 6}),
+}
+
+MIME_TYPES = {"PNG": "image/png", "WEBP": "image/webp"}
+
+
+class AssetPipeline:
+    """
+    Generates resized, format-optimised variants of image assets and caches them.
+
+    Each variant is generated once and stored on disk under the content hash of its source,
+    so an edited source gets new variants and an unchanged one is never resized again.
+    Decoded variants are kept in a process-level LRU cache.
+
+    Attributes:
+        cache_dir (str): The directory of the generated variants.
+        max_decoded (int): The maximum number of decoded images kept in memory.
+
+    Methods:
+        variant_path: Returns the path of a variant, generating it if needed.
+        image: Returns a decoded variant.
+        data_uri: Returns a variant as a data URI for the browser.
+        warm: Generates and decodes variants ahead of time.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_decoded: int = 256) -> None:
+        self.cache_dir = cache_dir
+        self.max_decoded = max_decoded
+        self._hashes = {}
+        self._decoded = OrderedDict()
+        self._data_uris = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _content_hash(self, source: str) -> str:
+        stat = os.stat(source)
+        key = (source, stat.st_mtime_ns, stat.st_size)
+        content_hash = self._hashes.get(key)
+        if content_hash is None:
+            with open(source, "rb") as file:
+                content_hash = hashlib.sha256(file.read()).hexdigest()[:32]
+            self._hashes[key] = content_hash
+        return content_hash
+
+    def variant_path(self, source: str, variant: str) -> str:
+        """
+        Returns the path of a variant, generating it if needed.
+
+        Args:
+            source (str): The path of the source image.
+            variant (str): "icon", "thumbnail" or "detail".
+
+        Returns:
+            str: The path of the generated file.
+        """
+        size, image_format, options = VARIANTS[variant]
+        path = os.path.join(
+            self.cache_dir,
+            "{0}-{1}.{2}".format(
+                self._content_hash(source), variant, image_format.lower()
+            ),
+        )
+        if not os.path.exists(path):
+            with Image.open(source) as image:
+                image.load()
+                if image_format == "WEBP" or image.mode not in {"RGB", "RGBA"}:
+                    image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+                image.thumbnail((size, size), Image.LANCZOS)
+                temporary = "{0}.{1}.tmp".format(path, threading.get_ident())
+                image.save(temporary, image_format, **options)
+            os.replace(temporary, path)
+        return path
+
+    def image(self, source: str, variant: str) -> Image.Image:
+        """
+        Returns a decoded variant, shared by all sessions.
+
+        Args:
+            source (str): The path of the source image.
+            variant (str): "icon", "thumbnail" or "detail".
+
+        Returns:
+            Image.Image: The decoded image. Callers must not modify it.
+        """
+        path = self.variant_path(source, variant)
+        with self._lock:
+            image = self._decoded.get(path)
+            if image is not None:
+                self._decoded.move_to_end(path)
+                return image
+        image = Image.open(path)
+        image.load()
+        with self._lock:
+            self._decoded[path] = image
+            while len(self._decoded) > self.max_decoded:
+                self._decoded.popitem(last=False)
+        return image
+
+    def data_uri(self, source: str, variant: str) -> str:
+        """
+        Returns a variant as a base64 data URI, e.g. for st.column_config.ImageColumn.
+
+        Args:
+            source (str): The path of the source image.
+            variant (str): "icon", "thumbnail" or "detail".
+
+        Returns:
+            str: The data URI.
+        """
+        path = self.variant_path(source, variant)
+        uri = self._data_uris.get(path)
+        if uri is None:
+            with open(path, "rb") as file:
+                encoded = base64.b64encode(file.read()).decode("ascii")
+            mime_type = MIME_TYPES[VARIANTS[variant][1]]
+            uri = "data:{0};base64,{1}".format(mime_type, encoded)
+            self._data_uris[path] = uri
+        return uri
+
+    def warm(self, sources: Iterable[tuple]) -> None:
+        """
+        Generates and decodes variants ahead of time.
+
+        Missing or unreadable sources are skipped.
+
+        Args:
+            sources (Iterable): (source path, variant) pairs.
+        """
+        for source, variant in sources:
+            try:
+                self.image(source, variant)
+            except (OSError, ValueError):
+                continue
+
+
+@st.cache_resource(show_spinner=False)
+def get_asset_pipeline() -> AssetPipeline:
+    """
+    Returns the process-wide asset pipeline.
+
+    The icon is generated on first use; the product photos listed in the catalog are
+    warmed on a background thread so the first page render does not wait for them.
+
+    Returns:
+        AssetPipeline: The shared pipeline.
+    """
+    from catalog import get_catalog
+
+    pipeline = AssetPipeline()
+    pipeline.warm([("assets/icon.jpeg", "icon")])
+
+    def warm_products():
+        photos = get_catalog().frame["Photo"].dropna()
+        pipeline.warm((photo, "thumbnail") for photo in photos)
+
+    threading.Thread(target=warm_products, name="asset-warmup", daemon=True).start()
+    return pipeline
@@ -1,8 +1,13 @@
 # NOTE: This file contains the FirebaseAuthenticator class that is used to manage user authentication using Firebase.
 
 import json
+import jwt
 import requests
+from background_jobs import JobQueueFull, get_job_queue
 from credential_loader import Credentials
+from http_transport import get_identity_transport
+from token_manager import TokenManager
+from token_verifier import get_token_verifier
 import streamlit as st
 import re
 
@@ -13,6 +18,8 @@ class FirebaseAuthenticator(Credentials):
 
     Attributes:
         firebase_config (str): Firebase configuration.
+        identity (PooledTransport): Shared keep-alive transport for the Identity Toolkit API.
+        jobs (JobQueue): Shared worker pool for fire-and-forget auth side-effects.
 
     Methods:
         sign_in_with_email_and_password: Signs in a user with the provided email and password.
@@ -21,17 +28,25 @@ class FirebaseAuthenticator(Credentials):
         send_password_reset_email: Sends a password reset email to the specified email address.
         create_user_with_email_and_password: Creates a new user with the provided email and password.
         delete_user_account: Deletes a user account using the provided ID token.
+        account_info_from_token: Builds the account information from the verified claims of an ID token.
+        session_is_valid: Checks the current session's ID token locally.
+        run_in_background: Runs an auth side-effect on the shared job queue.
+        collect_auth_jobs: Reports failed background auth jobs of the current session.
         raise_detailed_error: Raises a detailed error if the HTTP request returns an error status code.
         sign_in: Signs in a user with the provided email and password.
         create_account: Creates a new user account with the provided email and password.
         reset_password: Resets the password for the given email.
         sign_out: Clears the session state and displays a success message for signing out.
         delete_account: Deletes the user account associated with the provided password.
+        verify_password: Verifies the password against the user's password.
+        stop_token_manager: Stops the background token refresh of the current session.
     """
 
     def __init__(self) -> None:
         super().__init__()
         self.firebase_config = self.get_firebase_config().get("apiKey")
+        self.identity = get_identity_transport()
+        self.jobs = get_job_queue()
 
     def sign_in_with_email_and_password(self, email: str, password: str) -> dict:
         """
@@ -47,14 +62,11 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error during the API request.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={0}".format(
-            self.firebase_config
+        request_object = self.identity.post_json(
+            "verifyPassword",
+            {"email": email, "password": password, "returnSecureToken": True},
+            params={"key": self.firebase_config},
         )
-        headers = {"content-type": "application/json; charset=UTF-8"}
-        data = json.dumps(
-            {"email": email, "password": password, "returnSecureToken": True}
-        )
-        request_object = requests.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
@@ -71,12 +83,11 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error in the request.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getAccountInfo?key={0}".format(
-            self.firebase_config
+        request_object = self.identity.post_json(
+            "getAccountInfo",
+            {"idToken": id_token},
+            params={"key": self.firebase_config},
         )
-        headers = {"content-type": "application/json; charset=UTF-8"}
-        data = json.dumps({"idToken": id_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
@@ -90,12 +101,12 @@ class FirebaseAuthenticator(Credentials):
         Returns:
             dict: The response JSON object containing the result of the request.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(
-            self.firebase_config
+        request_object = self.identity.post_json(
+            "getOobConfirmationCode",
+            {"requestType": "VERIFY_EMAIL", "idToken": id_token},
+            params={"key": self.firebase_config},
+            idempotent=False,
         )
-        headers = {"content-type": "application/json; charset=UTF-8"}
-        data = json.dumps({"requestType": "VERIFY_EMAIL", "idToken": id_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
@@ -112,12 +123,12 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error in the API call.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(
-            self.firebase_config
+        request_object = self.identity.post_json(
+            "getOobConfirmationCode",
+            {"requestType": "PASSWORD_RESET", "email": email},
+            params={"key": self.firebase_config},
+            idempotent=False,
         )
-        headers = {"content-type": "application/json; charset=UTF-8"}
-        data = json.dumps({"requestType": "PASSWORD_RESET", "email": email})
-        request_object = requests.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
@@ -135,14 +146,12 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error in the API call.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/signupNewUser?key={0}".format(
-            self.firebase_config
-        )
-        headers = {"content-type": "application/json; charset=UTF-8"}
-        data = json.dumps(
-            {"email": email, "password": password, "returnSecureToken": True}
+        request_object = self.identity.post_json(
+            "signupNewUser",
+            {"email": email, "password": password, "returnSecureToken": True},
+            params={"key": self.firebase_config},
+            idempotent=False,
         )
-        request_object = requests.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
@@ -159,15 +168,128 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error in the delete account request.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/deleteAccount?key={0}".format(
-            self.firebase_config
+        request_object = self.identity.post_json(
+            "deleteAccount",
+            {"idToken": id_token},
+            params={"key": self.firebase_config},
+            idempotent=False,
         )
-        headers = {"content-type": "application/json; charset=UTF-8"}
-        data = json.dumps({"idToken": id_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
+    def account_info_from_token(self, id_token: str) -> dict:
+        """
+        Builds the account information from the verified claims of an ID token.
+
+        The token is verified locally with the cached signing keys, which saves the
+        getAccountInfo round trip. If local verification is not possible, the account
+        information is fetched from the API instead.
+
+        Args:
+            id_token (str): The ID token returned by sign-in.
+
+        Returns:
+            dict: The account information, shaped like the getAccountInfo response.
+        """
+        try:
+            claims = get_token_verifier(
+                self.get_firebase_config()["projectId"]
+            ).verify(id_token)
+        except Exception:
+            return self.get_account_info(id_token)
+        return {
+            "users": [
+                {
+                    "localId": claims["sub"],
+                    "email": claims.get("email"),
+                    "emailVerified": claims.get("email_verified", False),
+                    "displayName": claims.get("name"),
+                    "photoUrl": claims.get("picture"),
+                }
+            ]
+        }
+
+    def session_is_valid(self) -> bool:
+        """
+        Checks the current session's ID token locally, without network I/O once the keys are cached.
+
+        Guest sessions and sessions without a token manager are always considered valid.
+
+        Returns:
+            bool: False if the token was rejected, True otherwise.
+        """
+        token_manager = st.session_state.get("token_manager")
+        if token_manager is None:
+            return True
+        try:
+            get_token_verifier(self.get_firebase_config()["projectId"]).verify(
+                token_manager.id_token
+            )
+        except jwt.InvalidTokenError:
+            return False
+        except Exception:
+            return True
+        return True
+
+    def run_in_background(self, name: str, fn, *args) -> None:
+        """
+        Runs an auth side-effect on the shared job queue and records the job in the session.
+
+        If the queue is full, the call runs synchronously instead, so errors are raised
+        to the caller as before.
+
+        Args:
+            name (str): The name of the job, used to report failures.
+            fn: The function to run.
+            *args: Arguments for `fn`.
+
+        Returns:
+            None
+        """
+        try:
+            job_id = self.jobs.submit(name, fn, *args)
+        except JobQueueFull:
+            fn(*args)
+            return
+        st.session_state.setdefault("auth_jobs", []).append(job_id)
+
+    def collect_auth_jobs(self) -> None:
+        """
+        Polls the session's background auth jobs and reports failures as `auth_warning`.
+
+        Finished jobs are removed from `st.session_state.auth_jobs`.
+
+        Returns:
+            None
+        """
+        pending = []
+        for job_id in st.session_state.get("auth_jobs", []):
+            job = self.jobs.status(job_id)
+            if job is None:
+                continue
+            if job["state"] in {"pending", "running"}:
+                pending.append(job_id)
+            elif job["state"] == "failed":
+                error = job["error"]
+                try:
+                    error_message = json.loads(error.args[1])["error"]["message"]
+                except Exception:
+                    error_message = str(error)
+                if job["name"] == "send_password_reset_email" and error_message in {
+                    "MISSING_EMAIL",
+                    "INVALID_EMAIL",
+                    "EMAIL_NOT_FOUND",
+                }:
+                    st.session_state.auth_warning = """
+                    ##### Error: Invalid email.
+                    - The password reset email could not be sent.
+                    - Please check your email address.
+                    - Use the email address you used to create your account.
+                    """
+                else:
+                    st.session_state.auth_warning = f"Error: {error_message}"
+        st.session_state.auth_jobs = pending
+
     def raise_detailed_error(self, request_object: requests.models.Response) -> None:
         """
         Raises a detailed error if the HTTP request returns an error status code.
@@ -200,13 +322,14 @@ class FirebaseAuthenticator(Credentials):
             None
         """
         try:
-            id_token = self.sign_in_with_email_and_password(email, password)["idToken"]
-            # user_info = self.get_account_info(id_token)["users"][0]
-            account_info = self.get_account_info(id_token)
-            print(account_info)
+            sign_in_response = self.sign_in_with_email_and_password(email, password)
+            id_token = sign_in_response["idToken"]
+            account_info = self.account_info_from_token(id_token)
             user_info = account_info["users"][0]
             if not user_info["emailVerified"]:
-                self.send_email_verification(id_token)
+                self.run_in_background(
+                    "send_email_verification", self.send_email_verification, id_token
+                )
                 st.session_state.auth_warning = """
                 ##### Email not verified.
                 - Check your inbox to verify your email.
@@ -216,6 +339,10 @@ class FirebaseAuthenticator(Credentials):
                 user_info["idToken"] = id_token
                 user_info["fullUserInfo"] = account_info
                 st.session_state.user_info = user_info
+                self.stop_token_manager()
+                st.session_state.token_manager = TokenManager(
+                    self.firebase_config, sign_in_response
+                )
                 st.rerun()
         except requests.exceptions.HTTPError as error:
             error_message = json.loads(error.args[1])["error"]["message"]
@@ -271,7 +398,9 @@ class FirebaseAuthenticator(Credentials):
             id_token = self.create_user_with_email_and_password(email, password)[
                 "idToken"
             ]
-            self.send_email_verification(id_token)
+            self.run_in_background(
+                "send_email_verification", self.send_email_verification, id_token
+            )
             st.session_state.auth_success = f"""
             ##### Account created successfully.
             - Email sent to {email} to verify your email.
@@ -323,7 +452,9 @@ class FirebaseAuthenticator(Credentials):
             Exception: If there is any other error while sending the password reset email.
         """
         try:
-            self.send_password_reset_email(email)
+            self.run_in_background(
+                "send_password_reset_email", self.send_password_reset_email, email
+            )
             st.session_state.auth_success = f"""
             ##### Password reset email sent.
             - Email sent to {email} to reset your password.
@@ -353,6 +484,7 @@ class FirebaseAuthenticator(Credentials):
         Returns:
             None
         """
+        self.stop_token_manager()
         st.session_state.clear()
         st.session_state.auth_success = (
             "user signed out successfully."  # Not displayed in the app
@@ -373,10 +505,16 @@ class FirebaseAuthenticator(Credentials):
             Exception: If there is any other error during the account deletion.
         """
         try:
-            id_token = self.sign_in_with_email_and_password(
-                st.session_state.user_info["email"], password
-            )["idToken"]
+            token_manager = st.session_state.get("token_manager")
+            if token_manager is not None and token_manager.recently_verified(password):
+                # The password was just checked by verify_password, reuse its fresh token
+                id_token = token_manager.id_token
+            else:
+                id_token = self.sign_in_with_email_and_password(
+                    st.session_state.user_info["email"], password
+                )["idToken"]
             self.delete_user_account(id_token)
+            self.stop_token_manager()
             st.session_state.clear()
             st.session_state.auth_success = """
             ##### Account deleted successfully.
@@ -428,6 +566,9 @@ class FirebaseAuthenticator(Credentials):
         """
         Verifies the password against the user's password.
 
+        A password that was verified within the token manager's re-verification window
+        is accepted without another sign-in call.
+
         Args:
             password (str): The password to verify.
 
@@ -435,10 +576,14 @@ class FirebaseAuthenticator(Credentials):
             bool: True if the password matches the user's password, False otherwise.
         """
         try:
-            id_token = st.session_state.user_info["idToken"]
-            self.sign_in_with_email_and_password(
+            token_manager = st.session_state.get("token_manager")
+            if token_manager is not None and token_manager.recently_verified(password):
+                return True
+            sign_in_response = self.sign_in_with_email_and_password(
                 st.session_state.user_info["email"], password
             )
+            if token_manager is not None:
+                token_manager.accept_sign_in(sign_in_response, password)
             return True
         except requests.exceptions.HTTPError as error:
             error_message = json.loads(error.args[1])["error"]["message"]
@@ -465,6 +610,19 @@ class FirebaseAuthenticator(Credentials):
                 return False
         except Exception as error:
             return False
+
+    def stop_token_manager(self) -> None:
+        """
+        Stops the background token refresh of the current session, if there is one.
+
+        Returns:
+            None
+        """
+        token_manager = st.session_state.get("token_manager")
+        if token_manager is not None:
+            token_manager.stop()
+            del st.session_state["token_manager"]
+
     def get_test_user(self):
         """
         Returns the test user.
@@ -0,0 +1,160 @@
+# NOTE: This file contains the JobQueue class that is used to run fire-and-forget work off the script thread.
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import streamlit as st
+
+from credential_loader import get_settings
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is at its maximum depth.
+    """
+
+
+class JobQueue:
+    """
+    A bounded worker pool for fire-and-forget jobs such as sending emails.
+
+    Jobs run on a fixed number of worker threads. At most `max_pending` jobs may be queued
+    or running at once; further submissions raise `JobQueueFull` so callers can fall back
+    to running the work themselves. The status of the most recent jobs is kept so that
+    sessions can poll it by job ID.
+
+    Attributes:
+        max_pending (int): The maximum number of queued or running jobs.
+        max_history (int): How many job records are kept for polling.
+        executor (ThreadPoolExecutor): The worker pool.
+
+    Methods:
+        submit: Queues a job and returns its ID.
+        status: Returns the status of a job.
+        depth: Returns the number of queued or running jobs.
+    """
+
+    def __init__(
+        self, max_workers: int = 4, max_pending: int = 64, max_history: int = 4096
+    ) -> None:
+        self.max_pending = max_pending
+        self.max_history = max_history
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="background-job"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending = 0
+
+    def submit(self, name: str, fn: Callable, *args, **kwargs) -> int:
+        """
+        Queues a job and returns its ID.
+
+        Args:
+            name (str): A short label for the job, e.g. "send_email_verification".
+            fn (Callable): The function to run.
+            *args: Positional arguments for `fn`.
+            **kwargs: Keyword arguments for `fn`.
+
+        Returns:
+            int: The job ID.
+
+        Raises:
+            JobQueueFull: If `max_pending` jobs are already queued or running.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull(name)
+        job_id = next(self._ids)
+        with self._lock:
+            self._pending += 1
+            self._jobs[job_id] = {
+                "name": name,
+                "state": "pending",
+                "submitted_at": time.time(),
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+            while len(self._jobs) > self.max_history:
+                self._jobs.popitem(last=False)
+        try:
+            self.executor.submit(self._run, job_id, fn, args, kwargs)
+        except Exception:
+            self._finish(job_id, "failed", error="Job could not be scheduled")
+            raise
+        return job_id
+
+    def _run(self, job_id: int, fn: Callable, args: tuple, kwargs: dict) -> None:
+        self._update(job_id, state="running")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as error:
+            self._finish(job_id, "failed", error=error)
+        else:
+            self._finish(job_id, "done", result=result)
+
+    def _update(self, job_id: int, **fields) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _finish(self, job_id: int, state: str, result=None, error=None) -> None:
+        with self._lock:
+            self._pending -= 1
+        self._update(
+            job_id,
+            state=state,
+            result=result,
+            error=error,
+            finished_at=time.time(),
+        )
+        self._slots.release()
+
+    def status(self, job_id: int) -> Optional[dict]:
+        """
+        Returns the status of a job.
+
+        Args:
+            job_id (int): The job ID returned by `submit`.
+
+        Returns:
+            dict: A copy of the job record with its `state` ("pending", "running", "done"
+            or "failed"), `result` and `error`, or None if the record has been dropped.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def depth(self) -> int:
+        """
+        Returns the number of queued or running jobs.
+
+        Returns:
+            int: The queue depth.
+        """
+        return self._pending
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue() -> JobQueue:
+    """
+    Returns the process-wide job queue.
+
+    The pool can be sized with a `[background_jobs]` section (`max_workers`, `max_pending`)
+    in the secrets file.
+
+    Returns:
+        JobQueue: The shared job queue.
+    """
+    settings = get_settings("background_jobs")
+    return JobQueue(
+        max_workers=int(settings.get("max_workers", 4)),
+        max_pending=int(settings.get("max_pending", 64)),
+    )
@@ -0,0 +1,145 @@
+# NOTE: This file contains the ProductCatalog class that is used to load and query the product CSV.
+
+import os
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+CATALOG_PATH = "assets/your_data.csv"
+
+COLUMN_TYPES = {
+    "Product": "string",
+    "Price": "float64",
+    "Photo": "string",
+    "Category": "category",
+    "Description": "string",
+}
+
+
+class ProductCatalog:
+    """
+    An immutable, indexed view of the product catalog.
+
+    Rows are stored once, sorted by price, in a columnar DataFrame. Each category keeps the
+    positions and prices of its rows in the same order, so a category and price-range
+    filter is two binary searches plus a slice, and the result is already sorted by price.
+
+    Attributes:
+        frame (pd.DataFrame): The products, sorted by price.
+        prices (np.ndarray): The price column as a sorted NumPy array.
+        category_rows (dict): The row positions of each category, sorted by price.
+        category_prices (dict): The prices of each category's rows, sorted.
+
+    Methods:
+        categories: Returns the category names.
+        filter: Returns products by category and price range, sorted by price.
+        price_range: Returns the lowest and highest price.
+    """
+
+    def __init__(self, frame: pd.DataFrame) -> None:
+        frame = frame.sort_values("Price", kind="stable").reset_index(drop=True)
+        self.frame = frame
+        self.prices = frame["Price"].to_numpy()
+        codes = frame["Category"].cat.codes.to_numpy()
+        self.category_rows = {}
+        self.category_prices = {}
+        for code, name in enumerate(frame["Category"].cat.categories):
+            rows = np.flatnonzero(codes == code)
+            self.category_rows[name] = rows
+            self.category_prices[name] = self.prices[rows]
+
+    @classmethod
+    def from_csv(cls, path: str) -> "ProductCatalog":
+        """
+        Parses a catalog CSV into a catalog.
+
+        Args:
+            path (str): The path of the CSV file.
+
+        Returns:
+            ProductCatalog: The catalog.
+        """
+        frame = pd.read_csv(path, dtype=COLUMN_TYPES, usecols=list(COLUMN_TYPES))
+        return cls(frame)
+
+    def categories(self) -> List[str]:
+        """
+        Returns the category names.
+
+        Returns:
+            list: The categories in sorted order.
+        """
+        return list(self.category_rows)
+
+    def price_range(self) -> tuple:
+        """
+        Returns the lowest and highest price.
+
+        Returns:
+            tuple: (lowest, highest), or (0.0, 0.0) for an empty catalog.
+        """
+        if not len(self.prices):
+            return 0.0, 0.0
+        return float(self.prices[0]), float(self.prices[-1])
+
+    def filter(
+        self,
+        category: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns products by category and price range, sorted by price.
+
+        Args:
+            category (str): Only return this category, or None for all.
+            min_price (float): The lowest price to include, or None.
+            max_price (float): The highest price to include, or None.
+            descending (bool): Whether to sort from the most expensive product.
+            limit (int): The maximum number of rows, or None for all.
+
+        Returns:
+            pd.DataFrame: The matching products.
+        """
+        if category is None:
+            prices, rows = self.prices, None
+        else:
+            prices = self.category_prices.get(category, self.prices[:0])
+            rows = self.category_rows.get(category, np.empty(0, dtype=np.intp))
+        low = 0 if min_price is None else np.searchsorted(prices, min_price, "left")
+        high = (
+            len(prices)
+            if max_price is None
+            else np.searchsorted(prices, max_price, "right")
+        )
+        if descending:
+            stop = max(high - limit, low) if limit is not None else low
+            positions = np.arange(high - 1, stop - 1, -1)
+        else:
+            stop = min(low + limit, high) if limit is not None else high
+            positions = np.arange(low, stop)
+        if rows is not None:
+            positions = rows[positions]
+        return self.frame.iloc[positions]
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _load_catalog(path: str, modified: float) -> ProductCatalog:
+    return ProductCatalog.from_csv(path)
+
+
+def get_catalog(path: str = CATALOG_PATH) -> ProductCatalog:
+    """
+    Returns the process-wide catalog, parsed again only when the file changes.
+
+    Args:
+        path (str): The path of the CSV file.
+
+    Returns:
+        ProductCatalog: The shared catalog.
+    """
+    return _load_catalog(path, os.stat(path).st_mtime)
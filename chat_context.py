@@ -0,0 +1,150 @@
+# NOTE: This file contains the ConversationContext class that is used to keep chat prompts within a token budget.
+
+import re
+from functools import lru_cache
+from typing import List
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens in a text.
+
+    Words and punctuation marks are counted as one token each, with a small surcharge for
+    long words, which tracks the Mistral tokenizer closely enough for budgeting. Results are
+    cached per text, so each message is only counted once.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return sum(1 + len(piece) // 8 for piece in _TOKEN_PATTERN.findall(text))
+
+
+class ConversationContext:
+    """
+    Builds the messages sent to the model for a chat turn within a token budget.
+
+    Consecutive duplicate turns are dropped, the system message is always kept, and the
+    newest turns are kept first. Turns that do not fit are replaced by a short extractive
+    summary so the model still knows what was discussed earlier.
+
+    Attributes:
+        token_budget (int): The maximum number of prompt tokens.
+        summary_tokens (int): The maximum number of tokens spent on the summary.
+
+    Methods:
+        dedupe: Removes consecutive duplicate turns.
+        prompt_tokens: Estimates the tokens of a list of messages.
+        build: Returns the messages to send to the model.
+    """
+
+    def __init__(self, token_budget: int = 3000, summary_tokens: int = 256) -> None:
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+
+    @staticmethod
+    def dedupe(messages: List[dict]) -> List[dict]:
+        """
+        Removes consecutive duplicate turns (same role and content).
+
+        Args:
+            messages (list): The chat history.
+
+        Returns:
+            list: The history without repeated turns.
+        """
+        deduped = []
+        for message in messages:
+            if (
+                deduped
+                and deduped[-1]["role"] == message["role"]
+                and deduped[-1]["content"] == message["content"]
+            ):
+                continue
+            deduped.append(message)
+        return deduped
+
+    @staticmethod
+    def message_tokens(message: dict) -> int:
+        """
+        Estimates the tokens of a single message, including the template overhead.
+
+        Args:
+            message (dict): The message.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+    def prompt_tokens(self, messages: List[dict]) -> int:
+        """
+        Estimates the tokens of a list of messages.
+
+        Args:
+            messages (list): The messages.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return sum(self.message_tokens(message) for message in messages)
+
+    def _summarize(self, evicted: List[dict]) -> dict:
+        lines = []
+        used = count_tokens("Earlier in this conversation:") + MESSAGE_OVERHEAD
+        # Prefer the most recent of the evicted turns when the summary budget runs out
+        for message in reversed(evicted):
+            first_sentence = _SENTENCE_END.split(message["content"].strip(), 1)[0]
+            words = first_sentence.split()
+            if len(words) > 30:
+                first_sentence = " ".join(words[:30]) + "..."
+            line = "- {0}: {1}".format(message["role"], first_sentence)
+            cost = count_tokens(line)
+            if used + cost > self.summary_tokens:
+                break
+            lines.append(line)
+            used += cost
+        lines.reverse()
+        return {
+            "role": "system",
+            "content": "Earlier in this conversation:\n" + "\n".join(lines),
+        }
+
+    def build(self, messages: List[dict]) -> List[dict]:
+        """
+        Returns the messages to send to the model.
+
+        Args:
+            messages (list): The chat history, ending with the new question.
+
+        Returns:
+            list: The system message, an optional summary of evicted turns and the newest
+            turns that fit in the budget.
+        """
+        messages = self.dedupe(messages)
+        system = [message for message in messages[:1] if message["role"] == "system"]
+        turns = messages[len(system):]
+        budget = self.token_budget - self.prompt_tokens(system)
+        if self.prompt_tokens(turns) <= budget:
+            return system + turns
+
+        budget -= self.summary_tokens
+        kept = []
+        for message in reversed(turns):
+            cost = self.message_tokens(message)
+            if kept and cost > budget:
+                break
+            kept.append(message)
+            budget -= cost
+        kept.reverse()
+        evicted = turns[: len(turns) - len(kept)]
+        return system + [self._summarize(evicted)] + kept
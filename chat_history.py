@@ -0,0 +1,190 @@
+# NOTE: This file contains the ChatHistoryWriter class that is used to persist chat turns off the request path.
+
+import base64
+import queue
+import threading
+import time
+import zlib
+from typing import Callable, List
+
+import msgpack
+import streamlit as st
+
+from credential_loader import get_settings
+
+
+def encode_turn(message: dict) -> str:
+    """
+    Encodes a chat turn as a compact msgpack + zlib blob, base64 encoded for JSON storage.
+
+    Args:
+        message (dict): The chat message with "role" and "content".
+
+    Returns:
+        str: The encoded turn.
+    """
+    packed = msgpack.packb(
+        {"r": message["role"], "c": message["content"], "t": int(time.time())}
+    )
+    return base64.b64encode(zlib.compress(packed)).decode("ascii")
+
+
+def decode_turn(blob: str) -> dict:
+    """
+    Decodes a chat turn encoded by `encode_turn`.
+
+    Args:
+        blob (str): The encoded turn.
+
+    Returns:
+        dict: The chat message with "role" and "content".
+    """
+    unpacked = msgpack.unpackb(zlib.decompress(base64.b64decode(blob)))
+    return {"role": unpacked["r"], "content": unpacked["c"]}
+
+
+class ChatHistoryWriter:
+    """
+    Persists chat turns in batches on a background thread.
+
+    Turns are queued with their push keys already assigned, so their order is fixed at
+    enqueue time. The writer collects turns for up to `flush_interval` seconds and then
+    writes all turns of each user with a single multi-path update.
+
+    Attributes:
+        flush_interval (float): How long turns are collected before a write, in seconds.
+        max_batch (int): The maximum number of turns per write.
+        max_attempts (int): How often a failed write is attempted before it is dropped.
+        stats (dict): Counters of written, failed and dropped turns.
+
+    Methods:
+        enqueue: Queues turns for a user.
+        discard: Drops a user's queued turns and waits for a running write of them.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 1.0,
+        max_batch: int = 200,
+        max_attempts: int = 3,
+        max_queued: int = 10000,
+    ) -> None:
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.stats = {"written": 0, "failed_writes": 0, "dropped": 0}
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._sequence = 0
+        self._discarded = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        threading.Thread(
+            target=self._run, name="chat-history-writer", daemon=True
+        ).start()
+
+    def enqueue(
+        self,
+        uid: str,
+        database: Callable,
+        token: Callable[[], str],
+        turns: List[tuple],
+    ) -> None:
+        """
+        Queues turns for a user.
+
+        Args:
+            uid (str): The user's ID.
+            database (Callable): Returns a database handle for the write.
+            token (Callable): Returns the user's current ID token.
+            turns (list): (push key, encoded turn) pairs.
+        """
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        try:
+            self._queue.put_nowait((sequence, uid, database, token, turns))
+        except queue.Full:
+            self.stats["dropped"] += len(turns)
+
+    def discard(self, uid: str) -> None:
+        """
+        Drops the turns queued so far for a user, e.g. before their history is deleted.
+
+        Returns once a write of the user's turns that is already running has finished, so
+        nothing queued before this call is written after it.
+
+        Args:
+            uid (str): The user's ID.
+        """
+        with self._lock:
+            self._discarded[uid] = self._sequence
+        with self._write_lock:
+            pass
+
+    def _is_discarded(self, uid: str, sequence: int) -> bool:
+        with self._lock:
+            return sequence <= self._discarded.get(uid, 0)
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            batches = {}
+            for sequence, uid, database, token, turns in items:
+                batch = batches.setdefault(uid, [database, token, []])
+                batch[1] = token
+                batch[2].append((sequence, turns))
+            for uid, (database, token, queued) in batches.items():
+                self._write(uid, database, token, queued)
+
+    def _write(self, uid: str, database: Callable, token: Callable, queued: list):
+        # `queued` holds (sequence, turns) pairs; turns discarded meanwhile are skipped
+        for attempt in range(self.max_attempts):
+            with self._write_lock:
+                kept = []
+                for sequence, items in queued:
+                    if self._is_discarded(uid, sequence):
+                        self.stats["dropped"] += len(items)
+                    else:
+                        kept.append((sequence, items))
+                queued = kept
+                if not queued:
+                    return
+                turns = {key: turn for _, items in queued for key, turn in items}
+                try:
+                    database().child("users").child(uid).child("chat_history").update(
+                        turns, token=token()
+                    )
+                    self.stats["written"] += len(turns)
+                    return
+                except Exception:
+                    self.stats["failed_writes"] += 1
+            time.sleep(min(2**attempt, 10))
+        self.stats["dropped"] += sum(len(items) for _, items in queued)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chat_history_writer() -> ChatHistoryWriter:
+    """
+    Returns the process-wide chat history writer.
+
+    It is configured by an optional `[chat_history]` section in the secrets file with
+    `flush_interval`, `max_batch` and `max_attempts`.
+
+    Returns:
+        ChatHistoryWriter: The shared writer.
+    """
+    settings = get_settings("chat_history")
+    return ChatHistoryWriter(
+        flush_interval=float(settings.get("flush_interval", 1.0)),
+        max_batch=int(settings.get("max_batch", 200)),
+        max_attempts=int(settings.get("max_attempts", 3)),
+    )
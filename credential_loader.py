@@ -1,34 +1,172 @@
 # NOTE: This file contains the Credentials class that is used to manage credentials for Firebase and OpenAI.
 
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional
+
 import streamlit as st
 
 from firebase_admin import credentials
 
 
+@dataclass(frozen=True)
+class CredentialSet:
+    """
+    Immutable snapshot of the credentials stored in the secrets file.
+
+    The snapshot is resolved once per server process by `get_credentials` and shared
+    by every session, so the service account key is only parsed once.
+
+    Attributes:
+        firebase_cert (credentials.Certificate): Firebase service account certificate, or None if missing.
+        firebase_config (Mapping): Read-only Firebase configuration, or None if missing.
+        openai_credentials (str): OpenAI API key, or None if missing.
+        pexels_credentials (str): Pexels API key, or None if missing.
+        db_url (str): URL of the Firebase database, or None if missing.
+    """
+
+    firebase_cert: Optional[credentials.Certificate] = None
+    firebase_config: Optional[Mapping[str, str]] = None
+    openai_credentials: Optional[str] = None
+    pexels_credentials: Optional[str] = None
+    db_url: Optional[str] = None
+
+
+def _read_firebase_cert() -> credentials.Certificate:
+    """
+    Builds the Firebase service account certificate from the secrets file.
+
+    Returns:
+        credentials (credentials.Certificate): Firebase service account certificate.
+    """
+    credentials_dict = {
+        "type": st.secrets["firebase_auth"]["type"],
+        "project_id": st.secrets["firebase_auth"]["project_id"],
+        "private_key_id": st.secrets["firebase_auth"]["private_key_id"],
+        "private_key": st.secrets["firebase_auth"]["private_key"],
+        "client_email": st.secrets["firebase_auth"]["client_email"],
+        "client_id": st.secrets["firebase_auth"]["client_id"],
+        "auth_uri": st.secrets["firebase_auth"]["auth_uri"],
+        "token_uri": st.secrets["firebase_auth"]["token_uri"],
+        "auth_provider_x509_cert_url": st.secrets["firebase_auth"][
+            "auth_provider_x509_cert_url"
+        ],
+        "client_x509_cert_url": st.secrets["firebase_auth"]["client_x509_cert_url"],
+    }
+    return credentials.Certificate(credentials_dict)
+
+
+def _read_firebase_config() -> dict:
+    """
+    Reads the Firebase configuration from the secrets file.
+
+    Returns:
+        firebase_config (dict): Firebase configuration.
+    """
+    return {
+        "apiKey": st.secrets["firebase_config"]["apiKey"],
+        "authDomain": st.secrets["firebase_config"]["authDomain"],
+        "projectId": st.secrets["firebase_config"]["projectId"],
+        "storageBucket": st.secrets["firebase_config"]["storageBucket"],
+        "messagingSenderId": st.secrets["firebase_config"]["messagingSenderId"],
+        "appId": st.secrets["firebase_config"]["appId"],
+        "measurementId": st.secrets["firebase_config"]["measurementId"],
+        "databaseURL": st.secrets["firebase_config"]["databaseURL"],
+    }
+
+
+def _read_optional(reader):
+    """
+    Calls `reader` and returns None instead of raising if a secret is missing.
+    """
+    try:
+        return reader()
+    except KeyError:
+        return None
+
+
+@st.cache_resource(show_spinner=False)
+def get_credentials() -> CredentialSet:
+    """
+    Resolves the credentials once per server process.
+
+    The result is shared by all sessions. Call `reload_credentials` after the secrets file changes.
+
+    Returns:
+        CredentialSet: The shared, immutable credentials.
+    """
+    firebase_config = _read_optional(_read_firebase_config)
+    return CredentialSet(
+        firebase_cert=_read_optional(_read_firebase_cert),
+        firebase_config=(
+            MappingProxyType(firebase_config) if firebase_config is not None else None
+        ),
+        openai_credentials=_read_optional(
+            lambda: st.secrets["openai"]["openai_api_key"]
+        ),
+        pexels_credentials=_read_optional(
+            lambda: st.secrets["pexels"]["pexels_api_key"]
+        ),
+        db_url=_read_optional(lambda: st.secrets["firebase_config"]["databaseURL"]),
+    )
+
+
+def reload_credentials() -> CredentialSet:
+    """
+    Drops the cached credentials and resolves them again from the secrets file.
+
+    Returns:
+        CredentialSet: The freshly resolved credentials.
+    """
+    get_credentials.clear()
+    return get_credentials()
+
+
+def get_settings(section: str) -> dict:
+    """
+    Reads an optional, non-secret settings section from the secrets file.
+
+    Args:
+        section (str): The name of the section, e.g. "identity_toolkit".
+
+    Returns:
+        dict: The settings in the section, or an empty dict if it is missing.
+    """
+    try:
+        return dict(st.secrets.get(section, {}))
+    except FileNotFoundError:
+        return {}
+
+
 class Credentials:
     """
     Class to manage credentials for Firebase and OpenAI.
 
+    The values are read from the process-wide `CredentialSet` returned by `get_credentials`,
+    so creating instances on every rerun does not re-read the secrets file.
+
     Attributes:
-        firebase_credentials (service_account.Credentials): Firestore credentials.
+        firebase_cert (credentials.Certificate): Firebase service account certificate.
         firebase_config (dict): Firebase configuration.
         openai_credentials (str): OpenAI API key.
+        pexels_credentials (str): Pexels API key.
         db_url (str): URL of the Firebase database.
 
     Methods:
-        get_firestore_credentials: Retrieves the Firestore credentials from the secrets file.
-        get_openai_credentials: Retrieves the OpenAI API key from the secrets file.
-        get_firebase_config: Retrieves the Firebase configuration from the secrets file.
+        get_pexels_credentials: Retrieves the Pexels API key.
+        make_firebase_cert: Retrieves the Firebase service account certificate.
+        get_openai_credentials: Retrieves the OpenAI API key.
+        get_firebase_config: Retrieves the Firebase configuration.
     """
 
     def __init__(self) -> None:
-        try:
-            self.firebase_cert = self.make_firebase_cert()
-        except KeyError:
-            pass
-        try:
-            self.firebase_config = self.get_firebase_config()
-        except KeyError:
+        shared = get_credentials()
+        self.firebase_cert = shared.firebase_cert
+        self.openai_credentials = shared.openai_credentials
+        self.pexels_credentials = shared.pexels_credentials
+        if shared.firebase_config is not None:
+            self.firebase_config = dict(shared.firebase_config)
+        else:
             st.error(
                 """
                 # There was an error retrieving the Firebase configuration.
@@ -36,17 +174,9 @@ class Credentials:
                 - If the problem persists, please contact the developer.
                 """
             )
-        try:
-            self.openai_credentials = self.get_openai_credentials()
-        except KeyError:
-            pass
-        try:
-            self.pexels_credentials = self.get_pexels_credentials()
-        except KeyError:
-            pass
-        try:
-            self.db_url = st.secrets["firebase_config"]["databaseURL"]
-        except KeyError:
+        if shared.db_url is not None:
+            self.db_url = shared.db_url
+        else:
             st.error(
                 """
                 # There was an error retrieving the Firebase database URL.
@@ -57,59 +187,55 @@ class Credentials:
 
     def get_pexels_credentials(self) -> str:
         """
-        Retrieves the Pexels API key from the secrets file.
+        Retrieves the Pexels API key.
 
         Returns:
             pexels_api_key (str): Pexels API key.
+
+        Raises:
+            KeyError: If the key is missing from the secrets file.
         """
-        return st.secrets["pexels"]["pexels_api_key"]
+        return self._require("pexels_credentials", "pexels")
 
     def make_firebase_cert(self) -> credentials.Certificate:
         """
-        Retrieves the Firestore credentials from the secrets file.
+        Retrieves the Firebase service account certificate.
 
         Returns:
-            credentials (service_account.Credentials): Firestore credentials.
+            credentials (credentials.Certificate): Firebase service account certificate.
+
+        Raises:
+            KeyError: If the certificate is missing from the secrets file.
         """
-        credentials_dict = {
-            "type": st.secrets["firebase_auth"]["type"],
-            "project_id": st.secrets["firebase_auth"]["project_id"],
-            "private_key_id": st.secrets["firebase_auth"]["private_key_id"],
-            "private_key": st.secrets["firebase_auth"]["private_key"],
-            "client_email": st.secrets["firebase_auth"]["client_email"],
-            "client_id": st.secrets["firebase_auth"]["client_id"],
-            "auth_uri": st.secrets["firebase_auth"]["auth_uri"],
-            "token_uri": st.secrets["firebase_auth"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["firebase_auth"][
-                "auth_provider_x509_cert_url"
-            ],
-            "client_x509_cert_url": st.secrets["firebase_auth"]["client_x509_cert_url"],
-        }
-        return credentials.Certificate(credentials_dict)
+        return self._require("firebase_cert", "firebase_auth")
 
     def get_openai_credentials(self) -> str:
         """
-        Retrieves the OpenAI API key from the secrets file.
+        Retrieves the OpenAI API key.
 
         Returns:
             openai_api_key (str): OpenAI API key.
+
+        Raises:
+            KeyError: If the key is missing from the secrets file.
         """
-        return st.secrets["openai"]["openai_api_key"]
+        return self._require("openai_credentials", "openai")
 
     def get_firebase_config(self) -> dict:
         """
-        Retrieves the Firebase configuration from the secrets file.
+        Retrieves the Firebase configuration.
 
         Returns:
-            firebase_config (dict): Firebase configuration.
+            firebase_config (dict): A copy of the Firebase configuration.
+
+        Raises:
+            KeyError: If the configuration is missing from the secrets file.
         """
-        return {
-            "apiKey": st.secrets["firebase_config"]["apiKey"],
-            "authDomain": st.secrets["firebase_config"]["authDomain"],
-            "projectId": st.secrets["firebase_config"]["projectId"],
-            "storageBucket": st.secrets["firebase_config"]["storageBucket"],
-            "messagingSenderId": st.secrets["firebase_config"]["messagingSenderId"],
-            "appId": st.secrets["firebase_config"]["appId"],
-            "measurementId": st.secrets["firebase_config"]["measurementId"],
-            "databaseURL": st.secrets["firebase_config"]["databaseURL"],
-        }
+        return dict(self._require("firebase_config", "firebase_config"))
+
+    @staticmethod
+    def _require(attribute: str, section: str):
+        value = getattr(get_credentials(), attribute)
+        if value is None:
+            raise KeyError(section)
+        return value
@@ -0,0 +1,216 @@
+# NOTE: This file contains the PooledTransport class that is used to make keep-alive HTTP calls to Google APIs.
+
+import json
+import random
+import time
+from typing import Optional
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from credential_loader import get_settings
+
+IDENTITY_TOOLKIT_URL = "https://www.googleapis.com/identitytoolkit/v3/relyingparty"
+SECURE_TOKEN_URL = "https://securetoken.googleapis.com/v1"
+
+
+class PooledTransport:
+    """
+    A thread-safe HTTP transport with a shared connection pool.
+
+    All calls go through one `requests.Session`, so connections are kept alive and reused
+    instead of paying a TCP and TLS handshake per request. Connection errors, timeouts and
+    5xx responses are retried a bounded number of times with full-jitter exponential backoff.
+    Requests that are not idempotent are only retried if the connection could not be opened,
+    since a dropped connection, a timeout or a 5xx response does not tell whether the server
+    acted on the request.
+
+    Attributes:
+        base_url (str): The URL that relative paths are resolved against.
+        timeout (tuple): The (connect, read) timeouts in seconds.
+        max_retries (int): How many times a failed request is retried.
+        backoff (float): The base backoff delay in seconds.
+        backoff_cap (float): The maximum backoff delay in seconds.
+        session (requests.Session): The pooled session.
+
+    Methods:
+        request: Sends a request, retrying transient failures.
+        post_json: Sends a JSON POST request.
+        close: Closes the pooled connections.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        pool_size: int = 20,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        max_retries: int = 2,
+        backoff: float = 0.25,
+        backoff_cap: float = 2.0,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _url(self, path: str) -> str:
+        if not path:
+            return self.base_url
+        if path.startswith(("http://", "https://")):
+            return path
+        return "{0}/{1}".format(self.base_url, path.lstrip("/"))
+
+    @staticmethod
+    def _before_send(error: requests.exceptions.ConnectionError) -> bool:
+        # Whether the connection failed before the request could reach the server
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(
+            reason, NewConnectionError
+        )
+
+    def _sleep_before_retry(self, attempt: int) -> None:
+        time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff * 2**attempt)))
+
+    def request(
+        self, method: str, path: str, idempotent: bool = True, **kwargs
+    ) -> requests.models.Response:
+        """
+        Sends a request, retrying connection errors, timeouts and 5xx responses.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): A path relative to `base_url`, or an absolute URL.
+            idempotent (bool): Whether the request may be repeated safely. If False, only
+                failures to connect are retried.
+            **kwargs: Extra arguments passed to `requests.Session.request`.
+
+        Returns:
+            requests.models.Response: The last response received.
+
+        Raises:
+            requests.exceptions.RequestException: If the request still fails after all retries.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        url = self._url(path)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as error:
+                if attempt == self.max_retries or not (
+                    idempotent or self._before_send(error)
+                ):
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+            except requests.exceptions.Timeout:
+                # ConnectTimeout is a ConnectionError, so this is a read timeout
+                if attempt == self.max_retries or not idempotent:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+            if (
+                response.status_code >= 500
+                and idempotent
+                and attempt < self.max_retries
+            ):
+                response.close()
+                self._sleep_before_retry(attempt)
+                continue
+            return response
+
+    def post_json(
+        self,
+        path: str,
+        payload: dict,
+        params: Optional[dict] = None,
+        idempotent: bool = True,
+    ) -> requests.models.Response:
+        """
+        Sends a JSON POST request.
+
+        Args:
+            path (str): A path relative to `base_url`, or an absolute URL.
+            payload (dict): The JSON body.
+            params (dict): Optional query parameters.
+            idempotent (bool): Whether the request may be repeated safely.
+
+        Returns:
+            requests.models.Response: The response.
+        """
+        return self.request(
+            "POST",
+            path,
+            idempotent=idempotent,
+            params=params,
+            headers={"content-type": "application/json; charset=UTF-8"},
+            data=json.dumps(payload),
+        )
+
+    def close(self) -> None:
+        """
+        Closes the pooled connections.
+        """
+        self.session.close()
+
+
+def transport_from_settings(section: str, default_base_url: str) -> PooledTransport:
+    """
+    Builds a transport from an optional settings section in the secrets file.
+
+    Supported keys are `base_url`, `pool_size`, `connect_timeout`, `read_timeout`,
+    `max_retries`, `backoff` and `backoff_cap`.
+
+    Args:
+        section (str): The name of the settings section.
+        default_base_url (str): The base URL used if the section does not set one.
+
+    Returns:
+        PooledTransport: The configured transport.
+    """
+    settings = get_settings(section)
+    return PooledTransport(
+        base_url=settings.get("base_url", default_base_url),
+        pool_size=int(settings.get("pool_size", 20)),
+        connect_timeout=float(settings.get("connect_timeout", 3.05)),
+        read_timeout=float(settings.get("read_timeout", 10.0)),
+        max_retries=int(settings.get("max_retries", 2)),
+        backoff=float(settings.get("backoff", 0.25)),
+        backoff_cap=float(settings.get("backoff_cap", 2.0)),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_identity_transport() -> PooledTransport:
+    """
+    Returns the process-wide transport for the Identity Toolkit API.
+
+    The base URL can be pointed at a local stand-in server with
+    `[identity_toolkit] base_url = "http://localhost:9099/..."` in the secrets file.
+
+    Returns:
+        PooledTransport: The shared transport.
+    """
+    return transport_from_settings("identity_toolkit", IDENTITY_TOOLKIT_URL)
+
+
+@st.cache_resource(show_spinner=False)
+def get_secure_token_transport() -> PooledTransport:
+    """
+    Returns the process-wide transport for the Secure Token API used to refresh ID tokens.
+
+    The base URL can be overridden with a `[secure_token]` section in the secrets file.
+
+    Returns:
+        PooledTransport: The shared transport.
+    """
+    return transport_from_settings("secure_token", SECURE_TOKEN_URL)
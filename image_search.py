@@ -0,0 +1,350 @@
+# NOTE: This file contains the ImageSearch class that is used to find product photos on Pexels without blocking the page.
+
+import base64
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import streamlit as st
+
+from credential_loader import get_settings
+from http_transport import PooledTransport
+
+PEXELS_URL = "https://api.pexels.com/v1"
+CACHE_PATH = ".cache/pexels/images.sqlite"
+
+
+class ImageSearch:
+    """
+    Looks up product photos on Pexels in the background and caches them on disk.
+
+    The cache has two tables in one sqlite file: search query to photo URL, and photo URL to
+    image bytes. Queries without results are cached too, so they are not searched again until
+    their TTL expires. Image bytes are evicted least recently used first once they exceed
+    `max_bytes`. Cache hits only note the use in memory; the use times are written on
+    the thread pool every `touch_interval` seconds and before each eviction.
+
+    Lookups read through their own sqlite connection, and the file is in WAL mode, so a
+    background fetch that is storing an image or evicting never blocks them.
+
+    Lookups never block: `image` only reads the cache and schedules a fetch on a bounded
+    thread pool on a miss. Fetches of the same query are deduplicated, and new fetches are
+    dropped while `max_pending` are queued or after Pexels answers 429, until its rate
+    limit resets.
+
+    Attributes:
+        transport (PooledTransport): The transport to the Pexels API.
+        size (str): The Pexels photo size to download, e.g. "tiny" or "medium".
+        query_ttl (float): How long a query result stays valid, in seconds.
+        image_ttl (float): How long downloaded image bytes stay valid, in seconds.
+        max_bytes (int): The maximum total size of the cached images.
+        max_pending (int): The maximum number of queued fetches.
+        touch_interval (float): How often use times of cache hits are written, in seconds.
+        stats (dict): Hit, miss, fetch, failure and eviction counters.
+
+    Methods:
+        image: Returns the cached photo of a query, fetching it in the background on a miss.
+        data_uri: Returns the cached photo of a query as a data URI.
+        prefetch: Fetches the photos of several queries in the background.
+        fetch: Searches and downloads the photo of a query, blocking.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        transport: PooledTransport,
+        cache_path: Optional[str] = CACHE_PATH,
+        size: str = "tiny",
+        query_ttl: float = 7 * 24 * 3600,
+        image_ttl: float = 30 * 24 * 3600,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_workers: int = 4,
+        max_pending: int = 64,
+        touch_interval: float = 60.0,
+    ) -> None:
+        self.transport = transport
+        self.size = size
+        self.query_ttl = query_ttl
+        self.image_ttl = image_ttl
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.touch_interval = touch_interval
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "fetches": 0,
+            "failures": 0,
+            "dropped": 0,
+            "evictions": 0,
+        }
+        self._headers = {"Authorization": api_key}
+        self._pending = set()
+        self._blocked_until = 0.0
+        self._used = {}
+        self._used_written_at = time.time()
+        # `_lock` guards the in-memory state, `_write_lock` the writer connection and
+        # `_read_lock` the reader connection
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="image-search"
+        )
+        if cache_path:
+            if os.path.dirname(cache_path):
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            database, uri = cache_path, False
+        else:
+            # A private in-memory database that both connections share
+            database = "file:image-search-{0}?mode=memory&cache=shared".format(id(self))
+            uri = True
+        self._db = sqlite3.connect(database, uri=uri, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS queries "
+            "(query TEXT PRIMARY KEY, url TEXT, expires_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, "
+            "content_type TEXT NOT NULL, data BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS images_used ON images (used_at)")
+        self._db.commit()
+        self._reader = sqlite3.connect(database, uri=uri, check_same_thread=False)
+        # Only matters for the shared in-memory database, which has no WAL
+        self._reader.execute("PRAGMA read_uncommitted=1")
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += amount
+
+    @staticmethod
+    def _normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def _cached(self, query: str) -> tuple:
+        # Returns (known, image), where known is False if the query must be fetched
+        now = time.time()
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT url FROM queries WHERE query = ? AND expires_at > ?",
+                (query, now),
+            ).fetchone()
+            if row is None:
+                return False, None
+            if row[0] is None:
+                return True, None
+            image = self._reader.execute(
+                "SELECT content_type, data FROM images WHERE url = ? AND expires_at > ?",
+                (row[0], now),
+            ).fetchone()
+        if image is None:
+            return False, None
+        with self._lock:
+            self._used[row[0]] = now
+            write = now - self._used_written_at >= self.touch_interval
+            if write:
+                self._used_written_at = now
+        if write:
+            self._executor.submit(self._flush_used)
+        return True, image
+
+    def _write_used(self) -> None:
+        # Must be called with the write lock held
+        with self._lock:
+            used, self._used = self._used, {}
+        if used:
+            self._db.executemany(
+                "UPDATE images SET used_at = ? WHERE url = ?",
+                [(used_at, url) for url, used_at in used.items()],
+            )
+
+    def _flush_used(self) -> None:
+        with self._write_lock:
+            self._write_used()
+            self._db.commit()
+
+    def image(self, query: str) -> Optional[tuple]:
+        """
+        Returns the cached photo of a query, fetching it in the background on a miss.
+
+        Args:
+            query (str): The search query, e.g. a product name.
+
+        Returns:
+            tuple: (content type, image bytes), or None if the photo is not cached (yet) or
+            the query has no results.
+        """
+        query = self._normalize(query)
+        known, image = self._cached(query)
+        if known:
+            self._count("hits")
+            return image
+        self._count("misses")
+        self._schedule(query)
+        return None
+
+    def data_uri(self, query: str) -> Optional[str]:
+        """
+        Returns the cached photo of a query as a data URI, fetching it in the background on
+        a miss.
+
+        Args:
+            query (str): The search query, e.g. a product name.
+
+        Returns:
+            str: The data URI, or None if the photo is not available yet.
+        """
+        image = self.image(query)
+        if image is None:
+            return None
+        return "data:{0};base64,{1}".format(
+            image[0], base64.b64encode(image[1]).decode("ascii")
+        )
+
+    def prefetch(self, queries: Iterable[str]) -> None:
+        """
+        Fetches the photos of several queries in the background, skipping cached ones.
+
+        Args:
+            queries (Iterable): The search queries.
+        """
+        for query in queries:
+            query = self._normalize(query)
+            if not self._cached(query)[0]:
+                self._schedule(query)
+
+    def _schedule(self, query: str) -> None:
+        with self._lock:
+            if query in self._pending:
+                return
+            if (
+                len(self._pending) >= self.max_pending
+                or time.time() < self._blocked_until
+            ):
+                self.stats["dropped"] += 1
+                return
+            self._pending.add(query)
+        self._executor.submit(self._fetch_pending, query)
+
+    def _fetch_pending(self, query: str) -> None:
+        try:
+            self.fetch(query)
+        except Exception:
+            self._count("failures")
+        finally:
+            with self._lock:
+                self._pending.discard(query)
+
+    def fetch(self, query: str) -> Optional[tuple]:
+        """
+        Searches and downloads the photo of a query and stores both in the cache, blocking.
+
+        Args:
+            query (str): The search query.
+
+        Returns:
+            tuple: (content type, image bytes), or None if the query has no results.
+
+        Raises:
+            requests.exceptions.RequestException: If Pexels or the image host fails.
+        """
+        query = self._normalize(query)
+        self._count("fetches")
+        response = self.transport.request(
+            "GET",
+            "search",
+            params={"query": query, "per_page": 1},
+            headers=self._headers,
+        )
+        if response.status_code == 429:
+            reset = response.headers.get("X-Ratelimit-Reset")
+            with self._lock:
+                self._blocked_until = float(reset) if reset else time.time() + 60
+        response.raise_for_status()
+        photos = response.json().get("photos") or []
+        url = photos[0]["src"].get(self.size) if photos else None
+        image = None
+        if url:
+            download = self.transport.request("GET", url)
+            download.raise_for_status()
+            image = (
+                download.headers.get("content-type", "image/jpeg"),
+                download.content,
+            )
+        self._store(query, url, image)
+        return image
+
+    def _store(self, query: str, url: Optional[str], image: Optional[tuple]) -> None:
+        now = time.time()
+        with self._write_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?)",
+                (query, url, now + self.query_ttl),
+            )
+            if image is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, image[0], image[1], len(image[1]), now + self.image_ttl, now),
+                )
+                self._write_used()
+                self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float) -> None:
+        self._db.execute("DELETE FROM images WHERE expires_at <= ?", (now,))
+        self._db.execute("DELETE FROM queries WHERE expires_at <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()
+        excess = total[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for url, size in self._db.execute(
+            "SELECT url, size FROM images ORDER BY used_at"
+        ).fetchall():
+            if excess <= 0:
+                break
+            evicted.append((url,))
+            excess -= size
+        self._db.executemany("DELETE FROM images WHERE url = ?", evicted)
+        self._count("evictions", len(evicted))
+
+
+@st.cache_resource(show_spinner=False)
+def get_image_search(api_key: str) -> ImageSearch:
+    """
+    Returns the process-wide Pexels image search for an API key.
+
+    It is configured by an optional `[pexels]` section in the secrets file with `base_url`
+    (e.g. a local stand-in server from `stand_in_servers.py`), `cache_path`, `size`,
+    `query_ttl`, `image_ttl`, `max_bytes`, `max_workers`, `max_pending` and
+    `touch_interval`.
+
+    Args:
+        api_key (str): The Pexels API key.
+
+    Returns:
+        ImageSearch: The shared image search.
+    """
+    settings = get_settings("pexels")
+    max_workers = int(settings.get("max_workers", 4))
+    return ImageSearch(
+        api_key,
+        PooledTransport(
+            settings.get("base_url", PEXELS_URL),
+            pool_size=max_workers,
+            read_timeout=float(settings.get("read_timeout", 10.0)),
+        ),
+        cache_path=settings.get("cache_path", CACHE_PATH),
+        size=settings.get("size", "tiny"),
+        query_ttl=float(settings.get("query_ttl", 7 * 24 * 3600)),
+        image_ttl=float(settings.get("image_ttl", 30 * 24 * 3600)),
+        max_bytes=int(settings.get("max_bytes", 64 * 1024 * 1024)),
+        max_workers=max_workers,
+        max_pending=int(settings.get("max_pending", 64)),
+        touch_interval=float(settings.get("touch_interval", 60.0)),
+    )
@@ -0,0 +1,494 @@
+# NOTE: This file contains the LiveView class that is used to follow a user's valve status and sensor data over the Realtime Database stream.
+
+import json
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+import requests
+import streamlit as st
+
+from credential_loader import get_credentials, get_settings
+from push_keys import push_key_bound
+
+
+def _replace(node, parts: list, value):
+    # Returns a copy of `node` with `value` at `parts`, copying only the changed path
+    if not parts:
+        return value
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _replace(node.get(parts[0]), parts[1:], value)
+    if child is None or child == {}:
+        node.pop(parts[0], None)
+    else:
+        node[parts[0]] = child
+    return node or None
+
+
+def _lookup(node, parts: list):
+    for part in parts:
+        if not isinstance(node, dict):
+            return None
+        node = node.get(part)
+    return node
+
+
+class MaterializedView:
+    """
+    An in-memory copy of a database location, updated from stream events.
+
+    Updates copy only the nodes on the changed path, so a value returned by `get` is a
+    snapshot that later events do not modify. `version` is increased only by events that
+    actually change the data.
+
+    Attributes:
+        version (int): The number of changes applied so far.
+
+    Methods:
+        apply: Applies a put or patch event.
+        get: Returns the data at a path.
+    """
+
+    def __init__(self, max_children: Optional[int] = None) -> None:
+        self.version = 0
+        self._data = None
+        self._max_children = max_children
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parts(path: str) -> list:
+        return [part for part in path.split("/") if part]
+
+    def apply(self, event: str, path: str, data) -> bool:
+        """
+        Applies a put or patch event.
+
+        Args:
+            event (str): "put" or "patch".
+            path (str): The changed path, relative to the view's location.
+            data: The new value (put) or the children to update (patch).
+
+        Returns:
+            bool: Whether the data changed.
+        """
+        parts = self._parts(path)
+        with self._lock:
+            updated = self._data
+            if event == "patch":
+                for key, value in (data or {}).items():
+                    updated = _replace(updated, parts + self._parts(key), value)
+            else:
+                updated = _replace(updated, parts, data)
+            if (
+                self._max_children
+                and isinstance(updated, dict)
+                and len(updated) > self._max_children
+            ):
+                # Keeps the newest children, which sort last for push keys
+                updated = dict(sorted(updated.items())[-self._max_children :])
+            if updated == self._data:
+                return False
+            self._data = updated
+            self.version += 1
+            return True
+
+    def get(self, path: str = "/"):
+        """
+        Returns the data at a path.
+
+        Args:
+            path (str): A path relative to the view's location.
+
+        Returns:
+            The data, or None if there is none. It must not be modified.
+        """
+        return _lookup(self._data, self._parts(path))
+
+
+class StreamSubscription:
+    """
+    Follows one database location over a Server-Sent Events stream on a daemon thread.
+
+    The stream is reopened with jittered exponential backoff after errors, and with a
+    fresh ID token after the server revokes the old one. The query parameters are asked
+    for at every connect, so a filtered stream can resume where it left off; with
+    `merge_snapshot`, the snapshot sent at the start of a connection is merged into the
+    view instead of replacing it.
+
+    Attributes:
+        url (str): The `.json` URL of the location.
+        params (Callable): Returns extra query parameters, e.g. `orderBy` and `startAt`.
+        view (MaterializedView): The view the events are applied to.
+        merge_snapshot (bool): Whether the initial snapshot of a connection is merged.
+        stopped_at (float): When the stream was stopped, as a monotonic time, or None.
+        stats (dict): Counters of connections, events, changes and errors.
+
+    Methods:
+        start: Starts the stream thread.
+        stop: Stops the stream.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        params: Callable[[], dict],
+        token: Callable[[], str],
+        view: MaterializedView,
+        read_timeout: float = 60.0,
+        backoff_cap: float = 30.0,
+        merge_snapshot: bool = False,
+    ) -> None:
+        self.url = url
+        self.params = params
+        self.token = token
+        self.view = view
+        self.read_timeout = read_timeout
+        self.backoff_cap = backoff_cap
+        self.merge_snapshot = merge_snapshot
+        self.stats = {"connections": 0, "events": 0, "changes": 0, "errors": 0}
+        self.stopped_at = None
+        self._stopped = threading.Event()
+        self._response = None
+        self._snapshot_pending = False
+        self._thread = threading.Thread(
+            target=self._run, name="live-view-stream", daemon=True
+        )
+
+    def start(self) -> None:
+        """
+        Starts the stream thread.
+        """
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the stream and closes its connection.
+        """
+        if self.stopped_at is None:
+            self.stopped_at = time.monotonic()
+        self._stopped.set()
+        response = self._response
+        if response is not None:
+            response.close()
+
+    def _run(self) -> None:
+        session = requests.Session()
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                if self._listen(session):
+                    failures = 0
+            except Exception:
+                self.stats["errors"] += 1
+                failures += 1
+            if self._stopped.is_set():
+                break
+            self._stopped.wait(
+                random.uniform(0, min(self.backoff_cap, 0.5 * 2**failures))
+            )
+        session.close()
+
+    def _listen(self, session: requests.Session) -> bool:
+        # Returns True if the stream ended normally and should be reopened right away
+        response = session.get(
+            self.url,
+            params=dict(self.params(), auth=self.token()),
+            headers={"Accept": "text/event-stream"},
+            stream=True,
+            timeout=(3.05, self.read_timeout),
+        )
+        self._response = response
+        try:
+            if self._stopped.is_set():
+                # `stop` ran while the connection was being opened
+                return True
+            response.raise_for_status()
+            self.stats["connections"] += 1
+            self._snapshot_pending = True
+            event, data = None, []
+            # Events are small and must be handled as soon as they arrive, while larger
+            # reads would wait until enough bytes (e.g. several keep-alives) came in
+            for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                if self._stopped.is_set():
+                    return True
+                if line:
+                    field, _, value = line.partition(":")
+                    if field == "event":
+                        event = value.strip()
+                    elif field == "data":
+                        data.append(value[1:] if value.startswith(" ") else value)
+                    continue
+                if event is not None and not self._dispatch(event, "\n".join(data)):
+                    return True
+                event, data = None, []
+            return True
+        finally:
+            self._response = None
+            response.close()
+
+    def _dispatch(self, event: str, data: str) -> bool:
+        # Returns False if the stream must be reopened
+        self.stats["events"] += 1
+        if event in ("put", "patch"):
+            payload = json.loads(data)
+            path, value = payload["path"], payload["data"]
+            if self._snapshot_pending and event == "put" and path == "/":
+                if self.merge_snapshot:
+                    # The snapshot only holds the children after the resume point
+                    event, value = "patch", value or {}
+            self._snapshot_pending = False
+            if self.view.apply(event, path, value):
+                self.stats["changes"] += 1
+            return True
+        if event == "cancel":
+            # The rules no longer allow reading the location
+            self.stop()
+            return False
+        if event == "auth_revoked":
+            return False
+        return True
+
+
+class LiveView:
+    """
+    The live valve status and new sensor readings of one user.
+
+    The user's `valve_status` and `sensor_data` locations are followed by one stream each,
+    both owned by this object. The sensor stream starts at the time of the subscription, so
+    the history is not downloaded again; it is read through the sensor cache instead. After
+    a reconnect it resumes at the newest reading already received.
+
+    Attributes:
+        uid (str): The user's ID.
+        valve (MaterializedView): The user's valve_status.
+        sensors (MaterializedView): The sensor readings received since the subscription.
+        last_used (float): When a session last used the view, as a monotonic time.
+
+    Methods:
+        version: Returns a number that changes whenever the view changes.
+        valve_status: Returns the current valve status.
+        sensor_readings: Returns the sensor readings received so far.
+        touch: Marks the view as used and updates the token source.
+        stopped_at: Returns when a stream of the view stopped, if one did.
+        stop: Stops both streams.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        uid: str,
+        token: Callable[[], str],
+        max_readings: int = 1000,
+        read_timeout: float = 60.0,
+    ) -> None:
+        self.uid = uid
+        self.valve = MaterializedView()
+        self.sensors = MaterializedView(max_children=max_readings)
+        self.last_used = time.monotonic()
+        self._token = token
+        self._start_key = push_key_bound(time.time())
+        location = "{0}/users/{1}".format(base_url.rstrip("/"), uid)
+        self._streams = [
+            StreamSubscription(
+                location + "/valve_status.json",
+                lambda: {},
+                self._current_token,
+                self.valve,
+                read_timeout,
+            ),
+            StreamSubscription(
+                location + "/sensor_data.json",
+                self._sensor_params,
+                self._current_token,
+                self.sensors,
+                read_timeout,
+                merge_snapshot=True,
+            ),
+        ]
+        for stream in self._streams:
+            stream.start()
+
+    def _current_token(self) -> str:
+        return self._token()
+
+    def _sensor_params(self) -> dict:
+        readings = self.sensors.get()
+        start = max(readings) if isinstance(readings, dict) and readings else None
+        return {
+            "orderBy": json.dumps("$key"),
+            "startAt": json.dumps(start or self._start_key),
+        }
+
+    def version(self) -> int:
+        """
+        Returns a number that changes whenever the valve status or the readings change.
+
+        Returns:
+            int: The combined version of both views.
+        """
+        return self.valve.version + self.sensors.version
+
+    def valve_status(self) -> Optional[str]:
+        """
+        Returns the current valve status.
+
+        Returns:
+            str: The valve status, or None if it is not set.
+        """
+        return self.valve.get("/valve_status")
+
+    def sensor_readings(self) -> dict:
+        """
+        Returns the sensor readings received since the subscription.
+
+        Returns:
+            dict: The readings keyed by push key. It must not be modified.
+        """
+        return self.sensors.get() or {}
+
+    def touch(self, token: Callable[[], str]) -> None:
+        """
+        Marks the view as used and makes it use the calling session's token source.
+
+        Args:
+            token (Callable): Returns the user's current ID token.
+        """
+        self._token = token
+        self.last_used = time.monotonic()
+
+    def stopped_at(self) -> Optional[float]:
+        """
+        Returns when a stream of the view stopped, e.g. because the server cancelled it
+        after the database rules stopped allowing the read.
+
+        Returns:
+            float: The monotonic time the first stream stopped, or None if both run.
+        """
+        times = [s.stopped_at for s in self._streams if s.stopped_at is not None]
+        return min(times) if times else None
+
+    def stop(self) -> None:
+        """
+        Stops both streams.
+        """
+        for stream in self._streams:
+            stream.stop()
+
+
+class LiveSubscriptions:
+    """
+    A process-level registry of live views, one per user.
+
+    Sessions of the same user share a view. A view that no session used for
+    `idle_timeout` seconds is stopped by a reaper thread. A view whose stream the server
+    cancelled is replaced by a new one once it has been stopped for `retry_after` seconds.
+
+    Attributes:
+        base_url (str): The database URL.
+        idle_timeout (float): How long an unused view is kept, in seconds.
+        max_readings (int): The maximum number of new readings kept per view.
+        retry_after (float): How long a cancelled view is kept before it is replaced.
+
+    Methods:
+        view: Returns the live view of a user, starting it if needed.
+        stop: Stops the live view of a user.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        idle_timeout: float = 600.0,
+        max_readings: int = 1000,
+        read_timeout: float = 60.0,
+        retry_after: float = 30.0,
+    ) -> None:
+        self.base_url = base_url
+        self.idle_timeout = idle_timeout
+        self.max_readings = max_readings
+        self.read_timeout = read_timeout
+        self.retry_after = retry_after
+        self._views = {}
+        self._lock = threading.Lock()
+        threading.Thread(
+            target=self._reap, name="live-view-reaper", daemon=True
+        ).start()
+
+    def view(self, uid: str, token: Callable[[], str]) -> LiveView:
+        """
+        Returns the live view of a user, starting its streams if needed.
+
+        Args:
+            uid (str): The user's ID.
+            token (Callable): Returns the user's current ID token.
+
+        Returns:
+            LiveView: The shared view. Its `stopped_at` is set if the server cancelled it
+            less than `retry_after` seconds ago.
+        """
+        with self._lock:
+            view = self._views.get(uid)
+            stopped_at = view.stopped_at() if view is not None else None
+            if (
+                stopped_at is not None
+                and time.monotonic() - stopped_at >= self.retry_after
+            ):
+                view.stop()
+                view = None
+            if view is None:
+                view = LiveView(
+                    self.base_url, uid, token, self.max_readings, self.read_timeout
+                )
+                self._views[uid] = view
+        view.touch(token)
+        return view
+
+    def stop(self, uid: str) -> None:
+        """
+        Stops the live view of a user, e.g. when they sign out.
+
+        Args:
+            uid (str): The user's ID.
+        """
+        with self._lock:
+            view = self._views.pop(uid, None)
+        if view is not None:
+            view.stop()
+
+    def _reap(self) -> None:
+        while True:
+            time.sleep(min(30.0, self.idle_timeout))
+            now = time.monotonic()
+            with self._lock:
+                idle = [
+                    uid
+                    for uid, view in self._views.items()
+                    if now - view.last_used > self.idle_timeout
+                ]
+            for uid in idle:
+                self.stop(uid)
+
+
+@st.cache_resource(show_spinner=False)
+def get_live_subscriptions() -> Optional[LiveSubscriptions]:
+    """
+    Returns the process-wide live view registry.
+
+    It is configured by an optional `[live_view]` section in the secrets file with
+    `base_url` (e.g. a local stand-in server from `stand_in_servers.py`), `idle_timeout`,
+    `max_readings`, `read_timeout` and `retry_after`.
+
+    Returns:
+        LiveSubscriptions: The shared registry, or None if no database URL is configured.
+    """
+    settings = get_settings("live_view")
+    base_url = settings.get("base_url", get_credentials().db_url)
+    if not base_url:
+        return None
+    return LiveSubscriptions(
+        base_url,
+        idle_timeout=float(settings.get("idle_timeout", 600.0)),
+        max_readings=int(settings.get("max_readings", 1000)),
+        read_timeout=float(settings.get("read_timeout", 60.0)),
+        retry_after=float(settings.get("retry_after", 30.0)),
+    )
@@ -0,0 +1,347 @@
+# NOTE: This file contains the model backends that the ChatBot class uses to generate answers.
+
+import abc
+import hashlib
+import json
+import random
+import threading
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from http_transport import PooledTransport
+
+DEFAULT_MODEL = "mistralai/Mistral-7B-Instruct-v0.3"
+
+
+class ModelBackend(abc.ABC):
+    """
+    The interface every model backend implements; subclasses must implement `stream`.
+
+    Attributes:
+        name (str): The name of the backend, used in metrics and configuration.
+        default_model (str): The model used when the caller does not pick one.
+
+    Methods:
+        complete: Returns the whole answer to a list of messages.
+        stream: Yields the answer to a list of messages chunk by chunk.
+        open_stream: Starts a streamed answer that another thread can cancel.
+    """
+
+    name = "base"
+
+    def __init__(self, default_model: str = DEFAULT_MODEL) -> None:
+        self.default_model = default_model
+
+    def complete(self, messages: List[dict], model: Optional[str] = None) -> str:
+        """
+        Returns the whole answer to a list of messages.
+
+        Args:
+            messages (list): The chat messages.
+            model (str): The model to use, or None for the default model.
+
+        Returns:
+            str: The answer.
+        """
+        return "".join(self.stream(messages, model))
+
+    @abc.abstractmethod
+    def stream(self, messages: List[dict], model: Optional[str] = None) -> Iterator[str]:
+        """
+        Yields the answer to a list of messages chunk by chunk.
+
+        Closing the returned generator cancels the upstream request.
+
+        Args:
+            messages (list): The chat messages.
+            model (str): The model to use, or None for the default model.
+
+        Yields:
+            str: The next chunk of the answer.
+        """
+
+    def open_stream(
+        self, messages: List[dict], model: Optional[str] = None
+    ) -> Tuple[Iterator[str], Callable[[], None]]:
+        """
+        Starts a streamed answer and returns its chunks and a function that cancels it.
+
+        The cancel function may be called from another thread while the chunks are being
+        read. By default it closes the generator, which only takes effect between chunks;
+        backends that hold a connection close it at once so a waiting read ends.
+
+        Args:
+            messages (list): The chat messages.
+            model (str): The model to use, or None for the default model.
+
+        Returns:
+            tuple: The chunk iterator and the cancel function.
+        """
+        chunks = self.stream(messages, model)
+
+        def cancel():
+            try:
+                chunks.close()
+            except ValueError:
+                # The generator is running on another thread
+                pass
+
+        return chunks, cancel
+
+
+def _close_quietly(response) -> None:
+    close = getattr(response, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+class TogetherBackend(ModelBackend):
+    """
+    A backend that calls the Together API through its Python SDK.
+
+    Attributes:
+        client (Together): The Together client.
+    """
+
+    name = "together"
+
+    def __init__(self, api_key: str, default_model: str = DEFAULT_MODEL) -> None:
+        from together import Together
+
+        super().__init__(default_model)
+        self.client = Together(api_key=api_key)
+
+    def complete(self, messages: List[dict], model: Optional[str] = None) -> str:
+        response = self.client.chat.completions.create(
+            model=model or self.default_model, messages=messages
+        )
+        return response.choices[0].message.content
+
+    def stream(self, messages: List[dict], model: Optional[str] = None) -> Iterator[str]:
+        chunks, _ = self.open_stream(messages, model)
+        yield from chunks
+
+    def open_stream(
+        self, messages: List[dict], model: Optional[str] = None
+    ) -> Tuple[Iterator[str], Callable[[], None]]:
+        response = self.client.chat.completions.create(
+            model=model or self.default_model, messages=messages, stream=True
+        )
+        return self._chunks(response), lambda: _close_quietly(response)
+
+    @staticmethod
+    def _chunks(response) -> Iterator[str]:
+        try:
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    yield text
+        finally:
+            _close_quietly(response)
+
+
+class OpenAICompatibleBackend(ModelBackend):
+    """
+    A backend for any HTTP endpoint that implements the OpenAI chat completions API.
+
+    Attributes:
+        transport (PooledTransport): A pooled transport whose base URL ends in `/v1`.
+        api_key (str): The bearer token, or None if the endpoint needs none.
+    """
+
+    name = "openai"
+
+    def __init__(
+        self,
+        transport: PooledTransport,
+        api_key: Optional[str] = None,
+        default_model: str = DEFAULT_MODEL,
+    ) -> None:
+        super().__init__(default_model)
+        self.transport = transport
+        self.api_key = api_key
+
+    def _post(self, messages: List[dict], model: Optional[str], stream: bool):
+        headers = {"content-type": "application/json"}
+        if self.api_key:
+            headers["authorization"] = "Bearer {0}".format(self.api_key)
+        response = self.transport.request(
+            "POST",
+            "chat/completions",
+            headers=headers,
+            data=json.dumps(
+                {
+                    "model": model or self.default_model,
+                    "messages": messages,
+                    "stream": stream,
+                }
+            ),
+            stream=stream,
+        )
+        response.raise_for_status()
+        return response
+
+    def complete(self, messages: List[dict], model: Optional[str] = None) -> str:
+        response = self._post(messages, model, stream=False)
+        return response.json()["choices"][0]["message"]["content"]
+
+    def stream(self, messages: List[dict], model: Optional[str] = None) -> Iterator[str]:
+        chunks, _ = self.open_stream(messages, model)
+        yield from chunks
+
+    def open_stream(
+        self, messages: List[dict], model: Optional[str] = None
+    ) -> Tuple[Iterator[str], Callable[[], None]]:
+        response = self._post(messages, model, stream=True)
+        # Closing the response from another thread ends a read that waits for a token
+        return self._chunks(response), response.close
+
+    @staticmethod
+    def _chunks(response) -> Iterator[str]:
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                text = choices[0].get("delta", {}).get("content") if choices else None
+                if text:
+                    yield text
+        finally:
+            response.close()
+
+
+class StubBackend(ModelBackend):
+    """
+    A deterministic in-process backend for offline throughput and latency tests.
+
+    The answer depends only on the model and the last message, and is delivered with the
+    latency profile's time to first token and token rate.
+
+    Attributes:
+        first_token_latency (float): Seconds before the first chunk.
+        tokens_per_second (float): Chunks per second after the first one, 0 for no delay.
+        answer_tokens (int): The number of words in each answer.
+        jitter (float): Relative random variation of the delays.
+    """
+
+    name = "stub"
+
+    PROFILES = {
+        "instant": {"first_token_latency": 0.0, "tokens_per_second": 0.0},
+        "fast": {"first_token_latency": 0.05, "tokens_per_second": 200.0},
+        "typical": {"first_token_latency": 0.4, "tokens_per_second": 60.0},
+        "slow": {"first_token_latency": 1.5, "tokens_per_second": 15.0},
+    }
+
+    WORDS = (
+        "books study notes research reading chapter lecture summary practice exam "
+        "topic question answer example theory method source review outline essay"
+    ).split()
+
+    def __init__(
+        self,
+        profile: str = "instant",
+        first_token_latency: Optional[float] = None,
+        tokens_per_second: Optional[float] = None,
+        answer_tokens: int = 64,
+        jitter: float = 0.0,
+        default_model: str = "stub",
+    ) -> None:
+        super().__init__(default_model)
+        settings = self.PROFILES[profile]
+        self.first_token_latency = (
+            settings["first_token_latency"]
+            if first_token_latency is None
+            else first_token_latency
+        )
+        self.tokens_per_second = (
+            settings["tokens_per_second"]
+            if tokens_per_second is None
+            else tokens_per_second
+        )
+        self.answer_tokens = answer_tokens
+        self.jitter = jitter
+
+    def _delay(
+        self, seconds: float, rng: random.Random, cancelled: threading.Event
+    ) -> bool:
+        # Returns False if the stream was cancelled while waiting
+        if seconds > 0:
+            seconds *= 1 + rng.uniform(-self.jitter, self.jitter)
+        return not cancelled.wait(seconds) if seconds > 0 else not cancelled.is_set()
+
+    def stream(self, messages: List[dict], model: Optional[str] = None) -> Iterator[str]:
+        chunks, _ = self.open_stream(messages, model)
+        yield from chunks
+
+    def open_stream(
+        self, messages: List[dict], model: Optional[str] = None
+    ) -> Tuple[Iterator[str], Callable[[], None]]:
+        cancelled = threading.Event()
+        return self._chunks(messages, model, cancelled), cancelled.set
+
+    def _chunks(
+        self, messages: List[dict], model: Optional[str], cancelled: threading.Event
+    ) -> Iterator[str]:
+        seed = hashlib.sha256(
+            json.dumps([model or self.default_model, messages[-1:]]).encode("utf-8")
+        ).digest()
+        rng = random.Random(seed)
+        if not self._delay(self.first_token_latency, rng, cancelled):
+            return
+        interval = 1 / self.tokens_per_second if self.tokens_per_second else 0
+        for index in range(self.answer_tokens):
+            if index and not self._delay(interval, rng, cancelled):
+                return
+            word = rng.choice(self.WORDS)
+            yield word if index == 0 else " " + word
+
+
+def create_backend(settings: dict, api_key: Optional[str]) -> ModelBackend:
+    """
+    Creates a backend from a settings mapping.
+
+    Supported keys are `backend` ("together", "openai" or "stub"), `model`, and per backend:
+    `base_url` and `api_key` for "openai"; `profile`, `first_token_latency`,
+    `tokens_per_second`, `answer_tokens` and `jitter` for "stub".
+
+    Args:
+        settings (dict): The backend settings.
+        api_key (str): The API key used when the settings do not provide one.
+
+    Returns:
+        ModelBackend: The configured backend.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    kind = settings.get("backend", "together")
+    model = settings.get("model", DEFAULT_MODEL)
+    if kind == "together":
+        return TogetherBackend(settings.get("api_key", api_key), default_model=model)
+    if kind == "openai":
+        transport = PooledTransport(
+            settings["base_url"],
+            read_timeout=float(settings.get("read_timeout", 60.0)),
+            max_retries=int(settings.get("max_retries", 0)),
+        )
+        return OpenAICompatibleBackend(
+            transport, settings.get("api_key", api_key), default_model=model
+        )
+    if kind == "stub":
+        return StubBackend(
+            profile=settings.get("profile", "instant"),
+            first_token_latency=settings.get("first_token_latency"),
+            tokens_per_second=settings.get("tokens_per_second"),
+            answer_tokens=int(settings.get("answer_tokens", 64)),
+            jitter=float(settings.get("jitter", 0.0)),
+            default_model=settings.get("model", "stub"),
+        )
+    raise ValueError("Unknown model backend: {0}".format(kind))
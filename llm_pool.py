@@ -0,0 +1,222 @@
+# NOTE: This file contains the LLMClientPool class that is used to share model clients and limit upstream load.
+
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Optional
+
+import streamlit as st
+
+from credential_loader import get_settings
+from llm_backends import ModelBackend, create_backend
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request could not get a slot within the maximum wait.
+    """
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        capacity (float): The maximum number of tokens (the allowed burst).
+        tokens (float): The tokens currently available.
+
+    Methods:
+        acquire: Takes a token, waiting up to a timeout for one to become available.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, timeout: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if wait > timeout:
+                return -1.0
+            # Take the token now, the caller sleeps until it has been refilled
+            self.tokens -= 1
+            return wait
+
+    def acquire(self, timeout: float) -> bool:
+        """
+        Takes a token, waiting up to `timeout` seconds for one to become available.
+
+        Args:
+            timeout (float): The maximum time to wait in seconds.
+
+        Returns:
+            bool: True if a token was taken, False if it would take longer than `timeout`.
+        """
+        wait = self._reserve(timeout)
+        if wait < 0:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class LLMClientPool:
+    """
+    A process-wide pool of model backends that limits upstream load.
+
+    Backends are created once per configuration and shared by all sessions. Every request must
+    hold a slot: it first takes a token from the user's token bucket, then waits for the
+    global concurrency semaphore. Requests that cannot get a slot within `max_wait`
+    seconds raise `RateLimitExceeded` instead of piling up on the upstream.
+
+    Attributes:
+        max_concurrency (int): The maximum number of upstream requests in flight.
+        user_rate (float): Requests per second allowed for each user.
+        user_burst (float): The burst size allowed for each user.
+        max_wait (float): The maximum time a request waits for a slot, in seconds.
+
+    Methods:
+        backend: Returns the shared backend for a configuration.
+        slot: A context manager that holds a request slot for a user.
+        metrics: Returns the queue depth, in-flight count and wait times.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        user_rate: float = 0.5,
+        user_burst: float = 3,
+        max_wait: float = 30,
+        max_users: int = 10000,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_wait = max_wait
+        self.max_users = max_users
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._backends = {}
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+        self._rejected = 0
+        self._waits = deque(maxlen=1000)
+
+    def backend(self, settings: dict, api_key: str) -> ModelBackend:
+        """
+        Returns the shared backend for a configuration.
+
+        Args:
+            settings (dict): The backend settings, see `llm_backends.create_backend`.
+            api_key (str): The default API key.
+
+        Returns:
+            ModelBackend: The shared backend.
+        """
+        key = (json.dumps(settings, sort_keys=True, default=str), api_key)
+        with self._lock:
+            backend = self._backends.get(key)
+            if backend is None:
+                backend = self._backends[key] = create_backend(settings, api_key)
+            return backend
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+                self._buckets[user_id] = bucket
+                while len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(user_id)
+            return bucket
+
+    @contextmanager
+    def slot(self, user_id: Optional[str], max_wait: Optional[float] = None):
+        """
+        Holds a request slot for a user for the duration of the block.
+
+        Args:
+            user_id (str): The ID of the user making the request, or None for a request
+                made on behalf of one that already holds a slot (e.g. a hedged request),
+                which skips the user's rate limit.
+            max_wait (float): The maximum wait in seconds, or None for `max_wait`.
+
+        Raises:
+            RateLimitExceeded: If no slot was available within the maximum wait.
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            if user_id is not None and not self._bucket(user_id).acquire(max_wait):
+                raise RateLimitExceeded("Too many requests from this user")
+            remaining = max_wait - (time.monotonic() - started)
+            if not self._semaphore.acquire(timeout=max(remaining, 0)):
+                raise RateLimitExceeded("Too many requests in flight")
+        except RateLimitExceeded:
+            with self._lock:
+                self._waiting -= 1
+                self._rejected += 1
+            raise
+        with self._lock:
+            self._waiting -= 1
+            self._in_flight += 1
+            self._waits.append(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._semaphore.release()
+
+    def metrics(self) -> dict:
+        """
+        Returns the queue depth, in-flight count, rejections and recent wait times.
+
+        Returns:
+            dict: The pool metrics. Wait times are in seconds over the last 1000 requests.
+        """
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "queue_depth": self._waiting,
+                "in_flight": self._in_flight,
+                "rejected": self._rejected,
+                "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_pool() -> LLMClientPool:
+    """
+    Returns the process-wide model client pool.
+
+    It is configured by an optional `[llm_pool]` section in the secrets file with
+    `max_concurrency`, `user_rate`, `user_burst` and `max_wait`.
+
+    Returns:
+        LLMClientPool: The shared pool.
+    """
+    settings = get_settings("llm_pool")
+    return LLMClientPool(
+        max_concurrency=int(settings.get("max_concurrency", 8)),
+        user_rate=float(settings.get("user_rate", 0.5)),
+        user_burst=float(settings.get("user_burst", 3)),
+        max_wait=float(settings.get("max_wait", 30)),
+    )
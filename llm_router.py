@@ -0,0 +1,366 @@
+# NOTE: This file contains the ModelRouter class that is used to route chat requests and hedge slow backends.
+
+import functools
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Callable, Iterator, List, Optional
+
+import streamlit as st
+
+from chat_context import count_tokens
+from credential_loader import get_settings
+from llm_backends import ModelBackend
+from llm_pool import LLMClientPool, RateLimitExceeded, get_llm_pool
+
+
+class LatencyTracker:
+    """
+    A rolling window of time-to-first-token samples for one backend.
+
+    Attributes:
+        samples (deque): The most recent latencies in seconds.
+
+    Methods:
+        record: Adds a latency sample.
+        percentile: Returns a percentile of the window.
+    """
+
+    def __init__(self, window: int = 200) -> None:
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        """
+        Adds a latency sample.
+
+        Args:
+            seconds (float): The latency in seconds.
+        """
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        Returns a percentile of the window.
+
+        Args:
+            fraction (float): The percentile as a fraction, e.g. 0.95.
+
+        Returns:
+            float: The latency at that percentile, or None if there are no samples.
+        """
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class _Attempt:
+    """
+    One backend request running on its own thread and reporting into a shared event queue.
+
+    The attempt records its own time to first token in its route's tracker, whether or not
+    it wins, and holds the slot returned by `slot` (if any) while it runs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        backend: ModelBackend,
+        model: Optional[str],
+        messages: List[dict],
+        events: queue.Queue,
+        tracker: LatencyTracker,
+        slot: Optional[Callable] = None,
+    ) -> None:
+        self.name = name
+        self.started = time.monotonic()
+        self.failed = False
+        self._backend = backend
+        self._model = model
+        self._messages = messages
+        self._events = events
+        self._tracker = tracker
+        self._slot = slot
+        self._recorded = False
+        self._close = None
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _record(self, lower_bound: bool = False) -> None:
+        # Records the time to first token once; a cancelled attempt without a first
+        # token records the time it waited as a lower bound, so slow samples count too
+        with self._lock:
+            if self._recorded or (lower_bound and self.failed):
+                return
+            self._recorded = True
+        self._tracker.record(time.monotonic() - self.started)
+
+    def _run(self) -> None:
+        chunks = None
+        try:
+            with self._slot() if self._slot is not None else nullcontext():
+                chunks, close = self._backend.open_stream(self._messages, self._model)
+                with self._lock:
+                    self._close = close
+                if self._cancelled.is_set():
+                    close()
+                    return
+                for chunk in chunks:
+                    self._record()
+                    if self._cancelled.is_set():
+                        return
+                    self._events.put((self, "chunk", chunk))
+                self._record()
+                self._events.put((self, "done", None))
+        except Exception as error:
+            if not self._cancelled.is_set():
+                self._events.put((self, "error", error))
+        finally:
+            if chunks is not None:
+                chunks.close()
+
+    def cancel(self, lower_bound: bool = False) -> None:
+        """
+        Cancels the request and closes its connection, ending a read that is waiting.
+
+        Args:
+            lower_bound (bool): Whether to record the time waited so far as the time to
+                first token if none arrived yet.
+        """
+        if lower_bound:
+            self._record(lower_bound=True)
+        self._cancelled.set()
+        with self._lock:
+            close = self._close
+        if close is not None:
+            close()
+
+
+class ModelRouter(ModelBackend):
+    """
+    Routes chat requests between backends and hedges slow ones.
+
+    Short, simple prompts go to the fast backend if one is configured. If the chosen
+    backend has not produced its first token after the hedge threshold, the same request
+    is sent to the hedge backend and whichever answers first wins; the other request is
+    cancelled. The threshold is the p95 time to first token of the chosen backend once
+    enough samples exist, and `hedge_after` before that. A backend that fails before
+    answering falls back to the hedge backend immediately.
+
+    The caller holds a pool slot for the chosen backend; a hedge request takes a slot of
+    its own from `pool`, and is skipped when a slow backend is hedged while none is free.
+
+    Attributes:
+        primary (ModelBackend): The default backend.
+        fast (ModelBackend): The backend for short prompts, or None.
+        hedge (ModelBackend): The backend for hedged requests, or None.
+        short_prompt_tokens (int): The largest question routed to the fast backend.
+        hedge_after (float): The hedge threshold in seconds before enough samples exist.
+        min_samples (int): Samples needed before the p95 threshold is used.
+        pool (LLMClientPool): The pool hedge requests take a slot from, or None.
+        trackers (dict): The latency tracker of each backend, keyed by route name.
+        hedges (int): How many hedged requests were sent.
+        hedge_wins (int): How many hedged requests answered first.
+
+    Methods:
+        choose: Returns the route for a list of messages.
+        hedge_threshold: Returns the current hedge threshold of a route.
+        latency: Returns the p50 and p95 time to first token of every route.
+    """
+
+    name = "router"
+
+    def __init__(
+        self,
+        primary: ModelBackend,
+        fast: Optional[ModelBackend] = None,
+        hedge: Optional[ModelBackend] = None,
+        short_prompt_tokens: int = 40,
+        hedge_after: float = 2.0,
+        min_samples: int = 20,
+        pool: Optional[LLMClientPool] = None,
+    ) -> None:
+        super().__init__(primary.default_model)
+        self.primary = primary
+        self.fast = fast
+        self.hedge = hedge
+        self.short_prompt_tokens = short_prompt_tokens
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.pool = pool
+        self.trackers = {
+            name: LatencyTracker()
+            for name, backend in self._routes().items()
+            if backend is not None
+        }
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _routes(self) -> dict:
+        return {"primary": self.primary, "fast": self.fast, "hedge": self.hedge}
+
+    def choose(self, messages: List[dict]) -> str:
+        """
+        Returns the route for a list of messages.
+
+        Args:
+            messages (list): The chat messages, ending with the question.
+
+        Returns:
+            str: "fast" for short questions without code when a fast backend exists, else "primary".
+        """
+        question = messages[-1]["content"] if messages else ""
+        if (
+            self.fast is not None
+            and "```" not in question
+            and count_tokens(question) <= self.short_prompt_tokens
+        ):
+            return "fast"
+        return "primary"
+
+    def hedge_threshold(self, route: str) -> float:
+        """
+        Returns the current hedge threshold of a route.
+
+        Args:
+            route (str): The route name.
+
+        Returns:
+            float: Seconds to wait for the first token before hedging.
+        """
+        tracker = self.trackers[route]
+        if len(tracker.samples) < self.min_samples:
+            return self.hedge_after
+        return tracker.percentile(0.95)
+
+    def latency(self) -> dict:
+        """
+        Returns the p50 and p95 time to first token of every route.
+
+        Returns:
+            dict: {"route": {"p50": seconds, "p95": seconds, "samples": count}}.
+        """
+        return {
+            name: {
+                "p50": tracker.percentile(0.5),
+                "p95": tracker.percentile(0.95),
+                "samples": len(tracker.samples),
+            }
+            for name, tracker in self.trackers.items()
+        }
+
+    def stream(self, messages: List[dict], model: Optional[str] = None) -> Iterator[str]:
+        route = self.choose(messages)
+        events = queue.Queue()
+        attempts = [
+            _Attempt(
+                route,
+                self._routes()[route],
+                model if route == "primary" else None,
+                messages,
+                events,
+                self.trackers[route],
+            )
+        ]
+        hedge_at = time.monotonic() + self.hedge_threshold(route)
+
+        def start_hedge(fallback: bool = False):
+            slot = None
+            if self.pool is not None:
+                # A hedge of a slow request must not wait for a slot; a fallback may
+                slot = functools.partial(
+                    self.pool.slot, None, None if fallback else 0.0
+                )
+            self.hedges += 1
+            attempts.append(
+                _Attempt(
+                    "hedge",
+                    self.hedge,
+                    None,
+                    messages,
+                    events,
+                    self.trackers["hedge"],
+                    slot,
+                )
+            )
+
+        winner = None
+        try:
+            while winner is None:
+                can_hedge = self.hedge is not None and len(attempts) == 1
+                timeout = max(hedge_at - time.monotonic(), 0) if can_hedge else None
+                try:
+                    attempt, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    start_hedge()
+                    continue
+                if kind == "error":
+                    attempt.failed = True
+                    if attempt.name == "hedge" and isinstance(
+                        payload, RateLimitExceeded
+                    ):
+                        # The hedge got no slot and was never sent
+                        self.hedges -= 1
+                    if self.hedge is not None and len(attempts) == 1:
+                        start_hedge(fallback=True)
+                    elif all(other.failed for other in attempts):
+                        raise payload
+                    continue
+                winner = attempt
+                if winner.name == "hedge" and len(attempts) > 1:
+                    self.hedge_wins += 1
+                for other in attempts:
+                    if other is not winner:
+                        other.cancel(lower_bound=other.name != "hedge")
+                if kind == "done":
+                    return
+                yield payload
+            while True:
+                attempt, kind, payload = events.get()
+                if attempt is not winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    return
+                else:
+                    raise payload
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+
+@st.cache_resource(show_spinner=False)
+def get_model_router(api_key: str) -> ModelRouter:
+    """
+    Returns the process-wide model router.
+
+    The primary backend comes from the `[llm]` section of the secrets file, the optional
+    fast and hedge backends from `[llm_fast]` and `[llm_hedge]` (same keys), and the routing
+    thresholds from `[llm_router]` (`short_prompt_tokens`, `hedge_after`, `min_samples`).
+
+    Args:
+        api_key (str): The default API key for the backends.
+
+    Returns:
+        ModelRouter: The shared router.
+    """
+    pool = get_llm_pool()
+    fast_settings = get_settings("llm_fast")
+    hedge_settings = get_settings("llm_hedge")
+    router_settings = get_settings("llm_router")
+    return ModelRouter(
+        primary=pool.backend(get_settings("llm"), api_key),
+        fast=pool.backend(fast_settings, api_key) if fast_settings else None,
+        hedge=pool.backend(hedge_settings, api_key) if hedge_settings else None,
+        short_prompt_tokens=int(router_settings.get("short_prompt_tokens", 40)),
+        hedge_after=float(router_settings.get("hedge_after", 2.0)),
+        min_samples=int(router_settings.get("min_samples", 20)),
+        pool=pool,
+    )
@@ -1,4 +1,3 @@
-import time
 import requests
 import streamlit as st
 from auth import FirebaseAuthenticator
@@ -8,16 +7,60 @@ import datetime
 from datetime import timedelta as tdlt
 from datetime import datetime as dt
 from typing import List
-from together import Together
-from credential_loader import Credentials
+from credential_loader import get_credentials, get_settings
+from catalog import get_catalog
+from retrieval import format_products, get_retriever
+from chat_context import ConversationContext
+from response_cache import get_response_cache, normalized_key
+from single_flight import get_single_flight
+from llm_pool import RateLimitExceeded, get_llm_pool
+from llm_router import get_model_router
+from assets import get_asset_pipeline
+from image_search import get_image_search
+from live_view import get_live_subscriptions
 from streamlit import components
-from PIL import Image
 import urllib.parse
+import os
+
+
+def product_thumbnail(photo, product, image_search=None):
+    """
+    Returns a thumbnail data URI of a product without blocking.
+
+    The local photo is used if it exists. Otherwise the product name is looked up on Pexels,
+    which only reads the image cache and fetches a missing photo in the background.
+    """
+    if isinstance(photo, str) and os.path.exists(photo):
+        try:
+            return get_asset_pipeline().data_uri(photo, "thumbnail")
+        except (OSError, ValueError):
+            pass
+    if image_search is None:
+        return None
+    return image_search.data_uri(str(product))
 
 
 class ChatBot:
-    def __init__(self, api_key):
-        self.client = Together(api_key=api_key)
+    def __init__(self, api_key, user_id="anonymous"):
+        self.pool = get_llm_pool()
+        # Routes between the [llm], [llm_fast] and [llm_hedge] backends of the secrets file
+        self.backend = get_model_router(api_key)
+        self.model = self.backend.default_model
+        self.user_id = user_id
+        self.cache = get_response_cache()
+        self.flights = get_single_flight()
+        self.retriever = get_retriever()
+        retrieval_settings = get_settings("retrieval")
+        self.top_k = int(retrieval_settings.get("top_k", 3))
+        self.min_score = float(retrieval_settings.get("min_score", 0.1))
+        self.products = None
+        pexels_api_key = get_credentials().pexels_credentials
+        self.image_search = get_image_search(pexels_api_key) if pexels_api_key else None
+        context_settings = get_settings("chat_context")
+        self.context = ConversationContext(
+            token_budget=int(context_settings.get("token_budget", 3000)),
+            summary_tokens=int(context_settings.get("summary_tokens", 256)),
+        )
         if "messages" not in st.session_state:
             # Load products from CSV
 
@@ -28,18 +71,110 @@ class ChatBot:
                 }
             ]
 
-    def ask(self, question):
-        st.session_state["messages"].append({"role": "user", "content": question})
-        response = self.client.chat.completions.create(
-            model="mistralai/Mistral-7B-Instruct-v0.3",
-            messages=st.session_state["messages"],
+    def prompt(self, question_message):
+        """
+        Returns the messages to send for a question, trimmed to the context token budget.
+
+        The catalog products that best match the question are added to the leading system
+        message, so they count toward the budget and never end up mid-history.
+        """
+        history = st.session_state["messages"] + [question_message]
+        products = self.retriever.search(
+            question_message["content"], self.top_k, self.min_score
         )
-        st.session_state["messages"].append(
-            {"role": "assistant", "content": response.choices[0].message.content}
+        self.products = products
+        if len(products):
+            if self.image_search is not None:
+                # Photos of the recommended products download while the answer streams
+                self.image_search.prefetch(products["Product"])
+            if history[0]["role"] == "system":
+                system = dict(
+                    history[0],
+                    content=history[0]["content"] + "\n\n" + format_products(products),
+                )
+                history = [system] + history[1:]
+            else:
+                history = [
+                    {"role": "system", "content": format_products(products)}
+                ] + history
+        return self.context.build(history)
+
+    def commit(self, question_message, answer):
+        """
+        Appends a finished question and answer to the chat history.
+        """
+        st.session_state["messages"].append(question_message)
+        st.session_state["messages"].append({"role": "assistant", "content": answer})
+
+    def upstream(self, messages):
+        """
+        Streams an answer from the model backend while holding a slot in the client pool.
+        """
+        # The slot is held until the stream is exhausted or closed
+        with self.pool.slot(self.user_id):
+            yield from self.backend.stream(messages, self.model)
+
+    def shared_stream(self, messages):
+        """
+        Streams an answer, sharing the upstream call with identical requests in flight.
+        """
+        return self.flights.stream(
+            normalized_key(self.model, messages), lambda: self.upstream(messages)
         )
-        return response.choices[0].message.content
+
+    def ask(self, question, use_cache=True):
+        question_message = {"role": "user", "content": question}
+        messages = self.prompt(question_message)
+        answer = self.cache.get(self.model, messages) if use_cache else None
+        if answer is None:
+            answer = "".join(self.shared_stream(messages))
+            if use_cache:
+                self.cache.put(self.model, messages, answer)
+        self.commit(question_message, answer)
+        return answer
+
+    def stream(self, question, use_cache=True):
+        """
+        Asks a question and yields the answer chunk by chunk as the model produces it.
+
+        The question and the complete answer are committed to the chat history only once the
+        stream finishes. Closing the generator early (e.g. when the user reruns the script)
+        stops listening and leaves the history untouched; the upstream response is closed
+        once no other session is waiting for the same answer. A cached answer is yielded
+        in one piece.
+
+        Args:
+            question (str): The user's question.
+            use_cache (bool): Whether to look up and store the answer in the response cache.
+
+        Yields:
+            str: The next chunk of the answer.
+
+        Raises:
+            RateLimitExceeded: If the request could not get a slot in the client pool.
+        """
+        question_message = {"role": "user", "content": question}
+        messages = self.prompt(question_message)
+        answer = self.cache.get(self.model, messages) if use_cache else None
+        if answer is not None:
+            yield answer
+            self.commit(question_message, answer)
+            return
+        parts = []
+        response = self.shared_stream(messages)
+        try:
+            for text in response:
+                parts.append(text)
+                yield text
+        finally:
+            response.close()
+        answer = "".join(parts)
+        if use_cache:
+            self.cache.put(self.model, messages, answer)
+        self.commit(question_message, answer)
 
     def clear_chat(self):
+        st.session_state.pop("chat_window", None)
         st.session_state["messages"] = [
             {
                 "role": "system",
@@ -54,7 +189,9 @@ class App(FirebaseAuthenticator, RealtimeDB):
         self.set_page_config()
 
     def set_page_config(self):
-        app_icon = Image.open("assets/icon.jpeg")
+        # A small, pre-generated variant shared by all sessions instead of decoding the
+        # full-size JPEG on every rerun
+        app_icon = get_asset_pipeline().image("assets/icon.jpeg", "icon")
         st.set_page_config(
             page_title="Farm Dashboard",
             page_icon=app_icon,
@@ -63,6 +200,7 @@ class App(FirebaseAuthenticator, RealtimeDB):
         )
 
     def auth_page(self):
+        self.collect_auth_jobs()
         if "user_info" not in st.session_state:
             col1, col2, col3 = st.columns([2, 5, 2])
             login_register = col2.toggle(
@@ -122,19 +260,30 @@ class App(FirebaseAuthenticator, RealtimeDB):
                 auth_notification.error(st.session_state.auth_warning)
                 del st.session_state.auth_warning
 
+        elif not self.session_is_valid():
+            self.stop_live_view()
+            self.stop_token_manager()
+            del st.session_state["user_info"]
+            st.session_state.auth_warning = """
+            ##### Your session has expired.
+            - Please sign in again.
+            """
+            st.rerun()
         else:
             self.home_page()
 
+    def is_premium_user(self):
+        user = st.session_state.user_info["fullUserInfo"]["users"][0]
+        return (
+            user["localId"] != "test_user_id"
+            and user["email"] != "test_user_email"
+            and st.session_state.user_info["idToken"] != "test_id_token"
+        )
+
     def home_page(self):
         self.sidebar()
         try:
-            if (
-                st.session_state.user_info["fullUserInfo"]["users"][0]["localId"]
-                != "test_user_id"
-                and st.session_state.user_info["fullUserInfo"]["users"][0]["email"]
-                != "test_user_email"
-                and st.session_state.user_info["idToken"] != "test_id_token"
-            ):
+            if self.is_premium_user():
                 st.title(
                     f"**Welcome, _{st.session_state.user_info['fullUserInfo']['users'][0]['email'].split('@')[0]}_!**"
                 )
@@ -156,82 +305,188 @@ class App(FirebaseAuthenticator, RealtimeDB):
         )
 
         # Load products from CSV
-        # Initialize the chatbot
-        chatbot = ChatBot(Credentials().openai_credentials)
-        pexels_api_key = Credentials().pexels_credentials
+        catalog = get_catalog()
+        pexels_api_key = get_credentials().pexels_credentials
+        image_search = get_image_search(pexels_api_key) if pexels_api_key else None
 
         # Display products
         with st.status(
             label="**Getting Lesson Materials**", expanded=False
         ) as status_0:
             st.write("## Books")
+            self.product_list(catalog, image_search)
             status_0.update(
                 label="**Materials Analyzed! - Expand to view feedback**", state="complete", expanded=True
             )
-        if (
-            st.session_state.user_info["fullUserInfo"]["users"][0]["localId"]
-            != "test_user_id"
-            and st.session_state.user_info["fullUserInfo"]["users"][0]["email"]
-            != "test_user_email"
-            and st.session_state.user_info["idToken"] != "test_id_token"
+        if self.is_premium_user():
+            self.live_status()
+            self.chat_panel()
+
+    @st.experimental_fragment(run_every=2)
+    def live_status(self):
+        # Re-runs every 2 seconds, but only reads the live view kept up to date by the
+        # database stream, so idle dashboards cause no database traffic
+        subscriptions = get_live_subscriptions()
+        if subscriptions is None:
+            return
+        view = subscriptions.view(
+            st.session_state.user_info["fullUserInfo"]["users"][0]["localId"],
+            self.current_id_token,
+        )
+        if view.stopped_at() is not None:
+            st.warning("**Live updates are paused.** - They resume automatically.")
+        version = view.version()
+        changed = st.session_state.get("live_version", version) != version
+        st.session_state.live_version = version
+        readings = view.sensor_readings()
+        valve_col, readings_col = st.columns(2)
+        valve_col.metric("**Valve**", view.valve_status() or "Unknown")
+        readings_col.metric("**New sensor readings**", len(readings))
+        if readings:
+            latest = readings[max(readings)]
+            if isinstance(latest, dict):
+                latest = ", ".join(
+                    "{0}: {1}".format(name, value) for name, value in latest.items()
+                )
+            label = "**Updated:** " if changed else "**Latest reading:** "
+            st.caption(label + str(latest))
+
+    @st.experimental_fragment
+    def product_list(self, catalog, image_search=None):
+        category_col, price_col = st.columns([1, 2])
+        category = category_col.selectbox(
+            "**Category**", ["All"] + catalog.categories(), key="product_category"
+        )
+        lowest, highest = catalog.price_range()
+        min_price, max_price = price_col.slider(
+            "**Price**",
+            min_value=lowest,
+            max_value=max(highest, lowest + 1),
+            value=(lowest, max(highest, lowest + 1)),
+            key="product_price",
+        )
+        products = catalog.filter(
+            None if category == "All" else category,
+            min_price,
+            max_price,
+            limit=200,
+        )
+        # Products without a local photo get a Pexels photo once it has been fetched
+        thumbnails = [
+            product_thumbnail(photo, product, image_search)
+            for photo, product in zip(products["Photo"], products["Product"])
+        ]
+        st.dataframe(
+            products[["Product", "Price", "Category", "Description"]].assign(
+                Photo=thumbnails
+            ),
+            column_config={"Photo": st.column_config.ImageColumn("Photo")},
+            hide_index=True,
+            use_container_width=True,
+        )
+
+    @st.experimental_fragment
+    def chat_panel(self):
+        # Runs as a fragment: a chat turn only re-executes this method, not the whole page
+        chatbot = ChatBot(
+            get_credentials().openai_credentials,
+            st.session_state.user_info["fullUserInfo"]["users"][0]["localId"],
+        )
+        # Only the newest turns are drawn, older ones are paged in on demand
+        page_size = 2 * int(get_settings("chat_view").get("turns_per_page", 10))
+        window = st.session_state.setdefault("chat_window", page_size)
+        messages = st.session_state["messages"]
+        first = 1 if messages and messages[0]["role"] == "system" else 0
+        if "chat_history_loaded" not in st.session_state:
+            # The stored history is loaded lazily, one page per request
+            turns, cursor = self.load_chat_history(page_size)
+            messages[first:first] = turns
+            st.session_state.chat_history_loaded = True
+            st.session_state.chat_history_cursor = cursor
+        cursor = st.session_state.chat_history_cursor
+        start = max(first, len(messages) - window)
+        if (start > first or cursor is not None) and st.button(
+            "Load earlier messages", use_container_width=True
         ):
-            for message in st.session_state["messages"]:
-                if message["role"] != "system":  # Skip system messages
-                    with st.chat_message(message["role"]):
-                        st.markdown(message["content"])
-            if prompt := st.chat_input("Ask me anything!"):
-
-                #     st.markdown(
-                #             f"""
-                # <script>
-                #     window.scrollTo({{
-                #         top: document.body.scrollHeight,
-                #         behavior: 'smooth' // Optional: Add smooth scrolling effect
-                #     }});
-                # </script>
-                # """,
-                #             unsafe_allow_html=True,
-                #         )
-                st.session_state["messages"].append({"role": "user", "content": prompt})
-                with st.chat_message("user"):
-                    status_0.update(
-                        label="**Minimized! - Expand to view products**",
-                        state="complete",
-                        expanded=False,
-                    )
-                    st.markdown(prompt)
-
-                with st.status(
-                    label="**We are cooking up a response...**", expanded=False
-                ) as status:
-                    with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                        full_response = chatbot.ask(prompt)
-                        message_placeholder.markdown(full_response + "▌")
-                    st.session_state["messages"].append(
-                        {"role": "assistant", "content": full_response}
-                    )
-                    status.update(
-                        label="**Response is ready!**", state="complete", expanded=True
-                    )
-            cols = st.columns([20, 10, 20])
-            with cols[0]:
-                st.empty()
-            with cols[1]:
-                if len(st.session_state.get("messages", [])) > 1:
-                    if st.button("Clear Chat", use_container_width=True):
-                        chatbot.clear_chat()
-                        status_0.update(
-                            label="**Chat cleared!**", state="complete", expanded=True
+            if start == first:
+                turns, st.session_state.chat_history_cursor = self.load_chat_history(
+                    page_size, cursor
+                )
+                messages[first:first] = turns
+            st.session_state.chat_window = window = window + page_size
+            start = max(first, len(messages) - window)
+        for message in messages[start:]:
+            if message["role"] != "system":  # Skip system messages
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
+        if prompt := st.chat_input("Ask me anything!"):
+            with st.chat_message("user"):
+                st.markdown(prompt)
+
+            with st.status(
+                label="**We are cooking up a response...**", expanded=True
+            ) as status:
+                with st.chat_message("assistant"):
+                    history_length = len(messages)
+                    response_stream = chatbot.stream(prompt)
+                    try:
+                        st.write_stream(response_stream)
+                    except RateLimitExceeded:
+                        st.warning(
+                            "The assistant is busy right now. Please try again in a few seconds."
                         )
-                        st.rerun()
-            with cols[2]:
-                st.empty()
+                    finally:
+                        # Stops the upstream request if the user reruns mid-answer
+                        response_stream.close()
+                    products = chatbot.products
+                    if products is not None and len(products):
+                        thumbnails = []
+                        for photo, product in zip(
+                            products["Photo"], products["Product"]
+                        ):
+                            uri = product_thumbnail(photo, product, chatbot.image_search)
+                            if uri:
+                                thumbnails.append((product, uri))
+                        if thumbnails:
+                            st.image(
+                                [uri for _, uri in thumbnails],
+                                caption=[product for product, _ in thumbnails],
+                                width=96,
+                            )
+                    if len(messages) > history_length:
+                        self.queue_chat_turns(messages[history_length:])
+                status.update(
+                    label="**Response is ready!**", state="complete", expanded=True
+                )
+        cols = st.columns([20, 10, 20])
+        with cols[0]:
+            st.empty()
+        with cols[1]:
+            if len(st.session_state.get("messages", [])) > 1:
+                if st.button("Clear Chat", use_container_width=True):
+                    chatbot.clear_chat()
+                    self.delete_chat_history()
+                    st.session_state.chat_history_cursor = None
+                    st.rerun()
+        with cols[2]:
+            st.empty()
 
     def sidebar(self):
-        st.sidebar.write("# Your Account")
+        with st.sidebar:
+            st.write("# Your Account")
+            if "auth_warning" in st.session_state:
+                st.error(st.session_state.auth_warning)
+                del st.session_state.auth_warning
+            self.account_panel()
+            if self.is_premium_user():
+                with st.expander("**Click for Account Settings**"):
+                    self.account_settings()
 
-        if st.sidebar.button("**Sign Out**"):
+    @st.experimental_fragment
+    def account_panel(self):
+        if st.button("**Sign Out**"):
+            self.stop_live_view()
+            self.stop_token_manager()
             session_state_variables = [
                 "user_info",
                 "delete_account_warning_shown",
@@ -239,6 +494,11 @@ class App(FirebaseAuthenticator, RealtimeDB):
                 "auth_success",
                 "auth_warning",
                 "auth_error",
+                "messages",
+                "chat_window",
+                "chat_history_loaded",
+                "chat_history_cursor",
+                "live_version",
             ]
 
             for var in session_state_variables:
@@ -246,23 +506,14 @@ class App(FirebaseAuthenticator, RealtimeDB):
                     del st.session_state[var]
                 except KeyError:
                     continue
-            st.sidebar.success(
+            st.session_state.auth_success = """
+                ##### Signed out successfully.
+                - You have been signed out.
+                - Sign in to access your account.
                 """
-                    ##### Signed out successfully.
-                    - You have been signed out.
-                    - Sign in to access your account.
-                    """
-            )
-            time.sleep(2)
             st.rerun()
-        if (
-            st.session_state.user_info["fullUserInfo"]["users"][0]["localId"]
-            != "test_user_id"
-            and st.session_state.user_info["fullUserInfo"]["users"][0]["email"]
-            != "test_user_email"
-            and st.session_state.user_info["idToken"] != "test_id_token"
-        ):
-            with st.sidebar.expander("**Premium Access**"):
+        if self.is_premium_user():
+            with st.expander("**Premium Access**"):
                 st.write(
                     f"**Email:** {st.session_state.user_info['fullUserInfo']['users'][0]['email']}"
                 )
@@ -276,7 +527,7 @@ class App(FirebaseAuthenticator, RealtimeDB):
                     """
                 )
         else:
-            with st.sidebar.expander("**Guest Access**"):
+            with st.expander("**Guest Access**"):
 
                 st.warning(f"""### Your are in guest mode""")
                 st.warning(
@@ -287,16 +538,8 @@ class App(FirebaseAuthenticator, RealtimeDB):
                     **Upgrade to premium for more features!**
                     """
                 )
-        if (
-            st.session_state.user_info["fullUserInfo"]["users"][0]["localId"]
-            != "test_user_id"
-            and st.session_state.user_info["fullUserInfo"]["users"][0]["email"]
-            != "test_user_email"
-            and st.session_state.user_info["idToken"] != "test_id_token"
-        ):
-            with st.sidebar.expander("**Click for Account Settings**"):
-                self.account_settings()
 
+    @st.experimental_fragment
     def account_settings(self):
         with st.form(key="delete_account_form", clear_on_submit=True):
             st.subheader("Delete Account:")
@@ -309,9 +552,7 @@ class App(FirebaseAuthenticator, RealtimeDB):
                         with st.spinner("Deleting account"):
                             self.delete_account(password)
                         if "auth_success" in st.session_state:
-                            st.success(st.session_state.auth_success)
-                            del st.session_state.auth_success
-                            time.sleep(2)
+                            # The auth page shows the success message after the rerun
                             st.rerun()
                         elif "auth_warning" in st.session_state:
                             st.error(st.session_state.auth_warning)
@@ -0,0 +1,81 @@
+# NOTE: This file contains helpers for Firebase push keys, which sort in creation order.
+
+import random
+import threading
+import time
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+_lock = threading.Lock()
+_last_time = 0
+_last_random = []
+
+
+def _encode_time(millis: int) -> str:
+    chars = []
+    for _ in range(8):
+        chars.append(PUSH_CHARS[millis % 64])
+        millis //= 64
+    return "".join(reversed(chars))
+
+
+def generate_push_key(millis: int = None) -> str:
+    """
+    Generates a push key like the Firebase SDKs do.
+
+    The first 8 characters encode the creation time in milliseconds, so keys sort in
+    creation order, and keys generated in the same millisecond are strictly increasing.
+
+    Args:
+        millis (int): The creation time in milliseconds, or None for now.
+
+    Returns:
+        str: A 20-character push key.
+    """
+    global _last_time, _last_random
+    if millis is None:
+        millis = int(time.time() * 1000)
+    with _lock:
+        if millis == _last_time:
+            for index in range(11, -1, -1):
+                if _last_random[index] < 63:
+                    _last_random[index] += 1
+                    break
+                _last_random[index] = 0
+        else:
+            _last_random = [random.randrange(64) for _ in range(12)]
+            _last_time = millis
+        suffix = "".join(PUSH_CHARS[value] for value in _last_random)
+    return _encode_time(millis) + suffix
+
+
+def push_key_time(key: str) -> float:
+    """
+    Returns the creation time encoded in a push key.
+
+    Args:
+        key (str): A push key.
+
+    Returns:
+        float: The creation time as a UNIX timestamp in seconds.
+    """
+    millis = 0
+    for char in key[:8]:
+        millis = millis * 64 + PUSH_CHARS.index(char)
+    return millis / 1000
+
+
+def push_key_bound(timestamp: float, upper: bool = False) -> str:
+    """
+    Returns the smallest (or largest) possible push key for a point in time.
+
+    Args:
+        timestamp (float): A UNIX timestamp in seconds.
+        upper (bool): Whether to return the largest key of that millisecond.
+
+    Returns:
+        str: A key usable with `start_at` / `end_at` on an `order_by_key` query.
+    """
+    return _encode_time(int(timestamp * 1000)) + (
+        PUSH_CHARS[-1] * 12 if upper else PUSH_CHARS[0] * 12
+    )
@@ -1,8 +1,123 @@
+import copy
+import functools
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+from chat_history import decode_turn, encode_turn, get_chat_history_writer
 from credential_loader import Credentials
+from live_view import get_live_subscriptions
+from push_keys import generate_push_key, push_key_bound
+from sensor_aggregation import get_sensor_aggregator
+from sensor_cache import get_sensor_cache
+from sensor_writer import SensorQueueFull, get_sensor_writer
 import firebase
+import pandas as pd
+import requests
 import streamlit as st
 
 
+class FirebaseAppRegistry:
+    """
+    A process-level registry of Firebase apps.
+
+    Each distinct Firebase configuration is initialized once and its app and database
+    client are shared by every session. Sessions authenticate their own requests by
+    passing their ID token to each database call.
+
+    Attributes:
+        lock: Guards the registry against concurrent initialization.
+        entries: The initialized apps and database clients, keyed by configuration.
+        stats: Initialization metrics, keyed by configuration.
+
+    Methods:
+        get_app: Returns the Firebase app for a configuration, initializing it once.
+        database: Returns a database handle for a configuration.
+        metrics: Returns the initialization metrics.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {}
+
+    @staticmethod
+    def _config_key(config: dict) -> tuple:
+        return tuple(sorted(config.items()))
+
+    def _entry(self, config: dict) -> dict:
+        key = self._config_key(config)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.stats[key]["hits"] += 1
+            return entry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                started = time.perf_counter()
+                app = firebase.initialize_app(dict(config))
+                entry = {"app": app, "db": app.database()}
+                self.stats[key] = {
+                    "project_id": config.get("projectId"),
+                    "init_seconds": time.perf_counter() - started,
+                    "initialized_at": time.time(),
+                    "hits": 0,
+                }
+                self.entries[key] = entry
+            else:
+                self.stats[key]["hits"] += 1
+        return entry
+
+    def get_app(self, config: dict):
+        """
+        Returns the Firebase app for the given configuration, initializing it on first use.
+
+        Args:
+            config (dict): The Firebase configuration.
+
+        Returns:
+            The shared Firebase app instance.
+        """
+        return self._entry(config)["app"]
+
+    def database(self, config: dict):
+        """
+        Returns a database handle that shares the app's client and HTTP session.
+
+        The client keeps the path and query being built on the instance, so every
+        caller gets a shallow copy with its own query state.
+
+        Args:
+            config (dict): The Firebase configuration.
+
+        Returns:
+            A database handle for the shared Firebase app.
+        """
+        handle = copy.copy(self._entry(config)["db"])
+        handle.path = ""
+        handle.build_query = {}
+        return handle
+
+    def metrics(self) -> list:
+        """
+        Returns the initialization metrics for every registered app.
+
+        Returns:
+            list: One dict per app with its project ID, init time and cache hits.
+        """
+        return [dict(stats) for stats in self.stats.values()]
+
+
+@st.cache_resource(show_spinner=False)
+def get_firebase_registry() -> FirebaseAppRegistry:
+    """
+    Returns the process-wide Firebase app registry.
+
+    Returns:
+        FirebaseAppRegistry: The shared registry.
+    """
+    return FirebaseAppRegistry()
+
+
 class RealtimeDB(Credentials):
     """
     A class representing a Realtime Database.
@@ -18,16 +133,29 @@ class RealtimeDB(Credentials):
 
     Methods:
         push_sensor_data_for_user: Pushes new sensor data for the user.
+        push_sensor_readings_for_user: Queues several sensor readings for the user.
         get_sensor_data_for_user: Gets all the sensor data for the user.
+        get_latest_sensor_data_for_user: Gets the newest sensor readings for the user.
+        get_sensor_data_in_range_for_user: Gets the sensor readings of a time range.
+        get_sensor_data_page_for_user: Gets a page of sensor readings and the next cursor.
+        iter_sensor_data_for_user: Iterates over the sensor readings in chunks.
+        get_sensor_history_for_user: Gets the sensor history from the local cache, synced.
+        get_sensor_chart_for_user: Gets a sensor column downsampled for a chart.
         update_valve_status_for_user: Updates the valve_status for the user.
         get_valve_status_for_user: Gets the valve_status for the user.
         delete_sensor_data_for_user: Deletes all the sensor data for the user.
+        current_id_token: Returns the user's ID token, refreshed if needed.
+        end_expired_session: Signs the session out because its token could not be refreshed.
+        stop_live_view: Stops the user's live view when the session ends.
+        queue_chat_turns: Queues chat turns to be appended to the user's chat history.
+        load_chat_history: Loads a page of the user's chat history.
+        delete_chat_history: Deletes the user's chat history.
     """
 
     def __init__(self) -> None:
         super().__init__()
         try:
-            self.app = firebase.initialize_app(self.firebase_config)
+            self.app = get_firebase_registry().get_app(self.firebase_config)
         except Exception as e:
             st.error(
                 f"""
@@ -38,39 +166,121 @@ class RealtimeDB(Credentials):
             )
             st.stop()
         if st.session_state.get("user_info") is not None:
-            self.db = self.app.database()
+            self.db = get_firebase_registry().database(self.firebase_config)
             self.user_info = st.session_state.user_info["fullUserInfo"]
-            self.id_token = st.session_state.user_info["idToken"]
+            self.token_manager = st.session_state.get("token_manager")
+            try:
+                self.id_token = self.current_id_token()
+            except requests.exceptions.RequestException:
+                # The refresh token was revoked or the token service is unreachable
+                self.end_expired_session()
+
+    def end_expired_session(self) -> None:
+        """
+        Signs the session out because its ID token could not be refreshed.
+
+        The sign-in page shows the session-expired warning on the next run.
+
+        Returns:
+            None
+        """
+        self.stop_live_view()
+        if self.token_manager is not None:
+            self.token_manager.stop()
+        st.session_state.pop("token_manager", None)
+        st.session_state.pop("user_info", None)
+        self.token_manager = None
+        self.id_token = None
+        st.session_state.auth_warning = """
+            ##### Your session has expired.
+            - Please sign in again.
+            """
 
-    def push_sensor_data_for_user(self, data: dict) -> None:
+    def stop_live_view(self) -> None:
+        """
+        Stops the user's live view, so its streams stop using this session's token source.
+
+        Other sessions of the same user start a new view on their next run.
+
+        Returns:
+            None
+        """
+        user_info = st.session_state.get("user_info")
+        if user_info is None:
+            return
+        try:
+            subscriptions = get_live_subscriptions()
+            if subscriptions is not None:
+                subscriptions.stop(user_info["fullUserInfo"]["users"][0]["localId"])
+        except Exception as e:
+            pass
+
+    def push_sensor_data_for_user(self, data: dict) -> Optional[str]:
         """
         Sets the sensor data for the user.
 
+        The reading is queued and written in a batch by the sensor writer.
+
         Args:
             data (dict): The sensor data to set.
 
         Returns:
-            None
+            str: The push key of the reading, or None if it could not be queued.
         """
+        keys = self.push_sensor_readings_for_user([data])
+        return keys[0] if keys else None
+
+    def push_sensor_readings_for_user(self, readings: List[dict]) -> List[str]:
+        """
+        Queues sensor readings to be written for the user.
+
+        The readings get their push keys now and are kept in a local spool file until the
+        sensor writer has written them, in batches, with one multi-path update per batch.
+
+        Args:
+            readings (list): The readings, oldest first.
+
+        Returns:
+            list: The push key of every reading, or an empty list if the writer is full
+            or a reading cannot be stored.
+        """
+        uid = self.user_info["users"][0]["localId"]
         try:
-            uid = self.user_info["users"][0]["localId"]
-            self.db.child("users").child(uid).child("sensor_data").push(
-                data=data, token=self.id_token
+            return get_sensor_writer().enqueue(
+                uid,
+                functools.partial(
+                    get_firebase_registry().database, self.firebase_config
+                ),
+                self.current_id_token,
+                readings,
             )
-        except Exception as e:
+        except SensorQueueFull as e:
             st.error(
                 f"""
                 # There was an error pushing the sensor data.
-                - You may want to refresh the page.
+                - Too many readings are waiting to be written, please try again later.
                 - If the problem persists, please contact the developer.
                 """
             )
-            st.stop()
+            return []
+        except ValueError as e:
+            st.error(
+                f"""
+                # There was an error pushing the sensor data.
+                - The readings contain values that cannot be stored, e.g. NaN.
+                - If the problem persists, please contact the developer.
+                """
+            )
+            return []
 
     def get_sensor_data_for_user(self) -> dict:
         """
         Gets the all the sensor data for the user (from the first to the last data).
 
+        This downloads the whole history in one response; prefer the windowed
+        `get_latest_sensor_data_for_user`, `get_sensor_data_in_range_for_user` or
+        `iter_sensor_data_for_user` for long histories.
+
         Returns:
             dict: The sensor data for the user.
         """
@@ -93,6 +303,182 @@ class RealtimeDB(Credentials):
             )
             st.stop()
 
+    def _query_sensor_data(
+        self,
+        start_key: Optional[str] = None,
+        end_key: Optional[str] = None,
+        first: Optional[int] = None,
+        last: Optional[int] = None,
+    ) -> dict:
+        # Sensor readings are stored under push keys, so key order is time order
+        uid = self.user_info["users"][0]["localId"]
+        query = self.db.child("users").child(uid).child("sensor_data").order_by_key()
+        if start_key is not None:
+            query = query.start_at(start_key)
+        if end_key is not None:
+            query = query.end_at(end_key)
+        if first is not None:
+            query = query.limit_to_first(first)
+        if last is not None:
+            query = query.limit_to_last(last)
+        response = query.get(token=self.current_id_token())
+        # An empty filtered result cannot be converted by `val()`
+        readings = (response.val() if response.each() else None) or {}
+        return {key: readings[key] for key in sorted(readings)}
+
+    def _sensor_query_failed(self) -> None:
+        st.error(
+            f"""
+            # There was an error getting the sensor data.
+            - You may want to refresh the page.
+            - If the problem persists, please contact the developer.
+            """
+        )
+        st.stop()
+
+    def get_latest_sensor_data_for_user(self, limit: int = 100) -> dict:
+        """
+        Gets the newest sensor readings for the user.
+
+        Args:
+            limit (int): The maximum number of readings.
+
+        Returns:
+            dict: The readings keyed by push key, oldest first.
+        """
+        try:
+            return self._query_sensor_data(last=limit)
+        except Exception as e:
+            self._sensor_query_failed()
+
+    def get_sensor_data_in_range_for_user(
+        self, start: float, end: Optional[float] = None, limit: Optional[int] = None
+    ) -> dict:
+        """
+        Gets the sensor readings of a time range for the user.
+
+        Args:
+            start (float): The UNIX timestamp of the oldest reading to include.
+            end (float): The UNIX timestamp of the newest reading to include, or None for now.
+            limit (int): The maximum number of readings (the oldest ones), or None for all.
+
+        Returns:
+            dict: The readings keyed by push key, oldest first.
+        """
+        try:
+            return self._query_sensor_data(
+                start_key=push_key_bound(start),
+                end_key=None if end is None else push_key_bound(end, upper=True),
+                first=limit,
+            )
+        except Exception as e:
+            self._sensor_query_failed()
+
+    def get_sensor_data_page_for_user(
+        self,
+        limit: int = 500,
+        after_key: Optional[str] = None,
+        end_key: Optional[str] = None,
+    ) -> Tuple[dict, Optional[str]]:
+        """
+        Gets a page of sensor readings for the user, oldest first.
+
+        Args:
+            limit (int): The maximum number of readings.
+            after_key (str): Return readings after this key, or None to start at the oldest.
+            end_key (str): Do not return readings after this key, or None for no bound.
+
+        Returns:
+            tuple: The readings keyed by push key, and the key to pass as `after_key` for
+            the next page (None if this was the last page).
+        """
+        try:
+            # The start bound is inclusive, so one extra reading is requested and dropped
+            page = self._query_sensor_data(
+                start_key=after_key,
+                end_key=end_key,
+                first=limit if after_key is None else limit + 1,
+            )
+        except Exception as e:
+            self._sensor_query_failed()
+        page.pop(after_key, None)
+        keys = list(page)[:limit]
+        cursor = keys[-1] if len(keys) == limit else None
+        return {key: page[key] for key in keys}, cursor
+
+    def iter_sensor_data_for_user(
+        self,
+        chunk_size: int = 500,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> Iterator[dict]:
+        """
+        Iterates over the sensor readings of the user in chunks, oldest first.
+
+        Only one chunk is held in memory at a time, and each chunk is fetched when the
+        previous one has been consumed.
+
+        Args:
+            chunk_size (int): The maximum number of readings per chunk.
+            start (float): The UNIX timestamp of the oldest reading, or None for all.
+            end (float): The UNIX timestamp of the newest reading, or None for now.
+
+        Yields:
+            dict: The next chunk of readings keyed by push key.
+        """
+        # A key just below the first possible key of `start` makes the first page
+        # inclusive of it, as every later page is exclusive of its cursor
+        cursor = None if start is None else push_key_bound(start)[:-1]
+        end_key = None if end is None else push_key_bound(end, upper=True)
+        while True:
+            chunk, cursor = self.get_sensor_data_page_for_user(
+                chunk_size, cursor, end_key
+            )
+            if chunk:
+                yield chunk
+            if cursor is None:
+                return
+
+    def get_sensor_history_for_user(self) -> pd.DataFrame:
+        """
+        Gets the sensor history of the user as a frame from the local sensor cache.
+
+        Only the readings newer than the newest cached one are fetched from the database.
+
+        Returns:
+            pd.DataFrame: The readings indexed by push key, oldest first, with a `time`
+            column. The frame is shared and must not be modified.
+        """
+        uid = self.user_info["users"][0]["localId"]
+        try:
+            return get_sensor_cache().refresh(uid, self.get_sensor_data_page_for_user)
+        except Exception as e:
+            self._sensor_query_failed()
+
+    def get_sensor_chart_for_user(
+        self,
+        column: str,
+        max_points: int = 2000,
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+    ) -> pd.DataFrame:
+        """
+        Gets a sensor column of the user, bucketed or downsampled for a chart.
+
+        Args:
+            column (str): The numeric sensor column, e.g. "temperature".
+            max_points (int): The maximum number of points.
+            start (pd.Timestamp): The first time to include, or None.
+            end (pd.Timestamp): The last time to include, or None.
+
+        Returns:
+            pd.DataFrame: The `time` and `column` of at most about `max_points` points.
+        """
+        uid = self.user_info["users"][0]["localId"]
+        return get_sensor_aggregator().chart(
+            uid, self.get_sensor_history_for_user(), column, max_points, start, end
+        )
+
     def update_valve_status_for_user(self, valve_status: str) -> None:
         """
         Updates the valve_status for the user.
@@ -143,18 +529,21 @@ class RealtimeDB(Credentials):
         """
         Deletes all the sensor data for the user.
         Also deletes the valve_status field for the user.
+        Readings still queued for writing are discarded first.
 
         Returns:
             None
         """
         try:
             uid = self.user_info["users"][0]["localId"]
+            get_sensor_writer().drop(uid)
             self.db.child("users").child(uid).child("sensor_data").remove(
                 token=self.id_token
             )
             self.db.child("users").child(uid).child("valve_status").remove(
                 token=self.id_token
             )
+            get_sensor_cache().invalidate(uid)
         except Exception as e:
             st.error(
                 f"""
@@ -164,3 +553,103 @@ class RealtimeDB(Credentials):
                 """
             )
             st.stop()
+
+    def current_id_token(self) -> str:
+        """
+        Returns the user's ID token, refreshed by the token manager if it is about to expire.
+
+        Returns:
+            str: The ID token.
+        """
+        if self.token_manager is not None:
+            return self.token_manager.id_token
+        return st.session_state.user_info["idToken"]
+
+    def queue_chat_turns(self, messages: List[dict]) -> None:
+        """
+        Queues chat turns to be appended to the user's chat history.
+
+        The turns get their push keys now and are written in batches by a background
+        writer, so persisting them does not delay the chat.
+
+        Args:
+            messages (list): The chat messages to append, oldest first.
+
+        Returns:
+            None
+        """
+        uid = self.user_info["users"][0]["localId"]
+        turns = [(generate_push_key(), encode_turn(message)) for message in messages]
+        get_chat_history_writer().enqueue(
+            uid,
+            functools.partial(get_firebase_registry().database, self.firebase_config),
+            self.current_id_token,
+            turns,
+        )
+
+    def load_chat_history(
+        self, limit: int = 20, before_key: Optional[str] = None
+    ) -> Tuple[List[dict], Optional[str]]:
+        """
+        Loads a page of the user's chat history, newest page first.
+
+        Args:
+            limit (int): The maximum number of turns to load.
+            before_key (str): Load the turns before this key, or None for the newest turns.
+
+        Returns:
+            tuple: The turns oldest first, and the key to pass as `before_key` for the
+            previous page (None if there are no older turns).
+        """
+        try:
+            uid = self.user_info["users"][0]["localId"]
+            query = (
+                self.db.child("users")
+                .child(uid)
+                .child("chat_history")
+                .order_by_key()
+            )
+            if before_key is not None:
+                query = query.end_at(before_key).limit_to_last(limit + 1)
+            else:
+                query = query.limit_to_last(limit)
+            response = query.get(token=self.current_id_token())
+            # An empty filtered result cannot be converted by `val()`
+            page = (response.val() if response.each() else None) or {}
+        except Exception as e:
+            st.error(
+                f"""
+                # There was an error loading the chat history.
+                - You may want to refresh the page.
+                - If the problem persists, please contact the developer.
+                """
+            )
+            return [], None
+        keys = sorted(key for key in page if key != before_key)[-limit:]
+        cursor = keys[0] if len(keys) == limit else None
+        return [decode_turn(page[key]) for key in keys], cursor
+
+    def delete_chat_history(self) -> None:
+        """
+        Deletes the user's chat history.
+
+        Turns still queued for writing are dropped first, so they do not bring the
+        history back after it was deleted.
+
+        Returns:
+            None
+        """
+        try:
+            uid = self.user_info["users"][0]["localId"]
+            get_chat_history_writer().discard(uid)
+            self.db.child("users").child(uid).child("chat_history").remove(
+                token=self.current_id_token()
+            )
+        except Exception as e:
+            st.error(
+                f"""
+                # There was an error deleting the chat history.
+                - You may want to refresh the page.
+                - If the problem persists, please contact the developer.
+                """
+            )
@@ -0,0 +1,252 @@
+# NOTE: This file contains the ResponseCache class that is used to reuse chatbot answers across sessions.
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import streamlit as st
+
+from credential_loader import get_settings
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.,;:]+$")
+
+
+def exact_key(model: str, messages: List[dict]) -> str:
+    """
+    Returns the cache key of a prompt as sent.
+
+    Args:
+        model (str): The model name.
+        messages (list): The messages sent to the model.
+
+    Returns:
+        str: A hex digest of the model and the messages.
+    """
+    payload = json.dumps(
+        [model, [[m["role"], m["content"]] for m in messages]], ensure_ascii=False
+    )
+    return "x:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def normalized_key(model: str, messages: List[dict]) -> str:
+    """
+    Returns the cache key of a prompt after normalization.
+
+    Case, runs of whitespace and trailing punctuation are ignored, so "Recommend a book?"
+    and "recommend a  book" share a key.
+
+    Args:
+        model (str): The model name.
+        messages (list): The messages sent to the model.
+
+    Returns:
+        str: A hex digest of the model and the normalized messages.
+    """
+    normalized = [
+        [
+            m["role"],
+            _TRAILING_PUNCTUATION.sub("", _WHITESPACE.sub(" ", m["content"]))
+            .strip()
+            .lower(),
+        ]
+        for m in messages
+    ]
+    payload = json.dumps([model, normalized], ensure_ascii=False)
+    return "n:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    A process-shared LRU cache of chatbot answers with a TTL and an optional sqlite tier.
+
+    Answers are stored under the exact and the normalized key of their prompt. Lookups try
+    the exact key first. Entries evicted from memory stay in the sqlite file (if configured),
+    which also survives restarts. Expired and surplus disk rows are trimmed every
+    `trim_every` writes rather than on each write, and the disk tier has its own lock, so
+    memory hits never wait for sqlite.
+
+    Attributes:
+        max_entries (int): The maximum number of keys kept in memory.
+        ttl (float): How long an answer stays valid, in seconds.
+        disk_path (str): Path of the sqlite file, or None for a memory-only cache.
+        max_disk_entries (int): The maximum number of keys kept on disk.
+        trim_every (int): How many writes happen between two trims of the disk tier.
+        stats (dict): Hit, miss, eviction and write counters.
+
+    Methods:
+        get: Returns the cached answer of a prompt.
+        put: Stores the answer of a prompt.
+        clear: Empties both tiers.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        disk_path: Optional[str] = None,
+        max_disk_entries: int = 100000,
+        trim_every: int = 100,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self.trim_every = trim_every
+        self.stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "writes": 0,
+        }
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._writes_since_trim = 0
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at)"
+            )
+            self._db.commit()
+
+    def _remember(self, key: str, answer: str, expires_at: float) -> None:
+        self._memory[key] = (answer, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _lookup(self, key: str, now: float) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            del self._memory[key]
+        return None
+
+    def _lookup_disk(self, keys: tuple, now: float) -> Optional[str]:
+        with self._disk_lock:
+            for key in keys:
+                row = self._db.execute(
+                    "SELECT answer, expires_at FROM responses "
+                    "WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    break
+            else:
+                return None
+        with self._lock:
+            self._remember(key, row[0], row[1])
+            self.stats["disk_hits"] += 1
+        return row[0]
+
+    def _trim(self) -> None:
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+
+    def get(self, model: str, messages: List[dict]) -> Optional[str]:
+        """
+        Returns the cached answer of a prompt.
+
+        Args:
+            model (str): The model name.
+            messages (list): The messages sent to the model.
+
+        Returns:
+            str: The cached answer, or None on a miss.
+        """
+        now = time.time()
+        keys = (exact_key(model, messages), normalized_key(model, messages))
+        with self._lock:
+            for key in keys:
+                answer = self._lookup(key, now)
+                if answer is not None:
+                    return answer
+        if self._db is not None:
+            answer = self._lookup_disk(keys, now)
+            if answer is not None:
+                return answer
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, model: str, messages: List[dict], answer: str) -> None:
+        """
+        Stores the answer of a prompt under its exact and normalized keys.
+
+        Args:
+            model (str): The model name.
+            messages (list): The messages sent to the model.
+            answer (str): The complete answer.
+        """
+        if not answer:
+            return
+        expires_at = time.time() + self.ttl
+        keys = (exact_key(model, messages), normalized_key(model, messages))
+        with self._lock:
+            for key in keys:
+                self._remember(key, answer, expires_at)
+            self.stats["writes"] += 1
+        if self._db is None:
+            return
+        with self._disk_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                [(key, answer, expires_at) for key in keys],
+            )
+            self._writes_since_trim += 1
+            if self._writes_since_trim >= self.trim_every:
+                self._writes_since_trim = 0
+                self._trim()
+            self._db.commit()
+
+    def clear(self) -> None:
+        """
+        Empties both tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            with self._disk_lock:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """
+    Returns the process-wide response cache.
+
+    It is configured by an optional `[chat_cache]` section in the secrets file with
+    `max_entries`, `ttl`, `disk_path`, `max_disk_entries` and `trim_every`.
+
+    Returns:
+        ResponseCache: The shared cache.
+    """
+    settings = get_settings("chat_cache")
+    return ResponseCache(
+        max_entries=int(settings.get("max_entries", 1024)),
+        ttl=float(settings.get("ttl", 3600)),
+        disk_path=settings.get("disk_path"),
+        max_disk_entries=int(settings.get("max_disk_entries", 100000)),
+        trim_every=int(settings.get("trim_every", 100)),
+    )
@@ -0,0 +1,242 @@
+# NOTE: This file contains the ProductRetriever class that is used to ground chatbot answers in the product catalog.
+
+import hashlib
+import os
+import re
+import zlib
+from typing import List
+
+import numpy as np
+import streamlit as st
+
+from catalog import CATALOG_PATH, ProductCatalog, get_catalog
+
+DIMENSIONS = 2**18
+CACHE_DIR = ".cache/retrieval"
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+# Words that carry no product meaning; they are ignored in queries
+STOPWORDS = frozenset(
+    """
+    a about am an and any are as at be been but by can could do does for from have
+    how i if in is it its me my need of on or please recommend should show some
+    something that the this to want was what when where which who will with would
+    you your
+    """.split()
+)
+
+
+def hash_terms(text: str, stopwords: frozenset = frozenset()) -> np.ndarray:
+    """
+    Tokenizes a text and hashes its words into term IDs.
+
+    Args:
+        text (str): The text.
+        stopwords (frozenset): Words to leave out.
+
+    Returns:
+        np.ndarray: The term ID of every word, in order.
+    """
+    words = [word for word in _WORD.findall(text.lower()) if word not in stopwords]
+    return np.fromiter(
+        (zlib.crc32(word.encode("utf-8")) % DIMENSIONS for word in words),
+        dtype=np.int32,
+        count=len(words),
+    )
+
+
+def _row_text(product: str, category: str, description: str) -> str:
+    return " ".join([product, category, category, description])
+
+
+class ProductRetriever:
+    """
+    A hashed TF-IDF index over the catalog's product, category and description text.
+
+    Term frequencies are stored per row in CSR form and persisted to disk keyed by a hash
+    of each row's text, so a rebuild only tokenizes rows that changed. Weights are
+    normalized TF-IDF, and the index is kept as sorted posting lists, so a query only
+    touches the postings of its own terms.
+
+    Attributes:
+        catalog (ProductCatalog): The indexed catalog.
+        row_hashes (np.ndarray): The text hash of every row.
+        idf (np.ndarray): The inverse document frequency of every term ID.
+        posting_terms (np.ndarray): The term ID of every posting, sorted.
+        posting_rows (np.ndarray): The row of every posting.
+        posting_weights (np.ndarray): The normalized weight of every posting.
+
+    Methods:
+        search: Returns the best matching products for a query.
+        save: Persists the per-row term frequencies.
+    """
+
+    def __init__(self, catalog: ProductCatalog, cache_path: str = None) -> None:
+        self.catalog = catalog
+        self.cache_path = cache_path
+        frame = catalog.frame
+        texts = [
+            _row_text(str(product), str(category), str(description))
+            for product, category, description in zip(
+                frame["Product"], frame["Category"], frame["Description"]
+            )
+        ]
+        self.row_hashes = np.array(
+            [hashlib.sha1(text.encode("utf-8")).hexdigest() for text in texts]
+        )
+        terms, counts, lengths = self._term_frequencies(texts)
+        self._terms, self._counts, self._lengths = terms, counts, lengths
+        self._build(terms, counts, lengths)
+
+    def _load_saved(self) -> dict:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            saved = np.load(self.cache_path)
+            indptr = np.concatenate([[0], np.cumsum(saved["lengths"])])
+            return {
+                row_hash: (saved["terms"][start:end], saved["counts"][start:end])
+                for row_hash, start, end in zip(
+                    saved["row_hashes"], indptr[:-1], indptr[1:]
+                )
+            }
+        except Exception:
+            return {}
+
+    def _term_frequencies(self, texts: List[str]) -> tuple:
+        saved = self._load_saved()
+        terms, counts, lengths = [], [], []
+        for row_hash, text in zip(self.row_hashes, texts):
+            cached = saved.get(row_hash)
+            if cached is None:
+                cached = np.unique(hash_terms(text), return_counts=True)
+            terms.append(cached[0].astype(np.int32))
+            counts.append(cached[1].astype(np.int32))
+            lengths.append(len(cached[0]))
+        self._changed = len(saved) != len(texts) or any(
+            row_hash not in saved for row_hash in self.row_hashes
+        )
+        empty = np.empty(0, dtype=np.int32)
+        return (
+            np.concatenate(terms) if terms else empty,
+            np.concatenate(counts) if counts else empty,
+            np.array(lengths, dtype=np.int64),
+        )
+
+    def _build(self, terms: np.ndarray, counts: np.ndarray, lengths: np.ndarray):
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        documents = max(len(lengths), 1)
+        frequency = np.bincount(terms, minlength=DIMENSIONS)
+        self.idf = (np.log((1 + documents) / (1 + frequency)) + 1).astype(np.float32)
+        weights = (1 + np.log(counts)) * self.idf[terms]
+        norms = np.sqrt(np.bincount(rows, weights=weights**2, minlength=len(lengths)))
+        weights = weights / np.where(norms > 0, norms, 1)[rows]
+        order = np.argsort(terms, kind="stable")
+        self.posting_terms = terms[order]
+        self.posting_rows = rows[order]
+        self.posting_weights = weights[order].astype(np.float32)
+
+    def save(self) -> None:
+        """
+        Persists the per-row term frequencies if any row changed since the last save.
+        """
+        if not self.cache_path or not self._changed:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temporary = self.cache_path + ".tmp.npz"
+        np.savez_compressed(
+            temporary,
+            row_hashes=self.row_hashes,
+            terms=self._terms,
+            counts=self._counts,
+            lengths=self._lengths,
+        )
+        os.replace(temporary, self.cache_path)
+        self._changed = False
+
+    def search(self, query: str, k: int = 3, min_score: float = 0.1):
+        """
+        Returns the best matching products for a query.
+
+        Stopwords in the query are ignored, and the score is the cosine similarity of the
+        query and the product, so a product needs a real overlap to be returned.
+
+        Args:
+            query (str): The user's question.
+            k (int): The maximum number of products.
+            min_score (float): The lowest score of a returned product, from 0 to 1.
+
+        Returns:
+            pd.DataFrame: Up to `k` products scoring at least `min_score`, best match
+            first, with an added `Score` column.
+        """
+        query_terms, query_counts = np.unique(
+            hash_terms(query, STOPWORDS), return_counts=True
+        )
+        if not len(query_terms) or not len(self.posting_terms):
+            return self.catalog.frame.iloc[:0]
+        starts = np.searchsorted(self.posting_terms, query_terms, "left")
+        ends = np.searchsorted(self.posting_terms, query_terms, "right")
+        lengths = ends - starts
+        if not lengths.sum():
+            return self.catalog.frame.iloc[:0]
+        # Flattened indexes of all postings of all query terms
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+        query_weights = (1 + np.log(query_counts)) * self.idf[query_terms]
+        query_weights /= np.sqrt((query_weights**2).sum())
+        scores = np.bincount(
+            self.posting_rows[positions],
+            weights=self.posting_weights[positions]
+            * np.repeat(query_weights, lengths),
+            minlength=len(self.row_hashes),
+        )
+        k = min(k, int((scores >= max(min_score, 1e-9)).sum()))
+        if not k:
+            return self.catalog.frame.iloc[:0]
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return self.catalog.frame.iloc[best].assign(Score=scores[best])
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _load_retriever(path: str, modified: float) -> ProductRetriever:
+    name = os.path.splitext(os.path.basename(path))[0]
+    retriever = ProductRetriever(
+        get_catalog(path), os.path.join(CACHE_DIR, name + ".npz")
+    )
+    retriever.save()
+    return retriever
+
+
+def get_retriever(path: str = CATALOG_PATH) -> ProductRetriever:
+    """
+    Returns the process-wide retriever, rebuilt only when the catalog file changes.
+
+    Args:
+        path (str): The path of the catalog CSV.
+
+    Returns:
+        ProductRetriever: The shared retriever.
+    """
+    return _load_retriever(path, os.stat(path).st_mtime)
+
+
+def format_products(products) -> str:
+    """
+    Formats retrieved products as a system message for the chatbot.
+
+    Args:
+        products (pd.DataFrame): The retrieved products.
+
+    Returns:
+        str: One line per product.
+    """
+    lines = [
+        "- {0} (${1:.2f}, {2}): {3}".format(
+            row.Product, row.Price, row.Category, row.Description
+        )
+        for row in products.itertuples()
+    ]
+    return "Products from our catalog that may be relevant:\n" + "\n".join(lines)
@@ -0,0 +1,313 @@
+# NOTE: This file contains the SensorAggregator class that is used to bucket and downsample sensor time series for charts.
+
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from credential_loader import get_settings
+
+# Bucket widths in nanoseconds
+RESOLUTIONS = {
+    "minute": 60 * 10**9,
+    "hour": 3600 * 10**9,
+    "day": 86400 * 10**9,
+}
+
+
+def series_arrays(
+    frame: pd.DataFrame,
+    column: str,
+    start: Optional[pd.Timestamp] = None,
+    end: Optional[pd.Timestamp] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the times and values of one sensor column as NumPy arrays.
+
+    Args:
+        frame (pd.DataFrame): Sensor readings with a sorted `time` column.
+        column (str): The numeric column.
+        start (pd.Timestamp): The first time to include, or None.
+        end (pd.Timestamp): The last time to include, or None.
+
+    Returns:
+        tuple: The times as int64 nanoseconds since the epoch and the float64 values,
+        without missing values. Both are empty if the frame has no such numeric column.
+    """
+    if (
+        column not in frame.columns
+        or "time" not in frame.columns
+        or not pd.api.types.is_numeric_dtype(frame[column])
+    ):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    times = pd.DatetimeIndex(frame["time"]).tz_convert("UTC").as_unit("ns").asi8
+    low = 0 if start is None else np.searchsorted(times, pd.Timestamp(start).value)
+    high = (
+        len(times)
+        if end is None
+        else np.searchsorted(times, pd.Timestamp(end).value, "right")
+    )
+    values = frame[column].to_numpy(dtype=np.float64, na_value=np.nan)[low:high]
+    times = times[low:high]
+    present = ~np.isnan(values)
+    return times[present], values[present]
+
+
+def bucket_aggregate(times: np.ndarray, values: np.ndarray, width: int) -> pd.DataFrame:
+    """
+    Computes the min, max, mean, last value and count of fixed-width time buckets.
+
+    Args:
+        times (np.ndarray): Sorted int64 nanosecond timestamps.
+        values (np.ndarray): The float64 value at every timestamp.
+        width (int): The bucket width in nanoseconds.
+
+    Returns:
+        pd.DataFrame: One row per non-empty bucket with `time` (the bucket start), `min`,
+        `max`, `mean`, `last` and `count`.
+    """
+    if not len(times):
+        return pd.DataFrame(
+            {
+                "time": pd.DatetimeIndex([], tz="UTC"),
+                **{name: [] for name in ("min", "max", "mean", "last", "count")},
+            }
+        )
+    buckets = times // width
+    # Times are sorted, so each bucket is a contiguous run
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[starts, len(values)])
+    return pd.DataFrame(
+        {
+            "time": pd.to_datetime(buckets[starts] * width, unit="ns", utc=True),
+            "min": np.minimum.reduceat(values, starts),
+            "max": np.maximum.reduceat(values, starts),
+            "mean": np.add.reduceat(values, starts) / counts,
+            "last": values[starts + counts - 1],
+            "count": counts,
+        }
+    )
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Selects the points that best preserve the shape of a series (Largest-Triangle-Three-
+    Buckets).
+
+    The first and last points are always kept. The points in between are split into
+    `threshold - 2` buckets, and from each bucket the point that forms the largest
+    triangle with the previously selected point and the average of the next bucket is
+    kept. The triangle areas of a bucket are computed in one vectorized step.
+
+    Args:
+        x (np.ndarray): The sorted x values.
+        y (np.ndarray): The y values.
+        threshold (int): The number of points to keep.
+
+    Returns:
+        np.ndarray: The indexes of the kept points, sorted.
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    x = x.astype(np.float64)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    # The average point of every bucket, used as the third triangle corner
+    sums_x = np.add.reduceat(x[: count - 1], edges[:-1])
+    sums_y = np.add.reduceat(y[: count - 1], edges[:-1])
+    sizes = np.diff(edges)
+    average_x = np.r_[sums_x / sizes, x[-1]]
+    average_y = np.r_[sums_y / sizes, y[-1]]
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        low, high = edges[bucket], edges[bucket + 1]
+        ax, ay = x[previous], y[previous]
+        cx, cy = average_x[bucket + 1], average_y[bucket + 1]
+        areas = np.abs(
+            (ax - cx) * (y[low:high] - ay) - (ax - x[low:high]) * (cy - ay)
+        )
+        previous = low + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+class SensorAggregator:
+    """
+    Aggregates and downsamples sensor history for charts, with an LRU cache of results.
+
+    Results are cached per user, column, time range and resolution (or point budget). The
+    cache key includes the newest push key and the length of the history, so new readings
+    make earlier results unreachable instead of returning stale ones.
+
+    Attributes:
+        max_entries (int): The maximum number of cached results.
+        stats (dict): Hit and miss counters.
+
+    Methods:
+        buckets: Returns bucketed min/max/mean/last values of a column.
+        downsample: Returns at most `max_points` representative points of a column.
+        chart: Returns a column ready to chart, bucketed or downsampled.
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(frame: pd.DataFrame) -> tuple:
+        return (len(frame), frame.index[-1] if len(frame) else None)
+
+    def _cached(self, key: tuple, compute):
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.stats["hits"] += 1
+                return result
+            self.stats["misses"] += 1
+        result = compute()
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        return result
+
+    def buckets(
+        self,
+        uid: str,
+        frame: pd.DataFrame,
+        column: str,
+        resolution: str = "hour",
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns bucketed min/max/mean/last values of a column.
+
+        Args:
+            uid (str): The user's ID, part of the cache key.
+            frame (pd.DataFrame): The user's sensor history.
+            column (str): The numeric column.
+            resolution (str): "minute", "hour" or "day".
+            start (pd.Timestamp): The first time to include, or None.
+            end (pd.Timestamp): The last time to include, or None.
+
+        Returns:
+            pd.DataFrame: One row per non-empty bucket, see `bucket_aggregate`.
+        """
+        key = ("buckets", uid, column, resolution, start, end, self._version(frame))
+        return self._cached(
+            key,
+            lambda: bucket_aggregate(
+                *series_arrays(frame, column, start, end), RESOLUTIONS[resolution]
+            ),
+        )
+
+    def downsample(
+        self,
+        uid: str,
+        frame: pd.DataFrame,
+        column: str,
+        max_points: int = 2000,
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns at most `max_points` points of a column that keep the shape of the series.
+
+        Args:
+            uid (str): The user's ID, part of the cache key.
+            frame (pd.DataFrame): The user's sensor history.
+            column (str): The numeric column.
+            max_points (int): The maximum number of points.
+            start (pd.Timestamp): The first time to include, or None.
+            end (pd.Timestamp): The last time to include, or None.
+
+        Returns:
+            pd.DataFrame: The `time` and `column` of the kept points.
+        """
+
+        key = ("lttb", uid, column, max_points, start, end, self._version(frame))
+        return self._cached(
+            key,
+            lambda: self._downsampled(
+                *series_arrays(frame, column, start, end), column, max_points
+            ),
+        )
+
+    @staticmethod
+    def _downsampled(
+        times: np.ndarray, values: np.ndarray, column: str, max_points: int
+    ) -> pd.DataFrame:
+        kept = lttb(times, values, max_points)
+        return pd.DataFrame(
+            {
+                "time": pd.to_datetime(times[kept], unit="ns", utc=True),
+                column: values[kept],
+            }
+        )
+
+    def chart(
+        self,
+        uid: str,
+        frame: pd.DataFrame,
+        column: str,
+        max_points: int = 2000,
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns a column ready to chart with at most about `max_points` points.
+
+        The finest resolution whose bucket count fits `max_points` is used, with the bucket
+        mean as the value; if even daily buckets do not fit, the series is downsampled. The
+        result is cached, so a rerun without new readings does not touch the history.
+
+        Args:
+            uid (str): The user's ID, part of the cache key.
+            frame (pd.DataFrame): The user's sensor history.
+            column (str): The numeric column.
+            max_points (int): The maximum number of points.
+            start (pd.Timestamp): The first time to include, or None.
+            end (pd.Timestamp): The last time to include, or None.
+
+        Returns:
+            pd.DataFrame: The `time` and `column` of the points.
+        """
+
+        def compute():
+            times, values = series_arrays(frame, column, start, end)
+            if len(times) > max_points:
+                span = int(times[-1] - times[0])
+                for width in RESOLUTIONS.values():
+                    if span // width + 1 <= max_points:
+                        buckets = bucket_aggregate(times, values, width)
+                        return buckets[["time", "mean"]].rename(
+                            columns={"mean": column}
+                        )
+            return self._downsampled(times, values, column, max_points)
+
+        key = ("chart", uid, column, max_points, start, end, self._version(frame))
+        return self._cached(key, compute)
+
+
+@st.cache_resource(show_spinner=False)
+def get_sensor_aggregator() -> SensorAggregator:
+    """
+    Returns the process-wide sensor aggregator.
+
+    The size of its result cache can be set with `max_entries` in an optional
+    `[sensor_aggregation]` section in the secrets file.
+
+    Returns:
+        SensorAggregator: The shared aggregator.
+    """
+    settings = get_settings("sensor_aggregation")
+    return SensorAggregator(max_entries=int(settings.get("max_entries", 256)))
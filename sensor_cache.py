@@ -0,0 +1,321 @@
+# NOTE: This file contains the SensorCache class that is used to sync sensor history incrementally into local columnar storage.
+
+import glob
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from credential_loader import get_settings
+from push_keys import PUSH_CHARS
+
+CACHE_DIR = ".cache/sensors"
+
+_PUSH_CHAR_VALUES = np.full(128, -1, dtype=np.int64)
+_PUSH_CHAR_VALUES[[ord(char) for char in PUSH_CHARS]] = np.arange(len(PUSH_CHARS))
+
+
+def push_key_times(keys) -> pd.DatetimeIndex:
+    """
+    Decodes the creation times of many push keys at once.
+
+    Args:
+        keys (Iterable): Push keys.
+
+    Returns:
+        pd.DatetimeIndex: The UTC creation time of every key.
+    """
+    prefixes = np.array([key[:8] for key in keys], dtype="S8")
+    if not len(prefixes):
+        return pd.DatetimeIndex([], tz="UTC")
+    digits = _PUSH_CHAR_VALUES[prefixes.view(np.uint8).reshape(-1, 8)]
+    millis = digits @ (64 ** np.arange(7, -1, -1, dtype=np.int64))
+    return pd.to_datetime(millis, unit="ms", utc=True)
+
+
+def readings_to_frame(readings: dict) -> pd.DataFrame:
+    """
+    Converts sensor readings keyed by push key to a typed frame.
+
+    Nested fields are flattened to dotted column names, columns whose values are all
+    numeric become float64, and a `time` column holds the creation time of each key.
+
+    Args:
+        readings (dict): The readings keyed by push key.
+
+    Returns:
+        pd.DataFrame: One row per reading, indexed by push key in key order.
+    """
+    keys = sorted(readings)
+    records = [readings[key] for key in keys]
+    frame = pd.json_normalize(
+        [record if isinstance(record, dict) else {"value": record} for record in records]
+    )
+    frame.index = pd.Index(keys, name="key")
+    for column in frame.columns:
+        values = frame[column]
+        numeric = pd.to_numeric(values, errors="coerce")
+        if numeric.notna().sum() == values.notna().sum():
+            frame[column] = numeric.astype("float64")
+        else:
+            frame[column] = values.astype("string")
+    frame.insert(0, "time", push_key_times(keys))
+    return frame
+
+
+def concat_frames(frames: list) -> pd.DataFrame:
+    """
+    Concatenates reading frames under one schema.
+
+    `readings_to_frame` types each batch on its own, so a field can be numeric in one
+    batch and text in another. A column that is text in any frame is stored as text in
+    all of them, so the result and the Parquet parts written from it have one type per
+    column.
+
+    Args:
+        frames (list): Frames from `readings_to_frame` or earlier concatenations.
+
+    Returns:
+        pd.DataFrame: The concatenated frame.
+    """
+    frames = [frame for frame in frames if len(frame.columns)]
+    text = {
+        column
+        for frame in frames
+        for column, dtype in frame.dtypes.items()
+        if column != "time" and not pd.api.types.is_float_dtype(dtype)
+    }
+    frames = [
+        frame.astype({column: "string" for column in text if column in frame.columns})
+        for frame in frames
+    ]
+    return pd.concat(frames)
+
+
+class SensorCache:
+    """
+    A per-user cache of sensor history on disk (Parquet) and in memory (pandas).
+
+    Each user's history is stored as Parquet parts named by their first push key. A
+    refresh only asks the database for readings after the newest cached key and appends
+    them as a new part, so its cost grows with the number of new readings rather than
+    the length of the history. Parts are compacted once there are more than `max_parts`.
+    All parts of a user share one schema: a field that ever held text is text in every
+    part (see `concat_frames`).
+    The frames of the most recently used `max_users` users are kept in memory.
+
+    Attributes:
+        cache_dir (str): The directory of the Parquet parts.
+        max_users (int): The maximum number of user frames kept in memory.
+        chunk_size (int): The number of readings fetched per request during a refresh.
+        max_parts (int): The number of parts per user that triggers a compaction.
+        stats (dict): Memory hit, disk load, refresh, fetched reading and failed
+            compaction counters.
+
+    Methods:
+        frame: Returns the cached history of a user without contacting the database.
+        refresh: Fetches a user's new readings and returns the updated history.
+        merge: Adds readings that were just written to a user's cached history.
+        invalidate: Drops a user's history from memory and disk.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = CACHE_DIR,
+        max_users: int = 32,
+        chunk_size: int = 1000,
+        max_parts: int = 16,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_users = max_users
+        self.chunk_size = chunk_size
+        self.max_parts = max_parts
+        self.stats = {
+            "memory_hits": 0,
+            "disk_loads": 0,
+            "refreshes": 0,
+            "fetched": 0,
+            "failed_compactions": 0,
+        }
+        self._frames = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _user_dir(self, uid: str) -> str:
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(uid.encode("utf-8")).hexdigest()
+        )
+
+    def _user_lock(self, uid: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(uid, threading.Lock())
+
+    def _remember(self, uid: str, frame: pd.DataFrame) -> None:
+        with self._lock:
+            self._frames[uid] = frame
+            self._frames.move_to_end(uid)
+            while len(self._frames) > self.max_users:
+                self._frames.popitem(last=False)
+
+    def _parts(self, uid: str) -> list:
+        return sorted(glob.glob(os.path.join(self._user_dir(uid), "part-*.parquet")))
+
+    def _load(self, uid: str) -> pd.DataFrame:
+        parts = self._parts(uid)
+        if not parts:
+            return pd.DataFrame(
+                {"time": pd.DatetimeIndex([], tz="UTC")},
+                index=pd.Index([], name="key", dtype="object"),
+            )
+        frame = concat_frames([pd.read_parquet(part) for part in parts])
+        # A compaction interrupted between writing and removing parts leaves duplicates
+        return frame[~frame.index.duplicated(keep="last")].sort_index()
+
+    def _write_part(self, uid: str, frame: pd.DataFrame) -> str:
+        directory = self._user_dir(uid)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha1("".join(frame.index).encode("utf-8")).hexdigest()[:8]
+        path = os.path.join(
+            directory, "part-{0}-{1}.parquet".format(frame.index[0], digest)
+        )
+        frame.to_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def frame(self, uid: str) -> pd.DataFrame:
+        """
+        Returns the cached history of a user without contacting the database.
+
+        Args:
+            uid (str): The user's ID.
+
+        Returns:
+            pd.DataFrame: The readings indexed by push key, oldest first. The frame is
+            shared and must not be modified.
+        """
+        with self._lock:
+            frame = self._frames.get(uid)
+            if frame is not None:
+                self._frames.move_to_end(uid)
+                self.stats["memory_hits"] += 1
+                return frame
+        frame = self._load(uid)
+        self.stats["disk_loads"] += 1
+        self._remember(uid, frame)
+        return frame
+
+    def refresh(self, uid: str, fetch_page: Callable) -> pd.DataFrame:
+        """
+        Fetches a user's readings newer than the cached ones and returns the updated
+        history.
+
+        Concurrent refreshes of the same user are serialized, so the second one only
+        fetches what arrived in between.
+
+        Args:
+            uid (str): The user's ID.
+            fetch_page (Callable): Called as `fetch_page(limit, after_key)` and returns
+                (readings keyed by push key, next cursor or None), like
+                `RealtimeDB.get_sensor_data_page_for_user`.
+
+        Returns:
+            pd.DataFrame: The readings indexed by push key, oldest first.
+        """
+        with self._user_lock(uid):
+            frame = self.frame(uid)
+            cursor = frame.index[-1] if len(frame) else None
+            readings = {}
+            while True:
+                page, cursor = fetch_page(self.chunk_size, cursor)
+                readings.update(page)
+                if cursor is None:
+                    break
+            self.stats["refreshes"] += 1
+            if not readings:
+                return frame
+            self.stats["fetched"] += len(readings)
+            frame = self._append(uid, frame, readings_to_frame(readings))
+            self._remember(uid, frame)
+            return frame
+
+    def _append(self, uid: str, frame: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+        # Writes the new readings as a part under the user's schema and returns the
+        # combined history
+        combined = concat_frames([frame, new]) if len(frame) else new
+        self._write_part(uid, combined.iloc[len(frame) :])
+        if not (combined.index.is_monotonic_increasing and combined.index.is_unique):
+            combined = combined[~combined.index.duplicated(keep="last")].sort_index()
+        if len(self._parts(uid)) > self.max_parts:
+            self._compact(uid, combined)
+        return combined
+
+    def _compact(self, uid: str, frame: pd.DataFrame) -> None:
+        parts = self._parts(uid)
+        try:
+            compacted = self._write_part(uid, frame)
+        except Exception:
+            # The parts stay as they are; loading unifies their schema
+            self.stats["failed_compactions"] += 1
+            return
+        for part in parts:
+            if part != compacted:
+                os.remove(part)
+
+    def merge(self, uid: str, readings: dict) -> None:
+        """
+        Adds readings that were just written to the database to a user's cached history.
+
+        Readings written by the sensor writer can be older than the newest cached one, so
+        a refresh would not fetch them. Users without a cached history are skipped; their
+        next refresh fetches everything.
+
+        Args:
+            uid (str): The user's ID.
+            readings (dict): The written readings keyed by push key.
+        """
+        if not readings:
+            return
+        with self._user_lock(uid):
+            frame = self.frame(uid)
+            if not len(frame):
+                return
+            frame = self._append(uid, frame, readings_to_frame(readings))
+            self._remember(uid, frame)
+
+    def invalidate(self, uid: str) -> None:
+        """
+        Drops a user's history from memory and disk, e.g. after it was deleted.
+
+        Args:
+            uid (str): The user's ID.
+        """
+        with self._user_lock(uid):
+            with self._lock:
+                self._frames.pop(uid, None)
+            shutil.rmtree(self._user_dir(uid), ignore_errors=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_sensor_cache() -> SensorCache:
+    """
+    Returns the process-wide sensor cache.
+
+    It is configured by an optional `[sensor_cache]` section in the secrets file with
+    `cache_dir`, `max_users`, `chunk_size` and `max_parts`.
+
+    Returns:
+        SensorCache: The shared cache.
+    """
+    settings = get_settings("sensor_cache")
+    return SensorCache(
+        cache_dir=settings.get("cache_dir", CACHE_DIR),
+        max_users=int(settings.get("max_users", 32)),
+        chunk_size=int(settings.get("chunk_size", 1000)),
+        max_parts=int(settings.get("max_parts", 16)),
+    )
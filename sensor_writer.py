@@ -0,0 +1,436 @@
+# NOTE: This file contains the SensorWriter class that is used to ingest sensor readings in durable batches.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import requests
+import streamlit as st
+
+from credential_loader import get_settings
+from push_keys import generate_push_key
+from sensor_cache import get_sensor_cache
+
+SPOOL_PATH = ".cache/sensor_spool.sqlite"
+
+# Client errors that may succeed on a retry; any other 4xx rejects the batch for good
+RETRYABLE_STATUSES = {401, 408, 429}
+
+
+class SensorQueueFull(Exception):
+    """
+    Raised when readings could not be queued because the writer stayed full too long.
+    """
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    # The Firebase client re-raises HTTPError with the original error as first argument
+    for candidate in (error, *getattr(error, "args", ())[:1]):
+        response = getattr(candidate, "response", None)
+        if response is not None:
+            return response.status_code
+    return None
+
+
+def _is_permanent(error: Exception) -> bool:
+    status = _status_code(error)
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and status is not None
+        and 400 <= status < 500
+        and status not in RETRYABLE_STATUSES
+    )
+
+
+class SensorWriter:
+    """
+    Buffers sensor readings and writes them in batches on a background thread.
+
+    Every reading gets its push key when it is queued and is stored in a sqlite spool file
+    before `enqueue` returns. A user's readings are written with one multi-path update once
+    `flush_size` of them are pending or the oldest has waited `flush_interval` seconds.
+    Retries reuse the same keys, so a write that succeeded but was reported as failed is
+    not duplicated. Readings leave the spool only after they were written, so readings
+    queued before a restart are written once a session of their user queues again. Until
+    then they do not count toward `max_queued` and `flush` does not wait for them.
+
+    When `max_queued` writable readings are pending, or `max_queued_per_user` of one
+    user, `enqueue` blocks for up to `enqueue_timeout` seconds before it gives up.
+
+    A batch that the database rejects for good (a 4xx other than 401, 408 and 429) is
+    split in halves until the rejected reading is isolated, which then moves to the
+    `dead_letters` table of the spool file, so it does not hold up the user's later
+    readings.
+
+    Attributes:
+        spool_path (str): The path of the spool file, or None for memory only.
+        flush_size (int): The number of pending readings of a user that triggers a write.
+        flush_interval (float): The maximum time a reading waits before a write, in seconds.
+        max_queued (int): The maximum number of writable pending readings across users.
+        max_queued_per_user (int): The maximum number of pending readings of one user.
+        enqueue_timeout (float): How long `enqueue` waits for room, in seconds.
+        backoff_cap (float): The maximum delay between retries of a user, in seconds.
+        on_written (Callable): Called as `on_written(uid, readings)` after each write.
+        stats (dict): Counters of queued, written, recovered and dead-lettered readings
+            and of writes.
+
+    Methods:
+        enqueue: Queues readings for a user and returns their push keys.
+        pending: Returns the number of pending readings.
+        flush: Waits until the pending readings are written.
+        drop: Discards the pending readings of a user.
+    """
+
+    def __init__(
+        self,
+        spool_path: Optional[str] = SPOOL_PATH,
+        flush_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queued: int = 50000,
+        max_queued_per_user: int = 10000,
+        enqueue_timeout: float = 5.0,
+        backoff_cap: float = 60.0,
+        on_written: Optional[Callable[[str, dict], None]] = None,
+    ) -> None:
+        self.spool_path = spool_path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.enqueue_timeout = enqueue_timeout
+        self.backoff_cap = backoff_cap
+        self.on_written = on_written
+        self.stats = {
+            "queued": 0,
+            "written": 0,
+            "recovered": 0,
+            "dead_lettered": 0,
+            "writes": 0,
+            "failed_writes": 0,
+        }
+        self._pending = {}
+        self._queued_at = {}
+        self._handles = {}
+        self._failures = {}
+        self._retry_at = {}
+        self._batch_sizes = {}
+        self._writing = set()
+        self._count = 0
+        self._condition = threading.Condition()
+        if spool_path and os.path.dirname(spool_path):
+            os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+        self._spool = sqlite3.connect(spool_path or ":memory:", check_same_thread=False)
+        self._spool.execute("PRAGMA journal_mode=WAL")
+        self._spool.execute(
+            "CREATE TABLE IF NOT EXISTS spool "
+            "(key TEXT PRIMARY KEY, uid TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self._spool.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters (key TEXT PRIMARY KEY, uid TEXT "
+            "NOT NULL, data TEXT NOT NULL, error TEXT, failed_at REAL NOT NULL)"
+        )
+        self._spool.commit()
+        self._recover()
+        threading.Thread(target=self._run, name="sensor-writer", daemon=True).start()
+
+    def _recover(self) -> None:
+        now = time.monotonic()
+        for key, uid, data in self._spool.execute(
+            "SELECT key, uid, data FROM spool ORDER BY key"
+        ):
+            self._pending.setdefault(uid, OrderedDict())[key] = json.loads(data)
+            self._queued_at.setdefault(uid, now)
+            self._count += 1
+            self.stats["recovered"] += 1
+
+    def enqueue(
+        self,
+        uid: str,
+        database: Callable,
+        token: Callable[[], str],
+        readings: List[dict],
+    ) -> List[str]:
+        """
+        Queues readings for a user and returns their push keys.
+
+        The readings are in the spool file when this returns. Readings of the user left
+        from an earlier run are written along with them.
+
+        Args:
+            uid (str): The user's ID.
+            database (Callable): Returns a database handle for the write.
+            token (Callable): Returns the user's current ID token.
+            readings (list): The readings, oldest first.
+
+        Returns:
+            list: The push key of every reading.
+
+        Raises:
+            ValueError: If a reading cannot be stored as JSON, e.g. because it holds NaN.
+            SensorQueueFull: If there was no room for the readings within `enqueue_timeout`.
+        """
+        encoded = [json.dumps(reading, allow_nan=False) for reading in readings]
+        keys = [generate_push_key() for _ in readings]
+        deadline = time.monotonic() + self.enqueue_timeout
+        with self._condition:
+            while True:
+                writable = self._writable()
+                own = len(self._pending.get(uid, ()))
+                if (
+                    not writable or writable + len(readings) <= self.max_queued
+                ) and (not own or own + len(readings) <= self.max_queued_per_user):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SensorQueueFull(
+                        "{0} sensor readings are waiting to be written, {1} of them "
+                        "for this user.".format(writable, own)
+                    )
+                self._condition.wait(remaining)
+            self._spool.executemany(
+                "INSERT OR REPLACE INTO spool VALUES (?, ?, ?)",
+                [(key, uid, data) for key, data in zip(keys, encoded)],
+            )
+            self._spool.commit()
+            pending = self._pending.setdefault(uid, OrderedDict())
+            pending.update(zip(keys, readings))
+            self._queued_at.setdefault(uid, time.monotonic())
+            self._handles[uid] = (database, token)
+            self._count += len(readings)
+            self.stats["queued"] += len(readings)
+            self._condition.notify_all()
+        return keys
+
+    def _writable(self) -> int:
+        # Readings recovered from the spool have no handle until their user queues again
+        return sum(
+            len(pending)
+            for uid, pending in self._pending.items()
+            if uid in self._handles
+        )
+
+    def pending(self, uid: Optional[str] = None) -> int:
+        """
+        Returns the number of pending readings.
+
+        Args:
+            uid (str): Only count the readings of this user, or None for all users.
+
+        Returns:
+            int: The number of readings not yet written.
+        """
+        with self._condition:
+            if uid is None:
+                return self._count
+            return len(self._pending.get(uid, ()))
+
+    def flush(self, uid: Optional[str] = None, timeout: float = 10.0) -> bool:
+        """
+        Writes the pending readings now and waits until they are written.
+
+        Readings recovered from the spool whose user has not queued again cannot be
+        written yet and are not waited for.
+
+        Args:
+            uid (str): Only wait for the readings of this user, or None for all users.
+            timeout (float): The maximum time to wait, in seconds.
+
+        Returns:
+            bool: Whether the readings were written in time.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if uid is not None and uid in self._pending and uid not in self._handles:
+                return False
+            for user in [uid] if uid is not None else list(self._queued_at):
+                if user in self._queued_at:
+                    self._queued_at[user] = 0.0
+            self._condition.notify_all()
+            while (uid in self._pending if uid is not None else self._writable()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def drop(self, uid: str) -> int:
+        """
+        Discards the pending and dead-lettered readings of a user, e.g. before their
+        sensor data is deleted.
+
+        A write of the user's readings that is already running is waited for, so nothing
+        queued before this call reaches the database after it.
+
+        Args:
+            uid (str): The user's ID.
+
+        Returns:
+            int: The number of discarded readings.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: uid not in self._writing)
+            pending = self._pending.pop(uid, {})
+            self._queued_at.pop(uid, None)
+            self._failures.pop(uid, None)
+            self._retry_at.pop(uid, None)
+            self._batch_sizes.pop(uid, None)
+            self._spool.execute("DELETE FROM spool WHERE uid = ?", (uid,))
+            self._spool.execute("DELETE FROM dead_letters WHERE uid = ?", (uid,))
+            self._spool.commit()
+            self._count -= len(pending)
+            self._condition.notify_all()
+        return len(pending)
+
+    def _due(self, now: float) -> tuple:
+        # Returns the users to write now and how long to wait for the next one
+        due, wait = [], None
+        for uid, pending in self._pending.items():
+            if uid not in self._handles:
+                continue
+            ready_at = max(
+                self._retry_at.get(uid, 0.0),
+                now
+                if len(pending) >= self.flush_size
+                else self._queued_at[uid] + self.flush_interval,
+            )
+            if ready_at <= now:
+                due.append(uid)
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        return due, wait
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                due, wait = self._due(time.monotonic())
+                while not due:
+                    self._condition.wait(wait)
+                    due, wait = self._due(time.monotonic())
+                batches = [
+                    (
+                        uid,
+                        self._handles[uid],
+                        OrderedDict(
+                            list(self._pending[uid].items())[
+                                : self._batch_sizes.get(uid, self.flush_size)
+                            ]
+                        ),
+                    )
+                    for uid in due
+                ]
+                self._writing.update(due)
+            for uid, (database, token), readings in batches:
+                self._write(uid, database, token, readings)
+
+    def _write(
+        self, uid: str, database: Callable, token: Callable, readings: OrderedDict
+    ) -> None:
+        try:
+            self._send(uid, database, token, readings)
+        finally:
+            with self._condition:
+                self._writing.discard(uid)
+                self._condition.notify_all()
+
+    def _send(
+        self, uid: str, database: Callable, token: Callable, readings: OrderedDict
+    ) -> None:
+        try:
+            database().child("users").child(uid).child("sensor_data").update(
+                dict(readings), token=token()
+            )
+        except Exception as error:
+            if _is_permanent(error):
+                self._reject(uid, readings, error)
+                return
+            with self._condition:
+                failures = self._failures.get(uid, 0) + 1
+                self._failures[uid] = failures
+                self._retry_at[uid] = time.monotonic() + min(
+                    2 ** (failures - 1), self.backoff_cap
+                )
+                self.stats["failed_writes"] += 1
+            return
+        with self._condition:
+            self._spool.executemany(
+                "DELETE FROM spool WHERE key = ?", [(key,) for key in readings]
+            )
+            self._spool.commit()
+            pending = self._pending[uid]
+            for key in readings:
+                del pending[key]
+            if pending:
+                self._queued_at[uid] = time.monotonic() - self.flush_interval
+            else:
+                del self._pending[uid]
+                del self._queued_at[uid]
+            self._failures.pop(uid, None)
+            self._retry_at.pop(uid, None)
+            self._count -= len(readings)
+            self.stats["written"] += len(readings)
+            self.stats["writes"] += 1
+            self._condition.notify_all()
+        if self.on_written is not None:
+            try:
+                self.on_written(uid, readings)
+            except Exception:
+                pass
+
+
+    def _reject(self, uid: str, readings: OrderedDict, error: Exception) -> None:
+        # Splits a rejected batch; the smaller batch size is kept until the rejected
+        # reading is isolated and moved to the dead letters
+        with self._condition:
+            self.stats["failed_writes"] += 1
+            if len(readings) > 1:
+                self._batch_sizes[uid] = len(readings) // 2
+                self._condition.notify_all()
+                return
+            key, reading = next(iter(readings.items()))
+            self._spool.execute("DELETE FROM spool WHERE key = ?", (key,))
+            self._spool.execute(
+                "INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?)",
+                (key, uid, json.dumps(reading), str(error)[:1000], time.time()),
+            )
+            self._spool.commit()
+            pending = self._pending[uid]
+            del pending[key]
+            if not pending:
+                del self._pending[uid]
+                del self._queued_at[uid]
+            self._batch_sizes.pop(uid, None)
+            self._count -= 1
+            self.stats["dead_lettered"] += 1
+            self._condition.notify_all()
+
+
+@st.cache_resource(show_spinner=False)
+def get_sensor_writer() -> SensorWriter:
+    """
+    Returns the process-wide sensor writer.
+
+    Written readings are merged into the sensor cache, since a delayed batch can be older
+    than readings the cache has already synced.
+
+    It is configured by an optional `[sensor_writer]` section in the secrets file with
+    `spool_path`, `flush_size`, `flush_interval`, `max_queued`, `max_queued_per_user`,
+    `enqueue_timeout` and `backoff_cap`.
+
+    Returns:
+        SensorWriter: The shared writer.
+    """
+    settings = get_settings("sensor_writer")
+    return SensorWriter(
+        spool_path=settings.get("spool_path", SPOOL_PATH),
+        flush_size=int(settings.get("flush_size", 500)),
+        flush_interval=float(settings.get("flush_interval", 1.0)),
+        max_queued=int(settings.get("max_queued", 50000)),
+        max_queued_per_user=int(settings.get("max_queued_per_user", 10000)),
+        enqueue_timeout=float(settings.get("enqueue_timeout", 5.0)),
+        backoff_cap=float(settings.get("backoff_cap", 60.0)),
+        on_written=get_sensor_cache().merge,
+    )
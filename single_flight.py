@@ -0,0 +1,143 @@
+# NOTE: This file contains the SingleFlight class that is used to share one upstream call between identical chat requests.
+
+import threading
+from typing import Callable, Iterator
+
+import streamlit as st
+
+
+class FlightCancelled(Exception):
+    """
+    Marks an upstream call that was stopped because every subscriber went away.
+    """
+
+
+class _Flight:
+    """
+    The shared state of one upstream call: the chunks so far and whether it has finished.
+    """
+
+    def __init__(self) -> None:
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.condition = threading.Condition()
+        self.cancelled = threading.Event()
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight streaming requests into one upstream call.
+
+    The first request for a key starts the upstream stream on a background thread. Every
+    request for the same key that arrives while it is running subscribes to it and
+    receives all chunks from the beginning, so each waiting session streams the same
+    answer. The upstream call is cancelled only when every subscriber has gone away; a
+    cancelled call is removed at once and ends with `FlightCancelled`, so its partial
+    answer is never handed to a later request as if it were complete.
+
+    Attributes:
+        stats (dict): Counters of upstream calls ("leaders") and coalesced requests.
+
+    Methods:
+        stream: Streams the answer for a key, sharing the upstream call if one is running.
+        in_flight: Returns the number of running upstream calls.
+    """
+
+    def __init__(self) -> None:
+        self.stats = {"leaders": 0, "coalesced": 0}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _pump(self, key: str, flight: _Flight, start: Callable[[], Iterator[str]]):
+        chunks = None
+        try:
+            chunks = start()
+            for chunk in chunks:
+                if flight.cancelled.is_set():
+                    break
+                with flight.condition:
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except Exception as error:
+            if flight.error is None:
+                flight.error = error
+        finally:
+            if chunks is not None:
+                chunks.close()
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def stream(self, key: str, start: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Streams the answer for a key, sharing the upstream call if one is running.
+
+        Args:
+            key (str): The request key, e.g. the model plus a hash of the normalized context.
+            start (Callable): Starts the upstream stream; only called for the first request.
+
+        Yields:
+            str: The next chunk of the answer.
+
+        Raises:
+            Exception: Whatever the upstream stream raised.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.stats["leaders"] += 1
+                threading.Thread(
+                    target=self._pump, args=(key, flight, start), daemon=True
+                ).start()
+            else:
+                self.stats["coalesced"] += 1
+            flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                with flight.condition:
+                    while index >= len(flight.chunks) and not flight.done:
+                        flight.condition.wait()
+                    new_chunks = flight.chunks[index:]
+                    index += len(new_chunks)
+                    done = flight.done
+                for chunk in new_chunks:
+                    yield chunk
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+                if flight.subscribers == 0 and not flight.done:
+                    flight.error = FlightCancelled(key)
+                    flight.cancelled.set()
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+
+    def in_flight(self) -> int:
+        """
+        Returns the number of running upstream calls.
+
+        Returns:
+            int: The number of running upstream calls.
+        """
+        return len(self._flights)
+
+
+@st.cache_resource(show_spinner=False)
+def get_single_flight() -> SingleFlight:
+    """
+    Returns the process-wide single-flight group for chat requests.
+
+    Returns:
+        SingleFlight: The shared group.
+    """
+    return SingleFlight()
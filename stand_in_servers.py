@@ -0,0 +1,282 @@
+# NOTE: This file contains local stand-in servers for the external APIs, used for tests and offline development.
+
+import argparse
+import hashlib
+import json
+import struct
+import threading
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from live_view import _lookup, _replace
+from push_keys import generate_push_key
+
+
+def solid_png(color: tuple, size: int = 16) -> bytes:
+    """
+    Encodes a square PNG image of a single color.
+
+    Args:
+        color (tuple): The (red, green, blue) color.
+        size (int): The width and height in pixels.
+
+    Returns:
+        bytes: The PNG file.
+    """
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    row = b"\x00" + bytes(color) * size
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * size))
+        + chunk(b"IEND", b"")
+    )
+
+
+class PexelsStandIn(BaseHTTPRequestHandler):
+    """
+    Answers like the Pexels search API, with one generated photo per query.
+
+    `GET /v1/search?query=...` returns a single photo whose color is derived from the query,
+    and `GET /photos/<digest>.png` serves it. A query containing "nothing" returns no
+    photos. Every request is counted in `requests`, and the `api_key` class attribute, if
+    set, is required in the Authorization header.
+
+    Point the app at it with `[pexels] base_url = "http://127.0.0.1:<port>/v1"`.
+    """
+
+    api_key = None
+    requests = {"search": 0, "photo": 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/v1/search":
+            self.requests["search"] += 1
+            if self.api_key and self.headers.get("Authorization") != self.api_key:
+                self._send(401, "application/json", b'{"error": "Unauthorized"}')
+                return
+            query = urllib.parse.parse_qs(url.query).get("query", [""])[0]
+            photos = []
+            if "nothing" not in query:
+                digest = hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+                photo_url = "http://{0}:{1}/photos/{2}.png".format(
+                    *self.server.server_address[:2], digest
+                )
+                photos.append(
+                    {
+                        "id": int(digest, 16) % 10**9,
+                        "alt": query,
+                        "src": {
+                            size: photo_url
+                            for size in ("original", "medium", "small", "tiny")
+                        },
+                    }
+                )
+            body = json.dumps({"page": 1, "per_page": 1, "photos": photos})
+            self._send(200, "application/json", body.encode("utf-8"))
+        elif url.path.startswith("/photos/") and url.path.endswith(".png"):
+            self.requests["photo"] += 1
+            digest = bytes.fromhex(url.path[len("/photos/") : -len(".png")][:6])
+            self._send(200, "image/png", solid_png(tuple(digest[:3])))
+        else:
+            self._send(404, "application/json", b'{"error": "Not found"}')
+
+
+class RealtimeDBStandIn(BaseHTTPRequestHandler):
+    """
+    Answers like the Realtime Database REST API, including its event streams.
+
+    Data is kept in memory in the `data` class attribute. `GET`, `PUT`, `PATCH`, `POST` and
+    `DELETE` on `/<path>.json` read and write it. A `GET` with
+    `Accept: text/event-stream` first sends the current value as a `put` event and then a
+    `put` or `patch` event for every write at or below the path (a write above it is sent
+    as a `put` of the new value), plus a `keep-alive` event every `keep_alive` seconds.
+    `orderBy="$key"` with `startAt` filters the children of the streamed location. The
+    `auth` parameter is required but not checked.
+
+    Point the app at it with `[live_view] base_url = "http://127.0.0.1:<port>"`.
+    """
+
+    data = None
+    keep_alive = 15.0
+    _events = []
+    _condition = threading.Condition()
+
+    def log_message(self, format, *args):
+        pass
+
+    @classmethod
+    def reset(cls) -> None:
+        """
+        Empties the database and the event log.
+        """
+        with cls._condition:
+            cls.data = None
+            cls._events = []
+
+    def _request(self) -> tuple:
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path[: -len(".json")] if url.path.endswith(".json") else url.path
+        query = {
+            key: json.loads(values[0]) if key in ("orderBy", "startAt") else values[0]
+            for key, values in urllib.parse.parse_qs(url.query).items()
+        }
+        return [part for part in path.split("/") if part], query
+
+    def _send_json(self, status: int, value) -> None:
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+
+    @classmethod
+    def _write(cls, parts: list, event: str, value) -> None:
+        with cls._condition:
+            data = cls.data
+            if event == "patch":
+                for key, child in value.items():
+                    data = _replace(data, parts + key.split("/"), child)
+            else:
+                data = _replace(data, parts, value)
+            cls.data = data
+            cls._events.append((parts, event, value))
+            cls._condition.notify_all()
+
+    @staticmethod
+    def _filter(value, query: dict):
+        # Like the real API, a filtered read without matches is {} rather than null
+        if "orderBy" not in query:
+            return value
+        start = query.get("startAt")
+        if query.get("orderBy") == "$key" and start is not None and isinstance(
+            value, dict
+        ):
+            value = {key: child for key, child in value.items() if key >= start}
+        return value if value is not None else {}
+
+    def do_GET(self):
+        parts, query = self._request()
+        if "auth" not in query:
+            self._send_json(401, {"error": "Permission denied"})
+            return
+        if self.headers.get("Accept") != "text/event-stream":
+            with self._condition:
+                value = _lookup(self.data, parts)
+            self._send_json(200, self._filter(value, query))
+            return
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.end_headers()
+        with self._condition:
+            value, seen = _lookup(self.data, parts), len(self._events)
+        self._send_event(
+            "put", {"path": "/", "data": self._filter(value, query) or None}
+        )
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: len(self._events) > seen, self.keep_alive
+                    )
+                    events, seen = self._events[seen:], len(self._events)
+                    current = self._filter(_lookup(self.data, parts), query) or None
+                if not events:
+                    self._send_event("keep-alive", None)
+                for event_parts, event, value in events:
+                    if event_parts[: len(parts)] == parts:
+                        relative = event_parts[len(parts) :]
+                        if not relative:
+                            value = self._filter(value, query) or None
+                        elif query.get("startAt") is not None:
+                            if relative[0] < query["startAt"]:
+                                continue
+                        self._send_event(
+                            event, {"path": "/" + "/".join(relative), "data": value}
+                        )
+                    elif parts[: len(event_parts)] == event_parts:
+                        self._send_event("put", {"path": "/", "data": current})
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def _send_event(self, event: str, data) -> None:
+        self.wfile.write(
+            "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data)).encode("utf-8")
+        )
+        self.wfile.flush()
+
+    def do_PUT(self):
+        parts, _ = self._request()
+        value = self._body()
+        self._write(parts, "put", value)
+        self._send_json(200, value)
+
+    def do_PATCH(self):
+        parts, _ = self._request()
+        value = self._body()
+        self._write(parts, "patch", value)
+        self._send_json(200, value)
+
+    def do_POST(self):
+        parts, _ = self._request()
+        key = generate_push_key()
+        self._write(parts + [key], "put", self._body())
+        self._send_json(200, {"name": key})
+
+    def do_DELETE(self):
+        parts, _ = self._request()
+        self._write(parts, "put", None)
+        self._send_json(200, None)
+
+
+def serve_in_background(handler: type, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts a stand-in server on a daemon thread.
+
+    Args:
+        handler (type): The request handler class, e.g. `PexelsStandIn`.
+        port (int): The port to listen on, or 0 for a free one.
+
+    Returns:
+        ThreadingHTTPServer: The running server. Its URL is
+        `http://127.0.0.1:<server.server_address[1]>`; call `shutdown()` to stop it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="stand-in-server", daemon=True
+    ).start()
+    return server
+
+
+STAND_INS = {"pexels": PexelsStandIn, "realtimedb": RealtimeDBStandIn}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a local stand-in server.")
+    parser.add_argument("api", choices=sorted(STAND_INS))
+    parser.add_argument("--port", type=int, default=8765)
+    arguments = parser.parse_args()
+    handler = STAND_INS[arguments.api]
+    server = ThreadingHTTPServer(("127.0.0.1", arguments.port), handler)
+    print("Serving {0} on http://127.0.0.1:{1}".format(arguments.api, arguments.port))
+    server.serve_forever()
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("streamlit")
+
+from http_transport import PooledTransport
+from image_search import ImageSearch
+from stand_in_servers import PexelsStandIn, serve_in_background
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = serve_in_background(PexelsStandIn)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def search(server):
+    PexelsStandIn.requests.update(search=0, photo=0)
+    transport = PooledTransport(
+        "http://127.0.0.1:{0}/v1".format(server.server_address[1])
+    )
+    return ImageSearch("test-key", transport, cache_path=None, touch_interval=0.0)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_fetch_stores_photo(search):
+    content_type, data = search.fetch("Jeans")
+    assert content_type == "image/png"
+    assert data.startswith(b"\x89PNG")
+    assert search.image("jeans") == (content_type, data)
+    assert search.stats["hits"] == 1
+
+
+def test_miss_fetches_in_background(search):
+    assert search.image("Coat") is None
+    assert wait_for(lambda: search.image("coat") is not None)
+    assert search.data_uri("coat").startswith("data:image/png;base64,")
+    assert PexelsStandIn.requests == {"search": 1, "photo": 1}
+
+
+def test_query_without_results_is_cached(search):
+    assert search.fetch("nothing at all") is None
+    assert search.image("nothing at all") is None
+    search.prefetch(["nothing at all"])
+    assert PexelsStandIn.requests["search"] == 1
+    assert search.stats["misses"] == 0
+
+
+def test_hits_record_use_off_the_lookup(search):
+    search.fetch("Dress")
+    search.image("dress")
+    assert wait_for(lambda: not search._used)
+    used_at = search._db.execute("SELECT used_at FROM images").fetchone()[0]
+    assert used_at >= time.time() - 5
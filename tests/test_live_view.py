@@ -0,0 +1,128 @@
+import json
+import time
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("streamlit")
+
+from live_view import LiveSubscriptions, LiveView, MaterializedView
+from push_keys import generate_push_key
+from stand_in_servers import RealtimeDBStandIn, serve_in_background
+
+
+@pytest.fixture(scope="module")
+def server():
+    RealtimeDBStandIn.keep_alive = 0.2
+    server = serve_in_background(RealtimeDBStandIn)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def base_url(server):
+    RealtimeDBStandIn.reset()
+    return "http://127.0.0.1:{0}".format(server.server_address[1])
+
+
+@pytest.fixture
+def view(base_url):
+    view = LiveView(base_url, "user-1", lambda: "token")
+    yield view
+    view.stop()
+
+
+def put(base_url, path, value):
+    requests.put(
+        "{0}/{1}.json".format(base_url, path), params={"auth": "token"}, json=value
+    ).raise_for_status()
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_materialized_view_snapshots():
+    view = MaterializedView()
+    assert view.apply("put", "/", {"a": {"x": 1}})
+    snapshot = view.get()
+    assert view.apply("patch", "/a", {"y": 2})
+    assert snapshot == {"a": {"x": 1}}
+    assert view.get("/a") == {"x": 1, "y": 2}
+    assert not view.apply("patch", "/a", {"y": 2})
+    assert view.version == 2
+
+
+def test_follows_valve_and_new_readings(base_url, view):
+    put(base_url, "users/user-1/valve_status", {"valve_status": "open"})
+    assert wait_for(lambda: view.valve_status() == "open")
+    key = generate_push_key()
+    put(base_url, "users/user-1/sensor_data/" + key, {"temperature": 21.5})
+    assert wait_for(lambda: view.sensor_readings() == {key: {"temperature": 21.5}})
+
+
+def test_skips_readings_older_than_the_subscription(base_url):
+    old_key = generate_push_key()
+    put(base_url, "users/user-1/sensor_data/" + old_key, {"temperature": 1})
+    time.sleep(0.01)
+    view = LiveView(base_url, "user-1", lambda: "token")
+    try:
+        assert wait_for(lambda: view._streams[1].stats["connections"])
+        key = generate_push_key()
+        put(base_url, "users/user-1/sensor_data/" + key, {"temperature": 2})
+        assert wait_for(lambda: key in view.sensor_readings())
+        assert old_key not in view.sensor_readings()
+    finally:
+        view.stop()
+
+
+def test_keep_alive_does_not_change_version(base_url, view):
+    put(base_url, "users/user-1/valve_status", {"valve_status": "closed"})
+    assert wait_for(lambda: view.valve_status() == "closed")
+    version = view.version()
+    time.sleep(0.5)
+    assert view.version() == version
+
+
+def test_reconnect_resumes_after_newest_reading(base_url, view):
+    keys = []
+    for temperature in (1, 2):
+        keys.append(generate_push_key())
+        put(
+            base_url,
+            "users/user-1/sensor_data/" + keys[-1],
+            {"temperature": temperature},
+        )
+    assert wait_for(lambda: len(view.sensor_readings()) == 2)
+    stream = view._streams[1]
+    assert json.loads(stream.params()["startAt"]) == keys[-1]
+    connections = stream.stats["connections"]
+    stream._response.close()
+    assert wait_for(lambda: stream.stats["connections"] > connections)
+    keys.append(generate_push_key())
+    put(base_url, "users/user-1/sensor_data/" + keys[-1], {"temperature": 3})
+    assert wait_for(lambda: keys[-1] in view.sensor_readings())
+    # The resumed snapshot only holds the newest reading and must not replace the rest
+    assert sorted(view.sensor_readings()) == keys
+
+
+def test_cancelled_view_is_replaced(base_url):
+    subscriptions = LiveSubscriptions(base_url, retry_after=0.2)
+    view = subscriptions.view("user-1", lambda: "token")
+    try:
+        assert wait_for(lambda: view._streams[0].stats["connections"])
+        view._streams[0]._dispatch("cancel", "null")
+        assert view.stopped_at() is not None
+        assert subscriptions.view("user-1", lambda: "token") is view
+        time.sleep(0.25)
+        replacement = subscriptions.view("user-1", lambda: "token")
+        assert replacement is not view and replacement.stopped_at() is None
+        put(base_url, "users/user-1/valve_status", {"valve_status": "open"})
+        assert wait_for(lambda: replacement.valve_status() == "open")
+    finally:
+        subscriptions.stop("user-1")
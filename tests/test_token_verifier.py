@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+jwt = pytest.importorskip("jwt")
+pytest.importorskip("cryptography")
+pytest.importorskip("streamlit")
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from token_verifier import IdTokenVerifier, PublicKeyCache
+
+PROJECT_ID = "test-project"
+ISSUER = "https://securetoken.google.com/" + PROJECT_ID
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def verifier(private_key):
+    key_cache = PublicKeyCache()
+    key_cache.set_keys({"key-1": private_key.public_key()})
+    return IdTokenVerifier(PROJECT_ID, key_cache, leeway=0)
+
+
+def make_token(private_key, kid="key-1", **overrides):
+    now = int(time.time())
+    claims = {
+        "iss": ISSUER,
+        "aud": PROJECT_ID,
+        "sub": "user-1",
+        "iat": now,
+        "exp": now + 3600,
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_valid_token(verifier, private_key):
+    claims = verifier.verify(make_token(private_key))
+    assert claims["sub"] == "user-1"
+
+
+def test_expired_token(verifier, private_key):
+    now = int(time.time())
+    token = make_token(private_key, iat=now - 7200, exp=now - 3600)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        verifier.verify(token)
+
+
+def test_wrong_audience(verifier, private_key):
+    with pytest.raises(jwt.InvalidAudienceError):
+        verifier.verify(make_token(private_key, aud="other-project"))
+
+
+def test_wrong_issuer(verifier, private_key):
+    token = make_token(private_key, iss="https://securetoken.google.com/other")
+    with pytest.raises(jwt.InvalidIssuerError):
+        verifier.verify(token)
+
+
+def test_unknown_kid(verifier, private_key):
+    with pytest.raises(jwt.InvalidTokenError):
+        verifier.verify(make_token(private_key, kid="key-2"))
+
+
+def test_wrong_signing_key(verifier):
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with pytest.raises(jwt.InvalidSignatureError):
+        verifier.verify(make_token(other_key))
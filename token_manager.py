@@ -0,0 +1,229 @@
+# NOTE: This file contains the TokenManager class that is used to keep a user's Firebase ID token fresh.
+
+import hashlib
+import heapq
+import hmac
+import itertools
+import os
+import threading
+import time
+import weakref
+from typing import Optional
+
+import streamlit as st
+
+from http_transport import PooledTransport, get_secure_token_transport
+
+
+class RefreshScheduler:
+    """
+    A single background thread that refreshes ID tokens shortly before they expire.
+
+    Managers are held through weak references, so a session that goes away does not
+    keep its tokens alive or keep refreshing them.
+
+    Attributes:
+        condition: Wakes the worker when an earlier refresh is scheduled.
+        queue: A heap of (due time, sequence, manager reference) entries.
+
+    Methods:
+        schedule: Schedules a manager to be refreshed at the given time.
+    """
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.queue = []
+        self._counter = itertools.count()
+        self._thread = threading.Thread(
+            target=self._run, name="token-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def schedule(self, manager: "TokenManager", due: float) -> None:
+        """
+        Schedules a manager to be refreshed at the given time.
+
+        Args:
+            manager (TokenManager): The manager to refresh.
+            due (float): The UNIX time at which to refresh it.
+        """
+        with self.condition:
+            heapq.heappush(
+                self.queue, (due, next(self._counter), weakref.ref(manager))
+            )
+            self.condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    timeout = self.queue[0][0] - time.time() if self.queue else None
+                    self.condition.wait(timeout)
+                due, _, ref = heapq.heappop(self.queue)
+            manager = ref()
+            if manager is not None:
+                manager.refresh_if_due(due)
+
+
+@st.cache_resource(show_spinner=False)
+def get_refresh_scheduler() -> RefreshScheduler:
+    """
+    Returns the process-wide token refresh scheduler.
+
+    Returns:
+        RefreshScheduler: The shared scheduler.
+    """
+    return RefreshScheduler()
+
+
+class TokenManager:
+    """
+    Keeps a signed-in user's ID token fresh using the Firebase refresh token.
+
+    The token is refreshed in the background `refresh_margin` seconds before it expires,
+    and synchronously if it is read after that point. A password that was verified
+    within `reverify_window` seconds is remembered (as a salted hash), so sensitive
+    operations can reuse the fresh token instead of signing in again.
+
+    Attributes:
+        api_key (str): The Firebase web API key.
+        transport (PooledTransport): Transport for the Secure Token API.
+        refresh_token (str): The current refresh token.
+        expires_at (float): The UNIX time at which the ID token expires.
+        refresh_margin (float): How long before expiry the token is refreshed.
+        reverify_window (float): How long a verified password is trusted.
+
+    Methods:
+        id_token: The current ID token, refreshed if it is about to expire.
+        refresh: Exchanges the refresh token for a new ID token.
+        refresh_if_due: Refreshes the token from the background scheduler.
+        accept_sign_in: Stores the tokens from a fresh password sign-in.
+        recently_verified: Checks whether a password was verified within the window.
+        stop: Stops background refreshes.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        sign_in_response: dict,
+        transport: Optional[PooledTransport] = None,
+        refresh_margin: float = 300,
+        reverify_window: float = 300,
+    ) -> None:
+        self.api_key = api_key
+        self.transport = transport or get_secure_token_transport()
+        self.refresh_margin = refresh_margin
+        self.reverify_window = reverify_window
+        self._lock = threading.Lock()
+        self._salt = os.urandom(16)
+        self._verified_digest = None
+        self._verified_at = 0.0
+        self._stopped = False
+        self._store(
+            sign_in_response["idToken"],
+            sign_in_response["refreshToken"],
+            sign_in_response.get("expiresIn", 3600),
+        )
+
+    def _store(self, id_token: str, refresh_token: str, expires_in) -> None:
+        self._id_token = id_token
+        self.refresh_token = refresh_token
+        self.expires_at = time.time() + int(expires_in)
+        if not self._stopped:
+            get_refresh_scheduler().schedule(
+                self, self.expires_at - self.refresh_margin
+            )
+
+    def _digest(self, password: str) -> bytes:
+        return hashlib.sha256(self._salt + password.encode("utf-8")).digest()
+
+    @property
+    def id_token(self) -> str:
+        """
+        The current ID token, refreshed synchronously if it is about to expire.
+        """
+        if time.time() >= self.expires_at - self.refresh_margin:
+            self.refresh()
+        return self._id_token
+
+    def refresh(self) -> None:
+        """
+        Exchanges the refresh token for a new ID token.
+
+        Raises:
+            requests.exceptions.HTTPError: If the refresh token was rejected.
+        """
+        with self._lock:
+            if time.time() < self.expires_at - self.refresh_margin:
+                return
+            response = self.transport.request(
+                "POST",
+                "token",
+                params={"key": self.api_key},
+                data={
+                    "grant_type": "refresh_token",
+                    "refresh_token": self.refresh_token,
+                },
+            )
+            response.raise_for_status()
+            payload = response.json()
+            self._store(
+                payload["id_token"], payload["refresh_token"], payload["expires_in"]
+            )
+
+    def refresh_if_due(self, due: float) -> None:
+        """
+        Refreshes the token from the background scheduler.
+
+        Stale schedule entries (from before a newer token was stored) are ignored, and
+        failures are left for the next synchronous read of `id_token` to retry.
+
+        Args:
+            due (float): The time the refresh was scheduled for.
+        """
+        if self._stopped or due < self.expires_at - self.refresh_margin - 1:
+            return
+        try:
+            self.refresh()
+        except Exception:
+            pass
+
+    def accept_sign_in(self, sign_in_response: dict, password: str) -> None:
+        """
+        Stores the tokens from a fresh password sign-in and remembers the password as verified.
+
+        Args:
+            sign_in_response (dict): The response of the verifyPassword call.
+            password (str): The password that was verified.
+        """
+        with self._lock:
+            self._store(
+                sign_in_response["idToken"],
+                sign_in_response["refreshToken"],
+                sign_in_response.get("expiresIn", 3600),
+            )
+            self._verified_digest = self._digest(password)
+            self._verified_at = time.time()
+
+    def recently_verified(self, password: str) -> bool:
+        """
+        Checks whether this password was verified within the re-verification window.
+
+        Args:
+            password (str): The password to check.
+
+        Returns:
+            bool: True if the password matches one verified within the window.
+        """
+        if self._verified_digest is None:
+            return False
+        if time.time() - self._verified_at > self.reverify_window:
+            return False
+        return hmac.compare_digest(self._verified_digest, self._digest(password))
+
+    def stop(self) -> None:
+        """
+        Stops background refreshes and forgets the verified password.
+        """
+        self._stopped = True
+        self._verified_digest = None
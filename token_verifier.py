@@ -0,0 +1,217 @@
+# NOTE: This file contains the IdTokenVerifier class that is used to verify Firebase ID tokens without network calls.
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import jwt
+import streamlit as st
+from cryptography.x509 import load_pem_x509_certificate
+
+from http_transport import PooledTransport, transport_from_settings
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+
+class PublicKeyCache:
+    """
+    A cache of the public keys that sign Firebase ID tokens.
+
+    The key set is fetched once and kept for the `max-age` announced in the response's
+    Cache-Control header. Shortly before it expires a background thread fetches a new
+    set, so readers only block on the network when the cache is empty or stale.
+
+    Attributes:
+        transport (PooledTransport): Transport whose base URL serves the x509 certificates,
+            or None for a key set that is only set with `set_keys`.
+        refresh_ahead (float): How long before expiry the background refresh starts.
+        default_ttl (float): TTL used when the response has no max-age.
+        keys (dict): The public keys, keyed by key ID.
+        expires_at (float): The UNIX time at which the key set expires.
+
+    Methods:
+        get: Returns the public key with the given key ID.
+        set_keys: Replaces the key set, e.g. with locally generated keys.
+        fetch: Downloads the key set.
+    """
+
+    def __init__(
+        self,
+        transport: Optional[PooledTransport] = None,
+        refresh_ahead: float = 300,
+        default_ttl: float = 3600,
+    ) -> None:
+        self.transport = transport
+        self.refresh_ahead = refresh_ahead
+        self.default_ttl = default_ttl
+        self.keys = {}
+        self.expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def set_keys(self, keys: Dict[str, object], ttl: Optional[float] = None) -> None:
+        """
+        Replaces the key set.
+
+        Args:
+            keys (dict): Public keys or PEM-encoded certificates, keyed by key ID.
+            ttl (float): How long the keys are valid, or None to keep them forever.
+        """
+        parsed = {}
+        for kid, key in keys.items():
+            if isinstance(key, str):
+                key = load_pem_x509_certificate(key.encode("utf-8")).public_key()
+            parsed[kid] = key
+        self.keys = parsed
+        self.expires_at = time.time() + ttl if ttl is not None else float("inf")
+
+    def fetch(self) -> None:
+        """
+        Downloads the key set and stores it with the TTL from the Cache-Control header.
+
+        Raises:
+            requests.exceptions.RequestException: If the download fails.
+        """
+        response = self.transport.request("GET", "")
+        response.raise_for_status()
+        match = re.search(
+            r"max-age=(\d+)", response.headers.get("Cache-Control", "")
+        )
+        ttl = float(match.group(1)) if match else self.default_ttl
+        self.set_keys(response.json(), ttl)
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.fetch()
+        except Exception:
+            pass
+        finally:
+            self._refreshing = False
+
+    def get(self, kid: str):
+        """
+        Returns the public key with the given key ID.
+
+        Args:
+            kid (str): The key ID from the token header.
+
+        Returns:
+            The public key.
+
+        Raises:
+            jwt.InvalidTokenError: If no key with this ID is known.
+        """
+        now = time.time()
+        if self.transport is None:
+            # A local key set, e.g. in tests, is never downloaded again
+            pass
+        elif now >= self.expires_at or kid not in self.keys:
+            with self._lock:
+                if time.time() >= self.expires_at or kid not in self.keys:
+                    self.fetch()
+        elif now >= self.expires_at - self.refresh_ahead and not self._refreshing:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(
+                        target=self._refresh_in_background, daemon=True
+                    ).start()
+        try:
+            return self.keys[kid]
+        except KeyError:
+            raise jwt.InvalidTokenError("Unknown signing key: {0}".format(kid))
+
+
+class IdTokenVerifier:
+    """
+    Verifies Firebase ID tokens locally and caches the verified claims.
+
+    Verification checks the RS256 signature against the cached public keys, the audience
+    and issuer of the project, the expiry and issue times and the subject. The claims of
+    a verified token are cached until the token expires, so later reruns validate the
+    session token without any I/O.
+
+    Attributes:
+        project_id (str): The Firebase project ID.
+        key_cache (PublicKeyCache): The signing keys.
+        leeway (float): Allowed clock skew in seconds.
+        max_cached (int): The maximum number of cached claim sets.
+
+    Methods:
+        verify: Verifies a token and returns its claims.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        key_cache: PublicKeyCache,
+        leeway: float = 10,
+        max_cached: int = 4096,
+    ) -> None:
+        self.project_id = project_id
+        self.key_cache = key_cache
+        self.leeway = leeway
+        self.max_cached = max_cached
+        self._claims = OrderedDict()
+        self._lock = threading.Lock()
+
+    def verify(self, id_token: str) -> dict:
+        """
+        Verifies a token and returns its claims.
+
+        Args:
+            id_token (str): The Firebase ID token.
+
+        Returns:
+            dict: The verified claims.
+
+        Raises:
+            jwt.InvalidTokenError: If the token is invalid or expired.
+        """
+        cache_key = hashlib.sha256(id_token.encode("utf-8")).digest()
+        with self._lock:
+            cached = self._claims.get(cache_key)
+            if cached is not None:
+                if cached["exp"] + self.leeway > time.time():
+                    self._claims.move_to_end(cache_key)
+                    return cached
+                del self._claims[cache_key]
+        header = jwt.get_unverified_header(id_token)
+        if header.get("alg") != "RS256":
+            raise jwt.InvalidTokenError("Unexpected algorithm")
+        claims = jwt.decode(
+            id_token,
+            self.key_cache.get(header.get("kid")),
+            algorithms=["RS256"],
+            audience=self.project_id,
+            issuer="https://securetoken.google.com/{0}".format(self.project_id),
+            leeway=self.leeway,
+            options={"require": ["exp", "iat", "sub"]},
+        )
+        if not claims["sub"]:
+            raise jwt.InvalidTokenError("Empty subject")
+        with self._lock:
+            self._claims[cache_key] = claims
+            while len(self._claims) > self.max_cached:
+                self._claims.popitem(last=False)
+        return claims
+
+
+@st.cache_resource(show_spinner=False)
+def get_token_verifier(project_id: str) -> IdTokenVerifier:
+    """
+    Returns the process-wide ID token verifier for a project.
+
+    The certificate URL can be overridden with a `[google_certs]` section in the secrets file.
+
+    Args:
+        project_id (str): The Firebase project ID.
+
+    Returns:
+        IdTokenVerifier: The shared verifier.
+    """
+    key_cache = PublicKeyCache(transport_from_settings("google_certs", GOOGLE_CERTS_URL))
+    return IdTokenVerifier(project_id, key_cache)